@@ -0,0 +1,340 @@
+import argparse
+import json
+import datetime
+import logging
+import time
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import download_tropomi
+import search_for_dates_in_bucket
+import scheduler
+import granule_cache
+import bucket_inventory
+import transfer_plan
+import metrics
+import integrity
+
+# S3 config files used by each mode
+S3_CONFIG_FILES = {"download": "conf/tropomi_s3_ro.json",
+                   "upload": "conf/tropomi_s3_rw.json",
+                   "search": "conf/tropomi_s3_ro.json"}
+
+# daterange product having the date format of each download/upload
+# time period
+TIMEPERIOD_PRODUCTS = {"day": "l3_day",
+                       "month": "l3_month",
+                       "year": "l3_year"}
+
+# Date formats of daterange products
+DATE_FORMATS = {"l2": "%Y%m%d",
+                "l3_day": "%Y%m%d",
+                "l3_month": "%Y%m",
+                "l3_year": "%Y"}
+
+# boto3 transfers use up to 10 threads per file by default
+CONNECTIONS_PER_WORKER = 10
+
+logger = logging.getLogger("logger")
+
+
+def find_variable_configs(mode, variables):
+    """ Find and read variable config files matching given names or globs.
+
+    Keyword arguments:
+    mode -- Options: download | upload | search
+    variables -- list of variable names or globs (e.g. no2-offl, ukraine-*)
+
+    Return:
+    variable_configs -- dictionary of variable configs by variable name
+    """
+    variable_configs = {}
+    for variable in variables:
+        variable_config_files = sorted(glob.glob(f"conf/{mode}/{variable}.json"))
+        if not variable_config_files:
+            logger.error(f'No configuration files found for variable {variable}')
+
+        for variable_config_file in variable_config_files:
+            var = os.path.splitext(os.path.basename(variable_config_file))[0]
+            logger.debug(f'Reading config file {variable_config_file}')
+            try:
+                with metrics.timer("config"), open(variable_config_file, "r") as jsonfile:
+                    variable_configs[var] = json.load(jsonfile)
+            except Exception as e:
+                logger.error(f'Error while reading the configuration file {variable_config_file}')
+                logger.error(e)
+
+    return variable_configs
+
+
+def get_dates(start_date, end_date, product):
+    """ Get list of dates between first and last date.
+
+    Keyword arguments:
+    start_date -- First date as string
+    end_date -- Last date as string
+    product -- Options: l2 | l3_day | l3_month | l3_year
+
+    Return:
+    list of dates from last to first
+    """
+    start_date = datetime.datetime.strptime(start_date, DATE_FORMATS[product]).date()
+    end_date = datetime.datetime.strptime(end_date, DATE_FORMATS[product]).date()
+
+    return list(search_for_dates_in_bucket.daterange(start_date, end_date, product = product, reverse = True))
+
+
+def run_tasks(tasks, workers):
+    """ Run tasks concurrently.
+
+    Keyword arguments:
+    tasks -- dictionary of task functions without arguments by task name
+    workers -- number of tasks run in parallel
+
+    Return:
+    n_failed -- number of failed tasks
+    """
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(task): name for name, task in tasks.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                logger.debug(f'Finished {futures[future]}')
+            except Exception as e:
+                logger.error(f'Error while running {futures[future]}')
+                logger.error(e)
+                n_failed += 1
+
+    return n_failed
+
+
+def main():
+
+    start_time = time.perf_counter()
+
+    # Create one S3 client shared by all tasks
+    s3 = download_tropomi.create_s3_client(S3_CONFIG_FILES[options.mode],
+                                           max_pool_connections = max(10, options.workers * CONNECTIONS_PER_WORKER))
+
+    # Variables of saved plan are used instead of given variables
+    if options.from_plan:
+        plan_vars = {item["var"] for item in transfer_plan.read_plan(options.from_plan)["items"] if "var" in item}
+        variable_configs = find_variable_configs(options.mode, sorted(plan_vars))
+    else:
+        variable_configs = find_variable_configs(options.mode, options.vars.split(','))
+
+    inventory = None
+    if options.inventory:
+        inventory = bucket_inventory.open_inventory(options.inventory)
+
+    # Serve downloads from local granule cache
+    if options.cache_dir:
+        granule_cache.configure(options.cache_dir,
+                                quota = options.cache_quota * 1e9 if options.cache_quota else None,
+                                policy = options.cache_policy,
+                                max_age = options.cache_max_age * 86400 if options.cache_max_age else None,
+                                link = options.cache_link)
+
+    # Schedule transfers together with other jobs on the host
+    if options.schedule or options.bandwidth:
+        scheduler.configure(options.priority or scheduler.lowest_priority(variable_configs),
+                            bandwidth = options.bandwidth * 1e6 if options.bandwidth else None)
+
+    # Verify transfers with checksums computed while transferring
+    if options.verify:
+        integrity.configure(options.digest_algorithm)
+
+    # Plan transfers of all variables and dates, or read saved plan.
+    # Searches and downloads list each bucket once for all variables using it.
+    check_present = options.plan or bool(options.plan_file)
+    with metrics.timer("plan", mode = options.mode):
+        if options.from_plan:
+            plan = transfer_plan.read_plan(options.from_plan)
+            if plan["mode"] != options.mode:
+                raise ValueError(f'Plan {options.from_plan} is for {plan["mode"]}, not {options.mode}.')
+        elif options.mode == "search":
+            dates = get_dates(options.start_date, options.end_date, options.product)
+            plan = transfer_plan.plan_search(s3, variable_configs, options.product, dates, inventory = inventory)
+        elif options.mode == "download":
+            dates = get_dates(options.start_date, options.end_date, TIMEPERIOD_PRODUCTS[options.timeperiod])
+            plan = transfer_plan.plan_downloads(s3, variable_configs, options.timeperiod, dates, inventory = inventory,
+                                                sync = options.sync, checksum = options.checksum,
+                                                stream_decompress = options.stream_decompress, resume = options.resume,
+                                                subset = options.subset, check_present = check_present)
+        else:
+            dates = get_dates(options.start_date, options.end_date, TIMEPERIOD_PRODUCTS[options.timeperiod])
+            plan = transfer_plan.plan_uploads(s3, variable_configs, options.timeperiod, dates,
+                                              sync = options.sync, checksum = options.checksum,
+                                              stream_compress = options.stream_compress, resume = options.resume,
+                                              check_present = check_present)
+
+    transfer_plan.summarize(plan, throughput = options.throughput * 1e6, workers = options.workers)
+    if options.plan_file:
+        transfer_plan.write_plan(plan, options.plan_file)
+    if options.plan or options.from_plan:
+        transfer_plan.log_plan(plan)
+    if options.plan:
+        return
+
+    # Parallel downloads are shared by the buckets
+    task_workers = options.workers
+    if plan["mode"] == "download":
+        task_workers = min(options.workers, max(1, len(plan["buckets"])))
+    tasks = transfer_plan.plan_tasks(s3, plan, variable_configs, datelist_dir = options.datelist_dir,
+                                     workers = max(1, options.workers // task_workers), resume = options.resume,
+                                     confirm_footprint = options.confirm_footprint)
+
+    n_failed = run_tasks(tasks, task_workers)
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'Finished {len(tasks)} {options.mode} tasks ({n_failed} failed) in {elapsed:.1f} s')
+
+
+if __name__ == '__main__':
+    #Parse commandline arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode',
+                        type = str,
+                        choices = ['download', 'upload', 'search'],
+                        help = 'Operation to run for all variables and dates.')
+    parser.add_argument('--vars',
+                        type = str,
+                        default = 'no2-offl',
+                        help = 'Comma separated list of Tropomi variables or globs (e.g. no2-offl,ukraine-*).')
+    parser.add_argument('--start_date',
+                        type = str,
+                        default = '20221101',
+                        help = 'First date to process.')
+    parser.add_argument('--end_date',
+                        type = str,
+                        default = '20221130',
+                        help = 'Last date to process.')
+    parser.add_argument('--timeperiod',
+                        type = str,
+                        default = 'day',
+                        help = 'Time period to download or upload. Options: day|month|year')
+    parser.add_argument('--product',
+                        type = str,
+                        default = 'l3_day',
+                        help = 'Product to search. Options: l2|l3_day|l3_month|l3_year')
+    parser.add_argument('--datelist_dir',
+                        type = str,
+                        default = '.',
+                        help = 'Directory for lists of found dates, one file per variable.')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 4,
+                        help = 'Number of tasks run in parallel.')
+    parser.add_argument('--stream_decompress',
+                        action = 'store_true',
+                        help = 'Unpack compressed files while downloading without storing the compressed file.')
+    parser.add_argument('--stream_compress',
+                        action = 'store_true',
+                        help = 'Compress data files while uploading without writing compressed file to disk.')
+    parser.add_argument('--sync',
+                        action = 'store_true',
+                        help = 'Download or upload only new or changed files.')
+    parser.add_argument('--checksum',
+                        action = 'store_true',
+                        help = 'Compare file content with S3 ETag in sync.')
+    parser.add_argument('--resume',
+                        action = 'store_true',
+                        help = 'Continue interrupted transfers and retry failed requests. Uploads with stream_compress compress data files on disk first.')
+    parser.add_argument('--verify',
+                        action = 'store_true',
+                        help = 'Verify transfers with checksums computed while streaming, quarantine and retry failing downloads.')
+    parser.add_argument('--digest_algorithm',
+                        type = str,
+                        default = 'sha256',
+                        help = 'Digest of uncompressed content stored in object metadata with verify. Options: md5, sha256, crc32c')
+    parser.add_argument('--subset',
+                        action = 'store_true',
+                        help = 'Read only subset_variables of configs from netCDF granules with ranged GETs. Needs h5py.')
+    parser.add_argument('--confirm_footprint',
+                        action = 'store_true',
+                        help = 'Remove downloaded granules whose footprint does not intersect bounding box of config. Needs h5py.')
+    parser.add_argument('--inventory',
+                        type = str,
+                        default = None,
+                        help = 'Local SQLite bucket inventory file to search instead of listing S3 buckets.')
+    parser.add_argument('--plan',
+                        action = 'store_true',
+                        help = 'Only list and print transfer plan with object counts, bytes, requests and estimated duration.')
+    parser.add_argument('--plan_file',
+                        type = str,
+                        default = None,
+                        help = 'JSON outfile for transfer plan, which can be executed later with --from_plan.')
+    parser.add_argument('--from_plan',
+                        type = str,
+                        default = None,
+                        help = 'Execute saved transfer plan without listing again.')
+    parser.add_argument('--throughput',
+                        type = float,
+                        default = transfer_plan.THROUGHPUT / 1e6,
+                        help = 'Throughput in MB/s for estimated duration of plan.')
+    parser.add_argument('--schedule',
+                        action = 'store_true',
+                        help = 'Share transfer slots and bandwidth with other scheduled jobs on the host by priority.')
+    parser.add_argument('--priority',
+                        type = str,
+                        default = None,
+                        help = 'Priority class of transfers. Options: nrti|offl|rpro, default from stream in least urgent variable.')
+    parser.add_argument('--bandwidth',
+                        type = float,
+                        default = None,
+                        help = 'Bandwidth limit of all scheduled transfers on the host in MB/s, implies --schedule.')
+    parser.add_argument('--cache_dir',
+                        type = str,
+                        default = None,
+                        help = 'Local granule cache directory shared by variables, downloaded files are linked from cache.')
+    parser.add_argument('--cache_quota',
+                        type = float,
+                        default = None,
+                        help = 'Maximum size of granule cache in GB.')
+    parser.add_argument('--cache_policy',
+                        type = str,
+                        default = 'lru',
+                        help = 'Which granules to evict first from cache. Options: lru|age')
+    parser.add_argument('--cache_max_age',
+                        type = float,
+                        default = None,
+                        help = 'Evict granules not used (lru) or cached (age) during this many days.')
+    parser.add_argument('--cache_link',
+                        type = str,
+                        default = 'hardlink',
+                        help = 'How cached granules are linked to local directories. Options: hardlink|symlink')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
+    parser.add_argument('--loglevel',
+                        default='info',
+                        help='minimum severity of logged messages,\
+                        options: debug, info, warning, error, critical, default=info')
+
+    options = parser.parse_args()
+
+    # Setup logger
+    loglevel_dict={'debug':logging.DEBUG,
+                   'info':logging.INFO,
+                   'warning':logging.WARNING,
+                   'error':logging.ERROR,
+                   'critical':logging.CRITICAL}
+    logger = logging.getLogger("logger")
+    logger.setLevel(loglevel_dict[options.loglevel])
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s | (%(filename)s:%(lineno)d)','%Y-%m-%d %H:%M:%S')
+    logging.Formatter.converter = time.gmtime # use utc
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    metrics.run(main, "batch_tropomi", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
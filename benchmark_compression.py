@@ -0,0 +1,118 @@
+import argparse
+import json
+import logging
+import time
+import io
+import os
+
+import compression
+
+
+def benchmark_codec(data, codec, compresslevel = None, workers = None):
+    """ Measure compression and decompression of data in memory.
+
+    Keyword arguments:
+    data -- uncompressed data bytes
+    codec -- Options: gzip | pgzip | zstd
+    compresslevel -- compression level, codec default if not given
+    workers -- number of compression threads for pgzip and zstd
+
+    Return:
+    result -- dictionary of sizes, ratio and throughputs
+    """
+    start_time = time.perf_counter()
+    compressed = b"".join(compression.compress_chunks(io.BytesIO(data), codec, compresslevel, workers))
+    compress_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    f_out = io.BytesIO()
+    # Block-parallel gzip output is unpacked as plain gzip
+    compression.decompress_stream(io.BytesIO(compressed), f_out, "gzip" if codec == "pgzip" else codec)
+    decompress_time = time.perf_counter() - start_time
+
+    if f_out.getvalue() != data:
+        raise ValueError(f'Decompressed data differs from original with codec {codec}')
+
+    return {"codec": codec,
+            "compresslevel": compresslevel if compresslevel is not None else compression.DEFAULT_COMPRESSLEVEL[codec],
+            "size": len(data),
+            "compressed_size": len(compressed),
+            "ratio": len(data) / max(len(compressed), 1),
+            "compress_time": compress_time,
+            "decompress_time": decompress_time,
+            "compress_mbps": len(data) / 1e6 / compress_time,
+            "decompress_mbps": len(data) / 1e6 / decompress_time}
+
+
+def main():
+
+    results = []
+    for filename in options.files:
+        logger.debug(f'Reading file {filename}')
+        with open(filename, 'rb') as f_in:
+            data = f_in.read()
+
+        for codec in options.codecs.split(','):
+            try:
+                compression.check_codec(codec)
+            except ValueError as e:
+                logger.warning(e)
+                continue
+
+            result = benchmark_codec(data, codec, options.compresslevel, options.workers)
+            result["file"] = os.path.basename(filename)
+            results.append(result)
+            print(f'{result["file"]} {codec:>6} level {result["compresslevel"]}: '
+                  f'ratio {result["ratio"]:.2f}, '
+                  f'compress {result["compress_mbps"]:.1f} MB/s, '
+                  f'decompress {result["decompress_mbps"]:.1f} MB/s')
+
+    if options.output_file:
+        with open(options.output_file, 'w') as outfile:
+            json.dump(results, outfile, indent = 4)
+
+
+if __name__ == '__main__':
+    #Parse commandline arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files',
+                        nargs = '+',
+                        help = 'Sample files (e.g. L3 netCDF files) to compress.')
+    parser.add_argument('--codecs',
+                        type = str,
+                        default = 'gzip,pgzip,zstd',
+                        help = 'Comma separated list of codecs to compare. Options: gzip, pgzip, zstd')
+    parser.add_argument('--compresslevel',
+                        type = int,
+                        default = None,
+                        help = 'Compression level, codec default if not given.')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = None,
+                        help = 'Number of compression threads for pgzip and zstd, number of CPUs if not given.')
+    parser.add_argument('--output_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for results in JSON format.')
+    parser.add_argument('--loglevel',
+                        default='info',
+                        help='minimum severity of logged messages,\
+                        options: debug, info, warning, error, critical, default=info')
+
+    options = parser.parse_args()
+
+    # Setup logger
+    loglevel_dict={'debug':logging.DEBUG,
+                   'info':logging.INFO,
+                   'warning':logging.WARNING,
+                   'error':logging.ERROR,
+                   'critical':logging.CRITICAL}
+    logger = logging.getLogger("logger")
+    logger.setLevel(loglevel_dict[options.loglevel])
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s | (%(filename)s:%(lineno)d)','%Y-%m-%d %H:%M:%S')
+    logging.Formatter.converter = time.gmtime # use utc
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    main()
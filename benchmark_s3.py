@@ -0,0 +1,567 @@
+import argparse
+import json
+import datetime
+import logging
+import time
+import io
+import os
+import math
+import random
+import shutil
+import struct
+import platform
+import statistics
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+import compression
+import bucket_inventory
+import region_filter
+import download_tropomi
+import upload_tropomi
+import search_for_dates_in_bucket
+import metrics
+
+logger = logging.getLogger("logger")
+
+# Buckets and object names of synthetic S5P products
+L2_BUCKET = "benchmark-tropomi-no2"
+L3_BUCKET = "benchmark-tropomi-no2-l3"
+FIRST_DATE = datetime.date(2022, 1, 1)
+L2_TEMPLATE = "S5P_OFFL_L2__NO2____{date}"
+L3_DAY_TEMPLATE = "S5P_OFFL_L3_NO2_dailycomposite_{date}"
+L3_MONTH_TEMPLATE = "S5P_OFFL_L3_NO2_monthlycomposite_{date}"
+UPLOAD_KEY = "benchmark_upload_S5P_OFFL_L3_NO2_monthlycomposite.nc"
+
+# Synthetic data is made of distinct 1 MiB blocks of float32 fields, where
+# part of the values are fill values as in swaths and composites
+BLOCK_SIZE = 1024 * 1024
+N_BLOCKS = 8
+FILL_FRACTION = 0.4
+FILL_VALUE = 9.96921e36
+
+# Benchmarks in the order they are run
+BENCHMARKS = ["list", "search", "download", "upload", "compression"]
+
+
+def granule_keys(days, first_date = FIRST_DATE):
+    """ Get names of OFFL L2 granules of consecutive days, one granule per
+    orbit with sensing times and orbit numbers of the real orbits.
+
+    Keyword arguments:
+    days -- number of days
+    first_date -- first sensing date
+
+    Return:
+    keys -- list of S3 object names
+    """
+    first_time = datetime.datetime.combine(first_date, datetime.time(), tzinfo = datetime.timezone.utc)
+    last_time = first_time + datetime.timedelta(days = days)
+    orbit = region_filter.REFERENCE_ORBIT + math.ceil(
+        (first_time - region_filter.REFERENCE_ORBIT_START).total_seconds() / region_filter.ORBIT_PERIOD)
+
+    keys = []
+    while True:
+        start = region_filter.REFERENCE_ORBIT_START + datetime.timedelta(
+            seconds = (orbit - region_filter.REFERENCE_ORBIT) * region_filter.ORBIT_PERIOD)
+        if start >= last_time:
+            return keys
+        end = start + datetime.timedelta(seconds = region_filter.ORBIT_PERIOD)
+        production = end + datetime.timedelta(days = 1)
+        keys.append(f"{L2_TEMPLATE.format(date = start.strftime('%Y%m%dT%H%M%S'))}_{end:%Y%m%dT%H%M%S}_"
+                    f"{orbit:05d}_03_020400_{production:%Y%m%dT%H%M%S}.nc")
+        orbit += 1
+
+
+def synthetic_blocks(seed):
+    """ Make blocks of synthetic float32 fields, which compress roughly
+    like TROPOMI products: smooth fields with noise and runs of fill values.
+
+    Keyword arguments:
+    seed -- random seed
+
+    Return:
+    blocks -- list of N_BLOCKS bytes objects of BLOCK_SIZE bytes
+    """
+    rng = random.Random(seed)
+    blocks = []
+    for n in range(N_BLOCKS):
+        values = []
+        value = rng.uniform(0, 1e-4)
+        while len(values) < BLOCK_SIZE // 4:
+            run = rng.randint(16, 2048)
+            if rng.random() < FILL_FRACTION:
+                values += [FILL_VALUE] * run
+            else:
+                for i in range(run):
+                    value = abs(value + rng.gauss(0, 1e-6))
+                    values.append(value)
+        blocks.append(struct.pack(f"<{BLOCK_SIZE // 4}f", *values[:BLOCK_SIZE // 4]))
+    return blocks
+
+
+def synthetic_data(size, seed, blocks):
+    """ Get synthetic data of given size made of blocks in random order.
+
+    Keyword arguments:
+    size -- number of bytes
+    seed -- random seed of block order
+    blocks -- list of blocks from synthetic_blocks
+
+    Return:
+    data -- bytes
+    """
+    rng = random.Random(seed)
+    return b"".join(rng.choice(blocks) for n in range(size // BLOCK_SIZE + 1))[:size]
+
+
+def put_objects(s3, bucket_name, objects, workers):
+    """ Upload objects which are not yet found in bucket, so that an
+    existing stand-in is filled only once.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    objects -- dictionary of functions giving (data, metadata) by object name
+    workers -- number of parallel uploads
+
+    Return:
+    n_objects -- number of uploaded objects
+    """
+    try:
+        s3.create_bucket(Bucket = bucket_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+            raise
+    existing = {key['Key'] for key in bucket_inventory.list_bucket(s3, bucket_name)}
+    missing = [name for name in objects if name not in existing]
+
+    def put(name):
+        data, metadata = objects[name]()
+        s3.put_object(Bucket = bucket_name, Key = name, Body = data, Metadata = metadata)
+
+    logger.info(f'Filling bucket {bucket_name} with {len(missing)} objects, {len(existing)} already found')
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        list(pool.map(put, missing))
+    return len(missing)
+
+
+def fill_buckets(s3, blocks, days, granule_size, daily_size, monthly_size, months, seed, workers):
+    """ Fill L2 bucket with granules and L3 bucket with gzip compressed
+    daily and monthly composites.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    blocks -- list of blocks from synthetic_blocks
+    days -- number of days of products
+    granule_size -- size of L2 granules in bytes
+    daily_size -- size of daily composites in bytes before compression
+    monthly_size -- size of monthly composites in bytes before compression
+    months -- number of monthly composites
+    seed -- random seed
+    workers -- number of parallel uploads
+
+    Return:
+    dates -- list of dates of products, format YYYYMMDD
+    """
+    def granule(n):
+        return lambda: (synthetic_data(granule_size, seed + n, blocks), {})
+
+    def composite(size, n):
+        def make():
+            data = synthetic_data(size, seed + n, blocks)
+            compressed = b"".join(compression.compress_chunks(io.BytesIO(data), "gzip"))
+            return compressed, {compression.METADATA_KEY: "gzip"}
+        return make
+
+    dates = [(FIRST_DATE + datetime.timedelta(n)).strftime("%Y%m%d") for n in range(days)]
+    put_objects(s3, L2_BUCKET, {key: granule(n) for n, key in enumerate(granule_keys(days))}, workers)
+
+    composites = {f"{L3_DAY_TEMPLATE.format(date = date)}.nc.gz": composite(daily_size, n)
+                  for n, date in enumerate(dates)}
+    for month in sorted({date[:6] for date in dates})[:months]:
+        composites[f"{L3_MONTH_TEMPLATE.format(date = month)}.nc.gz"] = composite(monthly_size, int(month))
+    put_objects(s3, L3_BUCKET, composites, workers)
+
+    return dates
+
+
+def timed(function, repeat, setup = None):
+    """ Run function repeatedly and time it. Metrics are reset before each
+    run, so that requests of the run are counted.
+
+    Keyword arguments:
+    function -- function without arguments
+    repeat -- number of runs
+    setup -- function run before each run, not timed (optional)
+
+    Return:
+    seconds -- list of durations of runs
+    requests -- number of S3 requests of the last run
+    value -- return value of the last run
+    """
+    seconds = []
+    for n in range(repeat):
+        if setup is not None:
+            setup()
+        metrics.reset()
+        start_time = time.perf_counter()
+        value = function()
+        seconds.append(time.perf_counter() - start_time)
+    requests = sum(count for (name, labels), count in metrics.snapshot()[1].items() if name == "requests")
+    return seconds, requests, value
+
+
+def result(benchmark, case, seconds, requests, n_objects = None, n_bytes = None):
+    """ Make result record of benchmark case.
+
+    Keyword arguments:
+    benchmark -- benchmark name
+    case -- case name
+    seconds -- list of durations of runs
+    requests -- number of S3 requests of a run
+    n_objects -- number of handled objects or files (optional)
+    n_bytes -- number of handled bytes (optional)
+
+    Return:
+    result -- dictionary of durations, counts and throughputs
+    """
+    median = statistics.median(seconds)
+    record = {"benchmark": benchmark,
+              "case": case,
+              "runs": len(seconds),
+              "seconds": [round(value, 6) for value in seconds],
+              "min_seconds": round(min(seconds), 6),
+              "median_seconds": round(median, 6),
+              "requests": requests}
+    if n_objects is not None:
+        record["objects"] = n_objects
+        record["objects_per_second"] = round(n_objects / median, 1)
+    if n_bytes is not None:
+        record["bytes"] = n_bytes
+        record["mbps"] = round(n_bytes / 1e6 / median, 2)
+    logger.info(f'{benchmark} {case}: median {median:.3f} s, {requests} requests'
+                + (f', {record["mbps"]} MB/s' if n_bytes is not None else '')
+                + (f', {record["objects_per_second"]} objects/s' if n_objects is not None else ''))
+    return record
+
+
+def benchmark_list(s3, dates, repeat):
+    """ Measure listing latency of one day and of the whole L2 bucket.
+    """
+    pattern = L2_TEMPLATE.format(date = dates[len(dates) // 2])
+    seconds, requests, keys = timed(lambda: download_tropomi.list_files_containing_pattern(s3, L2_BUCKET, pattern),
+                                    repeat)
+    results = [result("list", "l2_day", seconds, requests, n_objects = len(keys))]
+
+    seconds, requests, keys = timed(lambda: list(bucket_inventory.list_bucket(s3, L2_BUCKET)), repeat)
+    results.append(result("list", "l2_bucket", seconds, requests, n_objects = len(keys)))
+    return results
+
+
+def benchmark_search(s3, dates, repeat):
+    """ Measure searching a date range for L2 granules and L3 composites,
+    date by date and with a single listing.
+    """
+    variable_config = {"l2": {"bucket_name": L2_BUCKET, "obj_name_start": L2_TEMPLATE},
+                       "l3_day": {"bucket_name": L3_BUCKET, "obj_name_start": L3_DAY_TEMPLATE}}
+    results = []
+    pattern = L2_TEMPLATE.format(date = dates[-1])
+    seconds, requests, found = timed(lambda: search_for_dates_in_bucket.search_for_pattern(s3, L2_BUCKET, pattern),
+                                     repeat)
+    results.append(result("search", "l2_pattern", seconds, requests))
+
+    for product in variable_config:
+        for single_listing in (False, True):
+            seconds, requests, found = timed(lambda: list(search_for_dates_in_bucket.search_variable(
+                s3, variable_config, product, dates, single_listing = single_listing)), repeat)
+            if len(found) != len(dates):
+                logger.warning(f'Found {len(found)} of {len(dates)} dates of {product}')
+            results.append(result("search", f"{product}_{'single_listing' if single_listing else 'per_date'}",
+                                  seconds, requests, n_objects = len(dates)))
+    return results
+
+
+def benchmark_download(s3, dates, workdir, workers, repeat):
+    """ Measure download throughput of one day of granules, file by file
+    and in parallel, and of a monthly composite with and without
+    unpacking from the download stream.
+    """
+    outpath = os.path.join(workdir, "download")
+
+    def clean():
+        shutil.rmtree(outpath, ignore_errors = True)
+        os.makedirs(outpath)
+
+    def download(bucket_name, pattern, workers, stream_decompress = False):
+        return lambda: download_tropomi.get_files_containing_pattern(s3, bucket_name, pattern, outpath,
+                                                                     workers = workers,
+                                                                     stream_decompress = stream_decompress)
+
+    results = []
+    pattern = L2_TEMPLATE.format(date = dates[len(dates) // 2])
+    keys = download_tropomi.list_files_containing_pattern(s3, L2_BUCKET, pattern)
+    for n_workers in sorted({1, workers}):
+        seconds, requests, value = timed(download(L2_BUCKET, pattern, n_workers), repeat, clean)
+        results.append(result("download", f"l2_day_workers_{n_workers}", seconds, requests,
+                              n_objects = len(keys), n_bytes = sum(key['Size'] for key in keys)))
+
+    pattern = L3_MONTH_TEMPLATE.format(date = dates[0][:6])
+    keys = download_tropomi.list_files_containing_pattern(s3, L3_BUCKET, pattern)
+    if not keys:
+        logger.warning(f'No monthly composites found for pattern {pattern}')
+        return results
+    for stream_decompress in (False, True):
+        seconds, requests, value = timed(download(L3_BUCKET, pattern, 1, stream_decompress), repeat, clean)
+        results.append(result("download", f"l3_month{'_stream_decompress' if stream_decompress else ''}",
+                              seconds, requests, n_objects = len(keys), n_bytes = sum(key['Size'] for key in keys)))
+    return results
+
+
+def benchmark_upload(s3, datafile, repeat):
+    """ Measure upload throughput of a composite as is and compressed
+    while uploading.
+    """
+    size = os.path.getsize(datafile)
+    seconds, requests, value = timed(lambda: upload_tropomi.upload_file(s3, datafile, L3_BUCKET, UPLOAD_KEY), repeat)
+    results = [result("upload", "l3_month", seconds, requests, n_objects = 1, n_bytes = size)]
+
+    seconds, requests, value = timed(lambda: upload_tropomi.upload_file_compress_stream(
+        s3, datafile, L3_BUCKET, f"{UPLOAD_KEY}.gz", codec = "gzip"), repeat)
+    results.append(result("upload", "l3_month_stream_compress_gzip", seconds, requests, n_objects = 1, n_bytes = size))
+    return results
+
+
+def benchmark_compression(datafile, codecs, repeat):
+    """ Measure compression and decompression of a composite file on disk
+    with each codec.
+    """
+    size = os.path.getsize(datafile)
+    results = []
+    for codec in codecs:
+        try:
+            compression.check_codec(codec)
+        except ValueError as e:
+            logger.warning(e)
+            continue
+
+        compressed_file = f"{datafile}.{codec}{compression.CODEC_EXTENSIONS[codec]}"
+        seconds, requests, value = timed(lambda: compression.compress_file(datafile, compressed_file, codec), repeat)
+        record = result("compression", f"compress_{codec}", seconds, requests, n_bytes = size)
+        record["ratio"] = round(size / max(os.path.getsize(compressed_file), 1), 3)
+        results.append(record)
+
+        seconds, requests, value = timed(lambda: compression.decompress_file(compressed_file, f"{datafile}.out"),
+                                         repeat)
+        results.append(result("compression", f"decompress_{codec}", seconds, requests, n_bytes = size))
+        os.remove(compressed_file)
+        os.remove(f"{datafile}.out")
+    return results
+
+
+def compare(results, baseline_file):
+    """ Log change of median durations against results of earlier run.
+
+    Keyword arguments:
+    results -- list of result records
+    baseline_file -- JSON outfile of earlier run
+    """
+    with open(baseline_file, 'r') as infile:
+        baseline = {(record["benchmark"], record["case"]): record for record in json.load(infile)["results"]}
+    for record in results:
+        other = baseline.get((record["benchmark"], record["case"]))
+        if other is None:
+            continue
+        change = record["median_seconds"] / max(other["median_seconds"], 1e-9) - 1
+        logger.info(f'{record["benchmark"]} {record["case"]}: {other["median_seconds"]:.3f} s -> '
+                    f'{record["median_seconds"]:.3f} s ({change:+.1%}), '
+                    f'requests {other["requests"]} -> {record["requests"]}')
+
+
+def git_revision():
+    """ Get git commit of the code, None outside git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    benchmarks = options.benchmarks.split(',')
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            raise ValueError(f'Give valid benchmark name, not {benchmark}.')
+
+    # Use given S3 stand-in, e.g. MinIO, or start moto server in this process
+    server = None
+    if options.s3_config:
+        s3 = download_tropomi.create_s3_client(options.s3_config, max_pool_connections = options.workers * 2)
+        endpoint = "s3_config"
+    else:
+        if ThreadedMotoServer is None:
+            raise ValueError('Give s3_config of S3 stand-in or install python package moto.')
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = ThreadedMotoServer(ip_address = "127.0.0.1", port = options.port, verbose = False)
+        server.start()
+        endpoint = "moto"
+        s3 = boto3.client("s3",
+                          aws_access_key_id = "benchmark",
+                          aws_secret_access_key = "benchmark",
+                          region_name = "us-east-1",
+                          endpoint_url = f"http://127.0.0.1:{options.port}",
+                          config = Config(max_pool_connections = options.workers * 2))
+        metrics.instrument(s3)
+
+    workdir = tempfile.mkdtemp(prefix = "benchmark_s3_", dir = options.workdir)
+    try:
+        blocks = synthetic_blocks(options.seed)
+        start_time = time.perf_counter()
+        dates = fill_buckets(s3, blocks, options.days, int(options.granule_size * 1e6),
+                             int(options.daily_size * 1e6), int(options.monthly_size * 1e6), options.months,
+                             options.seed, options.workers)
+        logger.info(f'Filled buckets in {time.perf_counter() - start_time:.1f} s')
+
+        datafile = os.path.join(workdir, "S5P_OFFL_L3_NO2_monthlycomposite.nc")
+        with open(datafile, 'wb') as outfile:
+            outfile.write(synthetic_data(int(options.monthly_size * 1e6), options.seed, blocks))
+
+        results = []
+        for benchmark in benchmarks:
+            if benchmark == "list":
+                results += benchmark_list(s3, dates, options.repeat)
+            elif benchmark == "search":
+                results += benchmark_search(s3, dates, options.repeat)
+            elif benchmark == "download":
+                results += benchmark_download(s3, dates, workdir, options.workers, options.repeat)
+            elif benchmark == "upload":
+                results += benchmark_upload(s3, datafile, options.repeat)
+            elif benchmark == "compression":
+                results += benchmark_compression(datafile, options.codecs.split(','), options.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+        if server is not None:
+            server.stop()
+
+    if options.baseline:
+        compare(results, options.baseline)
+
+    if options.output_file:
+        report = {"created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                  "revision": git_revision(),
+                  "environment": {"python": platform.python_version(),
+                                  "platform": platform.platform(),
+                                  "cpus": os.cpu_count(),
+                                  "boto3": boto3.__version__,
+                                  "endpoint": endpoint},
+                  "parameters": {"days": options.days,
+                                 "l2_granules": len(granule_keys(options.days)),
+                                 "granule_size": options.granule_size,
+                                 "daily_size": options.daily_size,
+                                 "monthly_size": options.monthly_size,
+                                 "months": options.months,
+                                 "workers": options.workers,
+                                 "repeat": options.repeat,
+                                 "seed": options.seed},
+                  "results": results}
+        with open(options.output_file, 'w') as outfile:
+            json.dump(report, outfile, indent = 4)
+
+
+if __name__ == '__main__':
+    #Parse commandline arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--s3_config',
+                        type = str,
+                        default = None,
+                        help = '.json S3 config file of S3 stand-in (e.g. MinIO), moto server is started if not given.')
+    parser.add_argument('--port',
+                        type = int,
+                        default = 5075,
+                        help = 'Port of moto server. Default 5075')
+    parser.add_argument('--benchmarks',
+                        type = str,
+                        default = ','.join(BENCHMARKS),
+                        help = f'Comma separated list of benchmarks. Options: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--days',
+                        type = int,
+                        default = 180,
+                        help = 'Number of days of synthetic products, about 14 L2 granules per day. Default 180')
+    parser.add_argument('--granule_size',
+                        type = float,
+                        default = 0.25,
+                        help = 'Size of synthetic L2 granules in MB. Default 0.25')
+    parser.add_argument('--daily_size',
+                        type = float,
+                        default = 0.25,
+                        help = 'Size of synthetic daily composites in MB before compression. Default 0.25')
+    parser.add_argument('--monthly_size',
+                        type = float,
+                        default = 64,
+                        help = 'Size of synthetic monthly composites in MB before compression. Default 64')
+    parser.add_argument('--months',
+                        type = int,
+                        default = 1,
+                        help = 'Number of synthetic monthly composites. Default 1')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of parallel downloads in the parallel download case. Default 8')
+    parser.add_argument('--repeat',
+                        type = int,
+                        default = 3,
+                        help = 'Number of runs of each case. Default 3')
+    parser.add_argument('--codecs',
+                        type = str,
+                        default = 'gzip,pgzip,zstd',
+                        help = 'Comma separated list of codecs to compare. Options: gzip, pgzip, zstd')
+    parser.add_argument('--seed',
+                        type = int,
+                        default = 0,
+                        help = 'Random seed of synthetic data. Default 0')
+    parser.add_argument('--workdir',
+                        type = str,
+                        default = None,
+                        help = 'Directory for temporary local files, system temporary directory if not given.')
+    parser.add_argument('--output_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for results in JSON format.')
+    parser.add_argument('--baseline',
+                        type = str,
+                        default = None,
+                        help = 'Results of earlier run in JSON format to compare with.')
+    parser.add_argument('--loglevel',
+                        default='info',
+                        help='minimum severity of logged messages,\
+                        options: debug, info, warning, error, critical, default=info')
+
+    options = parser.parse_args()
+
+    # Setup logger
+    loglevel_dict={'debug':logging.DEBUG,
+                   'info':logging.INFO,
+                   'warning':logging.WARNING,
+                   'error':logging.ERROR,
+                   'critical':logging.CRITICAL}
+    logger = logging.getLogger("logger")
+    logger.setLevel(loglevel_dict[options.loglevel])
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s | (%(filename)s:%(lineno)d)','%Y-%m-%d %H:%M:%S')
+    logging.Formatter.converter = time.gmtime # use utc
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    main()
@@ -0,0 +1,179 @@
+import logging
+import re
+import datetime
+import sqlite3
+
+import s3_listing
+
+logger = logging.getLogger("logger")
+
+# TROPOMI filenames, e.g.
+# S5P_OFFL_L2__NO2____20221102T001500_20221102T015630_26240_03_020400_20221103T170957.nc
+# S5P_OFFL_L3_NO2_dailycomposite_ukraine_20221102.nc.gz
+L2_FILENAME_REGEX = re.compile(r"S5P_(?P<stream>[A-Z_]{4})_(?P<product>L2__\w{6})_"
+                               r"(?P<date>\d{8})T\d{6}_\d{8}T\d{6}_(?P<orbit>\d{5})")
+L3_FILENAME_REGEX = re.compile(r"S5P_(?P<stream>[A-Z_]{4})_(?P<product>L3_[A-Z0-9]+_[a-z_]+?)_(?P<date>\d{4,8})\b")
+
+# Sensing start and end times in TROPOMI L2 filenames
+SENSING_TIME_REGEX = re.compile(r"_(\d{8}T\d{6})_(\d{8}T\d{6})_")
+SENSING_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    stream TEXT,
+    product TEXT,
+    date TEXT,
+    orbit INTEGER,
+    PRIMARY KEY (bucket, key)
+);
+CREATE INDEX IF NOT EXISTS objects_product_date ON objects (bucket, product, date);
+CREATE INDEX IF NOT EXISTS objects_orbit ON objects (bucket, orbit);
+"""
+
+
+def open_inventory(inventory_file):
+    """ Open local bucket inventory database, create it if it does not exist.
+
+    Keyword arguments:
+    inventory_file -- SQLite database file
+
+    Return:
+    conn -- SQLite connection
+    """
+    logger.debug(f'Opening bucket inventory {inventory_file}')
+    conn = sqlite3.connect(inventory_file)
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def parse_tropomi_filename(key):
+    """ Parse stream, product, date and orbit from TROPOMI filename.
+
+    Keyword arguments:
+    key -- S3 object name
+
+    Return:
+    dictionary with keys stream, product, date and orbit, values are None
+    if filename does not follow TROPOMI naming
+    """
+    for regex in (L2_FILENAME_REGEX, L3_FILENAME_REGEX):
+        match = regex.search(key)
+        if match:
+            fields = match.groupdict()
+            return {"stream": fields["stream"],
+                    "product": fields["product"],
+                    "date": fields["date"],
+                    "orbit": int(fields["orbit"]) if fields.get("orbit") else None}
+
+    return {"stream": None, "product": None, "date": None, "orbit": None}
+
+
+def sensing_times(key):
+    """ Parse sensing start and end times from TROPOMI L2 filename.
+
+    Keyword arguments:
+    key -- S3 object name
+
+    Return:
+    (start, end) -- UTC datetimes, None if not found
+    """
+    match = SENSING_TIME_REGEX.search(key)
+    if not match:
+        return None
+    return tuple(datetime.datetime.strptime(time_string, SENSING_TIME_FORMAT).replace(tzinfo = datetime.timezone.utc)
+                 for time_string in match.groups())
+
+
+def _prefix_condition(prefix):
+    """ SQL condition and parameters for keys starting with prefix, which
+    uses the primary key index.
+    """
+    if not prefix:
+        return "", ()
+    return " AND key >= ? AND key < ?", (prefix, prefix + "\U0010ffff")
+
+
+def refresh_inventory(conn, s3, bucket_name, prefix = "", full = False):
+    """ Update bucket inventory from S3 listing. Incremental refresh lists
+    only objects after the newest key already in the inventory.
+
+    Incremental refresh does not notice removed or rewritten objects, or
+    new objects sorting before the newest known key. Use prefix to keep
+    products with different filename beginnings apart, and full refresh
+    to resynchronize.
+
+    Keyword arguments:
+    conn -- SQLite connection
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    prefix -- refresh only objects starting with prefix
+    full -- if True, list all objects again and remove objects not found
+
+    Return:
+    n_objects -- number of listed objects
+    """
+    condition, parameters = _prefix_condition(prefix)
+    newest_key = None
+    if full:
+        conn.execute(f"DELETE FROM objects WHERE bucket = ?{condition}", (bucket_name,) + parameters)
+    else:
+        newest_key = conn.execute(f"SELECT MAX(key) FROM objects WHERE bucket = ?{condition}",
+                                  (bucket_name,) + parameters).fetchone()[0]
+
+    logger.debug(f'Refreshing inventory of bucket {bucket_name} with prefix {prefix} after key {newest_key}')
+    rows = []
+    for key in s3_listing.list_objects_sharded(s3, bucket_name, prefix, start_after = newest_key):
+        fields = parse_tropomi_filename(key['Key'])
+        rows.append((bucket_name, key['Key'], key['Size'], key['ETag'].strip('"'),
+                     key['LastModified'].isoformat(), fields["stream"], fields["product"],
+                     fields["date"], fields["orbit"]))
+    conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    n_objects = len(rows)
+
+    logger.debug(f'Added {n_objects} objects to inventory of bucket {bucket_name}')
+    return n_objects
+
+
+def list_objects(conn, bucket_name, prefix = ""):
+    """ Generator function for listing objects from bucket inventory
+
+    Keyword arguments:
+    conn -- SQLite connection
+    bucket_name -- S3 bucket name
+    prefix -- list only objects starting with prefix
+
+    Yield:
+    object descriptions in the same form as in S3 listing
+    """
+    condition, parameters = _prefix_condition(prefix)
+    cursor = conn.execute(f"SELECT key, size, etag, last_modified FROM objects WHERE bucket = ?{condition} ORDER BY key",
+                          (bucket_name,) + parameters)
+    for key, size, etag, last_modified in cursor:
+        yield {"Key": key, "Size": size, "ETag": f'"{etag}"',
+               "LastModified": datetime.datetime.fromisoformat(last_modified)}
+
+
+def list_bucket(s3, bucket_name, prefix = "", inventory = None):
+    """ Generator function for listing objects from bucket inventory if
+    given, otherwise from S3
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    prefix -- list only objects starting with prefix
+    inventory -- SQLite connection of bucket inventory (optional)
+
+    Yield:
+    object descriptions from S3 listing
+    """
+    if inventory is not None:
+        yield from list_objects(inventory, bucket_name, prefix)
+    else:
+        yield from s3_listing.list_objects_sharded(s3, bucket_name, prefix)
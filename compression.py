@@ -0,0 +1,226 @@
+import logging
+import os
+import zlib
+import gzip
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("logger")
+
+# Size of chunks read from input and of independently compressed blocks
+# in block-parallel gzip
+READ_CHUNKSIZE = 1024 * 1024
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Default compression levels, gzip same as gzip.open
+DEFAULT_COMPRESSLEVEL = {"gzip": 9,
+                         "pgzip": 9,
+                         "zstd": 3}
+
+# Filename extensions of compressed files
+CODEC_EXTENSIONS = {"gzip": ".gz",
+                    "pgzip": ".gz",
+                    "zstd": ".zst"}
+
+# S3 object metadata key telling which codec was used
+METADATA_KEY = "compression"
+
+
+def check_codec(codec):
+    """ Check that compression codec is known and available.
+
+    Keyword arguments:
+    codec -- Options: gzip | pgzip | zstd
+    """
+    if codec not in CODEC_EXTENSIONS:
+        raise ValueError(f'Give valid compression codec, not {codec}.')
+    if codec == "zstd" and zstandard is None:
+        raise ValueError('Compression codec zstd needs python package zstandard.')
+
+
+def codec_from_filename(filename, metadata = None):
+    """ Get codec for decompressing file from S3 object metadata or
+    filename extension.
+
+    Keyword arguments:
+    filename -- file or S3 object name
+    metadata -- S3 object metadata dictionary (optional)
+
+    Return:
+    codec -- gzip | zstd, or None if file is not compressed
+    """
+    if metadata and METADATA_KEY in metadata:
+        # Block-parallel gzip output is plain multi-member gzip
+        return "gzip" if metadata[METADATA_KEY] == "pgzip" else metadata[METADATA_KEY]
+    if filename.endswith(".gz"):
+        return "gzip"
+    if filename.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def decompressed_filename(filename):
+    """ Get filename without compression extension.
+
+    Keyword arguments:
+    filename -- compressed filename
+
+    Return:
+    filename without .gz or .zst extension
+    """
+    if codec_from_filename(filename):
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def _compress_block(block, compresslevel):
+    """ Compress block as a complete gzip member. zlib releases the GIL
+    while compressing, so blocks can be compressed in threads.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _read_blocks(f_in, block_size, digest = None):
+    """ Generator function for reading file object in blocks
+    """
+    while True:
+        block = f_in.read(block_size)
+        if not block:
+            break
+        if digest is not None:
+            digest.update(block)
+        yield block
+
+
+def _copy_digest(f_in, f_out, digest):
+    """ Copy file object into another file object in chunks and update
+    hash object with the copied data.
+    """
+    for chunk in _read_blocks(f_in, READ_CHUNKSIZE, digest):
+        f_out.write(chunk)
+
+
+def compress_chunks(f_in, codec = "gzip", compresslevel = None, workers = None, digest = None):
+    """ Generator function for compressing file object in chunks
+
+    Block-parallel gzip compresses blocks as separate gzip members, which
+    plain gunzip unpacks as one file. zstd uses its own worker threads.
+
+    Keyword arguments:
+    f_in -- binary file object to compress
+    codec -- Options: gzip | pgzip | zstd
+    compresslevel -- compression level, codec default if not given
+    workers -- number of compression threads for pgzip and zstd
+    digest -- hash object updated with the uncompressed data (optional)
+
+    Yield:
+    compressed data chunks
+    """
+    check_codec(codec)
+    if compresslevel is None:
+        compresslevel = DEFAULT_COMPRESSLEVEL[codec]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if codec == "gzip":
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in _read_blocks(f_in, READ_CHUNKSIZE, digest):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    elif codec == "pgzip":
+        # Keep limited number of blocks in flight and yield them in order
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            futures = deque()
+            n_blocks = 0
+            for block in _read_blocks(f_in, BLOCK_SIZE, digest):
+                futures.append(pool.submit(_compress_block, block, compresslevel))
+                n_blocks += 1
+                if len(futures) >= workers * 2:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        # Empty file is compressed as one empty gzip member to get a valid stream
+        if n_blocks == 0:
+            yield _compress_block(b"", compresslevel)
+
+    elif codec == "zstd":
+        compressor = zstandard.ZstdCompressor(level = compresslevel, threads = workers)
+        chunker = compressor.chunker(chunk_size = READ_CHUNKSIZE)
+        for chunk in _read_blocks(f_in, READ_CHUNKSIZE, digest):
+            for data in chunker.compress(chunk):
+                yield data
+        for data in chunker.finish():
+            yield data
+
+
+def compress_file(infile, outfile, codec = "gzip", compresslevel = None, workers = None, digest = None):
+    """ Compress file with given codec.
+
+    Keyword arguments:
+    infile -- file to compress
+    outfile -- compressed output file
+    codec -- Options: gzip | pgzip | zstd
+    compresslevel -- compression level, codec default if not given
+    workers -- number of compression threads for pgzip and zstd
+    digest -- hash object updated with the uncompressed data (optional)
+    """
+    logger.debug(f'Compressing file {infile} with {codec}')
+    with open(infile, 'rb') as f_in:
+        with open(outfile, 'wb') as f_out:
+            for data in compress_chunks(f_in, codec, compresslevel, workers, digest):
+                f_out.write(data)
+
+
+def decompress_stream(f_in, f_out, codec, digest = None):
+    """ Decompress file object into another file object in chunks.
+
+    Keyword arguments:
+    f_in -- binary file object to decompress, e.g. S3 response body
+    f_out -- binary file object to write to
+    codec -- Options: gzip | zstd
+    digest -- hash object updated with the decompressed data (optional)
+    """
+    if codec == "gzip":
+        with gzip.GzipFile(fileobj = f_in, mode = 'rb') as f_gzip:
+            if digest is not None:
+                _copy_digest(f_gzip, f_out, digest)
+            else:
+                shutil.copyfileobj(f_gzip, f_out, READ_CHUNKSIZE)
+    elif codec == "zstd":
+        check_codec(codec)
+        decompressor = zstandard.ZstdDecompressor()
+        if digest is not None:
+            with decompressor.stream_reader(f_in, read_size = READ_CHUNKSIZE, closefd = False) as f_zstd:
+                _copy_digest(f_zstd, f_out, digest)
+        else:
+            decompressor.copy_stream(f_in, f_out, read_size = READ_CHUNKSIZE, write_size = READ_CHUNKSIZE)
+    else:
+        raise ValueError(f'Give valid compression codec, not {codec}.')
+
+
+def decompress_file(infile, outfile = None, digest = None):
+    """ Decompress file, codec is chosen by filename extension.
+
+    Keyword arguments:
+    infile -- compressed file
+    outfile -- decompressed output file, infile without extension if not given
+    digest -- hash object updated with the decompressed data (optional)
+    """
+    codec = codec_from_filename(infile)
+    if outfile is None:
+        outfile = decompressed_filename(infile)
+
+    logger.debug(f'Decompressing file {infile} with {codec}')
+    with open(infile, 'rb') as f_in:
+        with open(outfile, 'wb') as f_out:
+            decompress_stream(f_in, f_out, codec, digest)
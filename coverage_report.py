@@ -0,0 +1,310 @@
+import argparse
+import csv
+import json
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import bucket_inventory
+import s3_listing
+import download_tropomi
+import search_for_dates_in_bucket
+import metrics
+from batch_tropomi import find_variable_configs, DATE_FORMATS
+
+PRODUCTS = ["l2", "l3_day", "l3_month", "l3_year"]
+
+# TROPOMI makes a bit over 14 orbits per day, L2 days with fewer orbits
+# are reported as partial
+MIN_ORBITS = 14
+
+SCAN_WORKERS = 8
+
+logger = logging.getLogger("logger")
+
+
+def product_dates(start_date, end_date, product):
+    """ Get dates of product between first and last day.
+
+    Keyword arguments:
+    start_date -- First day as string YYYYMMDD
+    end_date -- Last day as string YYYYMMDD
+    product -- Options: l2 | l3_day | l3_month | l3_year
+
+    Return:
+    list of dates from first to last in the date format of product
+    """
+    start_date = datetime.datetime.strptime(start_date, DATE_FORMATS["l2"]).date()
+    end_date = datetime.datetime.strptime(end_date, DATE_FORMATS["l2"]).date()
+
+    # Months and years are counted from their first days
+    if product == "l3_month":
+        start_date, end_date = start_date.replace(day = 1), end_date.replace(day = 1)
+    elif product == "l3_year":
+        start_date, end_date = start_date.replace(month = 1, day = 1), end_date.replace(month = 1, day = 1)
+
+    return list(search_for_dates_in_bucket.daterange(start_date, end_date, product = product))
+
+
+def scan_prefix(templates, dates):
+    """ Get common beginning of object names of all templates between first
+    and last date, which limits the listing of bucket.
+    """
+    return s3_listing.patterns_prefix([obj_name_start.format(date = single_date)
+                                       for obj_name_start in templates.values()
+                                       for single_date in dates[:1] + dates[-1:]])
+
+
+def scan_bucket(s3, bucket_name, templates, product, dates, inventory = None, keys = None):
+    """ List S3 bucket once and count objects and orbits of each filename
+    template by date.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    templates -- dictionary of filename templates containing placeholder
+    for {date} by variable name
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    dates -- list of dates from first to last
+    inventory -- bucket inventory to scan instead of S3 listing (optional)
+    keys -- object descriptions already listed, scanned instead of listing
+    bucket (optional)
+
+    Return:
+    counts -- dictionary of dictionaries by variable name and date with
+    keys objects, empty (number of zero size objects) and orbits (set)
+    """
+    date_digits = search_for_dates_in_bucket.DATE_DIGITS[product]
+    matcher = s3_listing.compile_patterns({var: search_for_dates_in_bucket.template_to_regex(obj_name_start, date_digits)
+                                           for var, obj_name_start in templates.items()})
+    prefix = scan_prefix(templates, dates)
+    if keys is None:
+        keys = bucket_inventory.list_bucket(s3, bucket_name, prefix, inventory)
+
+    counts = {var: {} for var in templates}
+    logger.debug(f'Scanning {product} of {len(templates)} variables with prefix {prefix} in bucket {bucket_name}')
+    for key in keys:
+        for date_regex, names in s3_listing.candidate_patterns(matcher, key['Key']):
+            match = date_regex.search(key['Key'])
+            if not match:
+                continue
+            orbit = bucket_inventory.parse_tropomi_filename(key['Key'])["orbit"]
+            for var in names:
+                count = counts[var].setdefault(match.group('date'), {"objects": 0, "empty": 0, "orbits": set()})
+                count["objects"] += 1
+                count["empty"] += key['Size'] == 0
+                if orbit is not None:
+                    count["orbits"].add(orbit)
+
+    return counts
+
+
+def date_status(count, product, min_orbits = MIN_ORBITS):
+    """ Get coverage status of one date.
+
+    Keyword arguments:
+    count -- object counts of date from scan_bucket, None if not found
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    min_orbits -- number of L2 orbits needed for full day
+
+    Return:
+    status -- Options: present | partial | missing
+    """
+    if not count:
+        return "missing"
+    if count["empty"] or (product == "l2" and len(count["orbits"]) < min_orbits):
+        return "partial"
+    return "present"
+
+
+def coverage_matrix(s3, variable_configs, products, start_date, end_date, workers = SCAN_WORKERS,
+                    inventory = None, min_orbits = MIN_ORBITS):
+    """ Build coverage matrix of variables, products and dates. Buckets are
+    scanned concurrently and each bucket is listed once per product for all
+    variables using it.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of search configurations by variable name
+    products -- list of products to scan
+    start_date -- First day as string YYYYMMDD
+    end_date -- Last day as string YYYYMMDD
+    workers -- number of buckets scanned in parallel
+    inventory -- bucket inventory to scan instead of S3 listing (optional)
+    min_orbits -- number of L2 orbits needed for full day
+
+    Return:
+    coverage -- dictionary by product with list of dates and status and
+    L2 orbit counts of each variable in the order of dates
+    """
+    coverage = {}
+    scans = {}
+    for product in products:
+        dates = product_dates(start_date, end_date, product)
+        coverage[product] = {"dates": dates, "variables": {}}
+        for var, variable_config in variable_configs.items():
+            if product not in variable_config:
+                continue
+            bucket_name = variable_config[product]["bucket_name"]
+            scans.setdefault((bucket_name, product), {})[var] = variable_config[product]["obj_name_start"]
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {}
+        for (bucket_name, product), templates in scans.items():
+            dates = coverage[product]["dates"]
+            keys = None
+            if inventory is not None:
+                # SQLite connection of inventory can only be used in the
+                # thread which opened it, so it is read before scanning
+                keys = list(bucket_inventory.list_bucket(s3, bucket_name, scan_prefix(templates, dates), inventory))
+            futures[pool.submit(scan_bucket, s3, bucket_name, templates, product, dates,
+                                keys = keys)] = (bucket_name, product)
+        for future in as_completed(futures):
+            bucket_name, product = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                logger.error(f'Error while scanning {product} in bucket {bucket_name}')
+                logger.error(e)
+                continue
+
+            dates = coverage[product]["dates"]
+            for var, var_counts in counts.items():
+                statuses = [date_status(var_counts.get(single_date), product, min_orbits) for single_date in dates]
+                coverage[product]["variables"][var] = {
+                    "bucket": bucket_name,
+                    "status": statuses,
+                    "present": statuses.count("present"),
+                    "partial": statuses.count("partial"),
+                    "missing": statuses.count("missing")}
+                if product == "l2":
+                    coverage[product]["variables"][var]["orbits"] = [
+                        len(var_counts[single_date]["orbits"]) if single_date in var_counts else 0
+                        for single_date in dates]
+
+    return coverage
+
+
+def write_csv(coverage, output_file):
+    """ Write coverage matrix as CSV with one row per variable, product
+    and date.
+
+    Keyword arguments:
+    coverage -- coverage matrix from coverage_matrix
+    output_file -- CSV outfile
+    """
+    with open(output_file, 'w', newline = '') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["variable", "product", "bucket", "date", "status", "orbits"])
+        for product, product_coverage in coverage.items():
+            for var, var_coverage in sorted(product_coverage["variables"].items()):
+                orbits = var_coverage.get("orbits", [""] * len(product_coverage["dates"]))
+                for single_date, status, n_orbits in zip(product_coverage["dates"], var_coverage["status"], orbits):
+                    writer.writerow([var, product, var_coverage["bucket"], single_date, status, n_orbits])
+
+
+def main():
+
+    start_time = time.perf_counter()
+
+    # Create S3 client
+    s3 = download_tropomi.create_s3_client("conf/tropomi_s3_ro.json",
+                                           max_pool_connections = max(10, options.workers * s3_listing.LISTING_WORKERS))
+
+    variable_configs = find_variable_configs("search", options.vars.split(','))
+
+    inventory = None
+    if options.inventory:
+        inventory = bucket_inventory.open_inventory(options.inventory)
+
+    coverage = coverage_matrix(s3, variable_configs, options.products.split(','), options.start_date,
+                               options.end_date, workers = options.workers, inventory = inventory,
+                               min_orbits = options.min_orbits)
+
+    # Write matrix in file
+    if options.output_file.endswith(".json"):
+        with open(options.output_file, 'w') as jsonfile:
+            json.dump({"start_date": options.start_date, "end_date": options.end_date, "products": coverage},
+                      jsonfile, indent = 1)
+    else:
+        write_csv(coverage, options.output_file)
+
+    for product, product_coverage in coverage.items():
+        for var, var_coverage in sorted(product_coverage["variables"].items()):
+            logger.info(f'{var} {product}: {var_coverage["present"]} present, {var_coverage["partial"]} partial, '
+                        f'{var_coverage["missing"]} missing')
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'Wrote coverage of {len(variable_configs)} variables to {options.output_file} in {elapsed:.1f} s')
+
+
+if __name__ == '__main__':
+    #Parse commandline arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vars',
+                        type = str,
+                        default = '*',
+                        help = 'Comma separated list of Tropomi variables or globs of search configurations.')
+    parser.add_argument('--products',
+                        type = str,
+                        default = ','.join(PRODUCTS),
+                        help = 'Comma separated list of products. Options: l2,l3_day,l3_month,l3_year')
+    parser.add_argument('--start_date',
+                        type = str,
+                        default = '20221101',
+                        help = 'First day of coverage (YYYYMMDD).')
+    parser.add_argument('--end_date',
+                        type = str,
+                        default = '20221130',
+                        help = 'Last day of coverage (YYYYMMDD).')
+    parser.add_argument('--output_file',
+                        type = str,
+                        default = 'coverage.csv',
+                        help = 'Outfile for coverage matrix, .json for JSON, otherwise CSV.')
+    parser.add_argument('--min_orbits',
+                        type = int,
+                        default = MIN_ORBITS,
+                        help = 'Number of L2 orbits per day below which the day is partial.')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = SCAN_WORKERS,
+                        help = 'Number of buckets scanned in parallel.')
+    parser.add_argument('--inventory',
+                        type = str,
+                        default = None,
+                        help = 'Local SQLite bucket inventory file to scan instead of listing S3 buckets.')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
+    parser.add_argument('--loglevel',
+                        default='info',
+                        help='minimum severity of logged messages,\
+                        options: debug, info, warning, error, critical, default=info')
+
+    options = parser.parse_args()
+
+    # Setup logger
+    loglevel_dict={'debug':logging.DEBUG,
+                   'info':logging.INFO,
+                   'warning':logging.WARNING,
+                   'error':logging.ERROR,
+                   'critical':logging.CRITICAL}
+    logger = logging.getLogger("logger")
+    logger.setLevel(loglevel_dict[options.loglevel])
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s | (%(filename)s:%(lineno)d)','%Y-%m-%d %H:%M:%S')
+    logging.Formatter.converter = time.gmtime # use utc
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    metrics.run(main, "coverage_report", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
@@ -1,20 +1,41 @@
 import argparse
 import json
-import re
 import datetime
 import logging
 import time
-import gzip
-import shutil
 import os
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def create_s3_client(s3_config_file):
+import compression
+import bucket_inventory
+import s3_sync
+import s3_listing
+import resumable
+import scheduler
+import granule_cache
+import region_filter
+import remote_subset
+import metrics
+import integrity
+
+# Objects larger than threshold are downloaded with parallel ranged GETs
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+TRANSFER_CONCURRENCY = 4
+
+logger = logging.getLogger("logger")
+
+
+def create_s3_client(s3_config_file, max_pool_connections = 10):
     """ Create S3 client to be used for downloading files.
                                                                                                   
     Keyword arguments:                                                                                
     s3_config_file -- .json config file containing S3 keys
+    max_pool_connections -- maximum number of connections kept in pool
                                                                                                       
     Return:                                                                                           
     s3 -- S3 client                                                       
@@ -23,23 +44,483 @@ def create_s3_client(s3_config_file):
     # Read S3 config file
     logger.debug(f'Reading S3 config file {s3_config_file}')
     try:
-        with open(s3_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(s3_config_file, "r") as jsonfile:
             s3_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the S3 configuration file {s3_config_file}')
         logger.error(e)
 
     # Create S3 client
-    s3 = boto3.client("s3",
-                      aws_access_key_id = s3_config['aws_access_key_id'],
-                      aws_secret_access_key = s3_config['aws_secret_access_key'],
-                      endpoint_url = s3_config['endpoint_url']
-    )
-    
+    with metrics.timer("client"):
+        s3 = boto3.client("s3",
+                          aws_access_key_id = s3_config['aws_access_key_id'],
+                          aws_secret_access_key = s3_config['aws_secret_access_key'],
+                          endpoint_url = s3_config['endpoint_url'],
+                          config = Config(max_pool_connections = max_pool_connections)
+        )
+    metrics.instrument(s3)
+
     return s3
 
 
-def get_files_containing_pattern(s3, bucket_name, pattern, outpath):
+def list_files_matching_patterns(s3, bucket_name, patterns, inventory = None):
+    """ List S3 objects matching any of given patterns with one listing of
+    the bucket.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    patterns -- dictionary of patterns by name
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    keys -- dictionary of lists of matching S3 object descriptions by
+    pattern name
+    """
+
+    # Listing is limited to objects starting with the common literal
+    # beginning of the patterns.
+    prefix = s3_listing.patterns_prefix(patterns.values())
+    matcher = s3_listing.compile_patterns(patterns)
+
+    # Search for files matching any pattern
+    logger.debug(f'Searching for {len(patterns)} patterns with prefix {prefix} in bucket {bucket_name}')
+    keys = {name: [] for name in patterns}
+    for key in bucket_inventory.list_bucket(s3, bucket_name, prefix, inventory):
+        for name in s3_listing.match_patterns(matcher, key['Key']):
+            keys[name].append(key)
+
+    return keys
+
+
+def list_files_containing_pattern(s3, bucket_name, pattern, inventory = None):
+    """ List S3 objects containing given pattern.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    pattern -- pattern used for searching matching files
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    keys -- list of matching S3 object descriptions from listing
+    """
+    return list_files_matching_patterns(s3, bucket_name, {pattern: pattern}, inventory)[pattern]
+
+
+def decompress_file(local_file):
+    """ Unpack compressed file next to the original file. If the source
+    digest of the downloaded object is known, the unpacked data is
+    compared with it, and both files are quarantined if they differ.
+
+    Keyword arguments:
+    local_file -- compressed local file
+    """
+    logger.debug(f'Unpacking compressed file {local_file}')
+    expected = integrity.expected_for(local_file)
+    digest = integrity.new_digest(expected[0]) if expected else None
+    try:
+        with metrics.timer("decompress", codec = compression.codec_from_filename(local_file)):
+            compression.decompress_file(local_file, digest = digest)
+        if expected:
+            integrity.check(local_file, digest.hexdigest() == expected[1], f"{expected[0]} digest")
+    except integrity.IntegrityError as e:
+        # The compressed file matched the object, so the object itself
+        # differs from its source and downloading again does not help
+        integrity.quarantine(compression.decompressed_filename(local_file))
+        integrity.quarantine(local_file)
+        logger.error(f'Error while unpacking compressed file {local_file}')
+        logger.error(e)
+    except Exception as e:
+        logger.error(f'Error while unpacking compressed file {local_file}')
+        logger.error(e)
+
+
+def download_and_decompress_object(s3, bucket_name, key, outpath):
+    """ Download compressed S3 object and unpack the response stream
+    directly into the final file without writing the compressed file to
+    disk. Codec is chosen by object metadata or extension. With
+    verification, ETag of the compressed stream and source digest of the
+    unpacked data are computed while unpacking, and the file is
+    quarantined if either does not match.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    key -- S3 object description from listing
+    outpath -- local directory where the file is unpacked to
+
+    Return:
+    unzipped_file -- path of unpacked file
+    """
+    logger.debug(f'Downloading and unpacking file {key["Key"]}')
+    unzipped_file = compression.decompressed_filename(f"{outpath}/{key['Key']}")
+    tmp_file = f"{unzipped_file}.tmp"
+
+    # Unpack in chunks into temporary file, which is renamed when complete
+    response = s3.get_object(Bucket=bucket_name, Key=key['Key'])
+    codec = compression.codec_from_filename(key['Key'], response.get('Metadata'))
+    f_in = scheduler.ThrottledReader(response['Body'])
+    etag_digest = source_digest = expected = None
+    if integrity.settings["enabled"]:
+        etag_digest = integrity.ETagDigest(response['ETag'], response['ContentLength'])
+        f_in = integrity.DigestReader(f_in, [etag_digest])
+        expected = integrity.expected_source_digest(response.get('Metadata'))
+        if expected:
+            source_digest = integrity.new_digest(expected[0])
+    try:
+        with open(tmp_file, 'wb') as f_out:
+            compression.decompress_stream(f_in, f_out, codec, source_digest)
+        # Bytes after the end of compressed stream are part of the ETag
+        if etag_digest is not None:
+            while f_in.read(compression.READ_CHUNKSIZE):
+                pass
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        response['Body'].close()
+
+    if etag_digest is not None:
+        try:
+            integrity.check(key['Key'], etag_digest.matches(), "ETag")
+            if expected:
+                integrity.check(key['Key'], source_digest.hexdigest() == expected[1], f"{expected[0]} digest")
+        except integrity.IntegrityError:
+            integrity.quarantine(tmp_file)
+            raise
+    os.replace(tmp_file, unzipped_file)
+    s3_sync.set_mtime(unzipped_file, key['LastModified'])
+
+    return unzipped_file
+
+
+def download_object(s3, bucket_name, key, outpath, transfer_config = None, stream_decompress = False,
+                    resume = False, subset_variables = None):
+    """ Download single S3 object.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    key -- S3 object description from listing
+    outpath -- local directory where the file is downloaded to
+    transfer_config -- boto3 TransferConfig for multipart downloads
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    resume -- if True, continue interrupted download and retry failures
+    subset_variables -- list of variables read from netCDF object with
+    ranged GETs into slim local file, None downloads whole object
+
+    Return:
+    local_file -- path of downloaded file
+    """
+    with scheduler.transfer_slot(), metrics.timer("download", bucket = bucket_name):
+        if subset_variables and not compression.codec_from_filename(key['Key']):
+            return remote_subset.download_subset(s3, bucket_name, key, outpath, subset_variables, resume = resume)
+
+        if stream_decompress and compression.codec_from_filename(key['Key']):
+            if resume:
+                unzipped_file = integrity.retry(resumable.retry, download_and_decompress_object,
+                                                s3, bucket_name, key, outpath)
+            else:
+                unzipped_file = integrity.retry(download_and_decompress_object, s3, bucket_name, key, outpath)
+            metrics.add("downloaded_bytes", key['Size'], bucket = bucket_name)
+            metrics.add("downloaded_objects", bucket = bucket_name)
+            return unzipped_file
+
+        logger.debug(f'Downloading file {key["Key"]}')
+        local_file = f"{outpath}/{key['Key']}"
+        hit = False
+        if granule_cache.settings["enabled"]:
+            hit = granule_cache.fetch(s3, bucket_name, key, local_file, transfer_config, resume,
+                                      scheduler.bandwidth_callback())
+        elif resume:
+            metadata = integrity.retry(resumable.download_resumable, s3, bucket_name, key['Key'], local_file)
+            integrity.expect(local_file, metadata)
+        elif integrity.settings["enabled"]:
+            metadata = integrity.retry(integrity.download_verified, s3, bucket_name, key, local_file,
+                                       scheduler.bandwidth_callback())
+            integrity.expect(local_file, metadata)
+        else:
+            s3.download_file(bucket_name, key['Key'], local_file, Config = transfer_config,
+                             Callback = scheduler.bandwidth_callback())
+        s3_sync.set_mtime(local_file, key['LastModified'])
+
+    # Granules served from cache are not transferred
+    if not hit:
+        metrics.add("downloaded_bytes", key['Size'], bucket = bucket_name)
+    metrics.add("downloaded_objects", bucket = bucket_name)
+
+    return local_file
+
+
+def is_unchanged(key, outpath, stream_decompress = False, checksum = False, subset = False):
+    """ Check if S3 object is already downloaded and unchanged. Files
+    unpacked while downloading and subset files are compared by
+    modification time only.
+
+    Keyword arguments:
+    key -- S3 object description from listing
+    outpath -- local directory where the file is downloaded to
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    checksum -- if True, compare file content with ETag
+    subset -- if True, local file is subset of S3 object
+
+    Return:
+    True/False -- True if local file is up to date
+    """
+    local_file = f"{outpath}/{key['Key']}"
+    if subset and not compression.codec_from_filename(key['Key']):
+        return s3_sync.is_downloaded(local_file, key, compare_size = False)
+    if stream_decompress and compression.codec_from_filename(key['Key']):
+        return s3_sync.is_downloaded(compression.decompressed_filename(local_file), key, compare_size = False)
+
+    return s3_sync.is_downloaded(local_file, key, checksum = checksum)
+
+
+def download_files_concurrently(s3, bucket_name, keys, outpath, workers, stream_decompress = False,
+                                resume = False, subset_variables = None):
+    """ Download S3 objects in parallel and unpack compressed files on
+    separate workers while other downloads continue.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    keys -- list of S3 object descriptions from listing
+    outpath -- local directory where the files are downloaded to
+    workers -- number of parallel downloads
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    resume -- if True, continue interrupted downloads and retry failures
+    subset_variables -- list of variables read from netCDF objects into
+    slim local files, None downloads whole objects
+
+    Return:
+    total_bytes -- number of bytes downloaded
+    """
+    transfer_config = TransferConfig(multipart_threshold = MULTIPART_THRESHOLD,
+                                     multipart_chunksize = MULTIPART_CHUNKSIZE,
+                                     max_concurrency = TRANSFER_CONCURRENCY)
+    total_bytes = 0
+
+    with ThreadPoolExecutor(max_workers = workers) as download_pool, \
+         ThreadPoolExecutor(max_workers = workers) as decompress_pool:
+        futures = {download_pool.submit(download_object, s3, bucket_name, key, outpath,
+                                      transfer_config, stream_decompress, resume, subset_variables): key
+                   for key in keys}
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                local_file = future.result()
+            except Exception as e:
+                logger.error(f'Error while downloading file {key["Key"]}')
+                logger.error(e)
+                continue
+            total_bytes += key['Size']
+
+            # If file is compressed, unpack
+            if compression.codec_from_filename(local_file):
+                decompress_pool.submit(decompress_file, local_file)
+
+    return total_bytes
+
+
+def download_keys(s3, bucket_name, keys, outpath, workers = 1, stream_decompress = False,
+                  sync = False, checksum = False, resume = False, subset_variables = None):
+    """ Download listed S3 objects.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    keys -- list of S3 object descriptions from listing
+    outpath -- local directory where files are downloaded to
+    workers -- number of parallel downloads, 1 downloads files one by one
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    sync -- if True, download only new or changed objects
+    checksum -- if True, compare local files with ETag in sync
+    resume -- if True, continue interrupted downloads and retry failures
+    subset_variables -- list of variables read from netCDF objects into
+    slim local files, None downloads whole objects
+    """
+    start_time = time.perf_counter()
+
+    # Skip objects which are already downloaded and unchanged
+    if sync:
+        skipped_keys = [key for key in keys if is_unchanged(key, outpath, stream_decompress, checksum,
+                                                                bool(subset_variables))]
+        keys = [key for key in keys if key not in skipped_keys]
+        logger.info(f'Skipped {len(skipped_keys)} unchanged files, '
+                    f'{sum(key["Size"] for key in skipped_keys) / 1e6:.1f} MB')
+
+    # Download files
+    if workers > 1:
+        total_bytes = download_files_concurrently(s3, bucket_name, keys, outpath, workers, stream_decompress, resume,
+                                                  subset_variables)
+    else:
+        total_bytes = 0
+        for key in keys:
+            try:
+                local_file = download_object(s3, bucket_name, key, outpath, stream_decompress = stream_decompress,
+                                             resume = resume, subset_variables = subset_variables)
+            except Exception as e:
+                logger.error(f'Error while downloading file {key["Key"]}')
+                logger.error(e)
+                continue
+            total_bytes += key['Size']
+
+            # If file is compressed, unpack
+            if compression.codec_from_filename(local_file):
+                decompress_file(local_file)
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'Downloaded {len(keys)} files, {total_bytes / 1e6:.1f} MB in {elapsed:.1f} s')
+
+
+def confirm_footprints(keys, outpath, bboxes, stream_decompress = False):
+    """ Remove downloaded files whose footprint in file metadata does not
+    intersect any of their bounding boxes.
+
+    Keyword arguments:
+    keys -- list of S3 object descriptions from listing
+    outpath -- local directory where files were downloaded to
+    bboxes -- dictionary of lists of bounding boxes by S3 object name
+    stream_decompress -- if True, compressed objects were unpacked while downloading
+
+    Return:
+    n_removed -- number of removed files
+    """
+    if region_filter.h5py is None:
+        logger.error('Footprint confirmation needs python package h5py, keeping downloaded files')
+        return 0
+
+    n_removed = 0
+    for key in keys:
+        if key['Key'] not in bboxes:
+            continue
+        local_file = f"{outpath}/{key['Key']}"
+        if compression.codec_from_filename(key['Key']):
+            local_file = compression.decompressed_filename(local_file)
+        if not os.path.exists(local_file):
+            continue
+        try:
+            if any(region_filter.footprint_intersects(local_file, bbox) for bbox in bboxes[key['Key']]):
+                continue
+        except Exception as e:
+            logger.error(f'Error while reading footprint of file {local_file}')
+            logger.error(e)
+            continue
+        logger.debug(f'Removing file {local_file} outside of bounding box')
+        os.remove(local_file)
+        n_removed += 1
+
+    logger.info(f'Removed {n_removed} files with footprint outside of bounding box')
+    return n_removed
+
+
+def select_keys(s3, bucket_name, targets, inventory = None):
+    """ List S3 objects matching any of given patterns with one listing of
+    the bucket and collect them by local directory. Objects of targets with
+    bounding box are selected only if their granule can cover the bounding
+    box.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    targets -- list of (pattern, outpath, bbox) tuples, matching files are
+    downloaded to outpath, bbox [lon_min, lat_min, lon_max, lat_max] or None
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    selected -- dictionary by outpath with keys "keys" (list of S3 object
+    descriptions) and "bboxes" (lists of bounding boxes of objects selected
+    only by targets with bounding box by object name)
+    """
+    patterns = {i: pattern for i, (pattern, outpath, bbox) in enumerate(targets)}
+    matching_keys = list_files_matching_patterns(s3, bucket_name, patterns, inventory)
+
+    # Collect matching objects of each local directory. Objects selected
+    # only by targets with bounding box keep their bounding boxes.
+    outpath_keys = {}
+    outpath_bboxes = {}
+    for i, (pattern, outpath, bbox) in enumerate(targets):
+        keys = matching_keys[i]
+        if bbox:
+            keys = region_filter.filter_keys(keys, bbox)
+            logger.info(f'Selected {len(keys)} of {len(matching_keys[i])} files of {pattern} crossing bounding box')
+        bboxes = outpath_bboxes.setdefault(outpath, {})
+        for key in keys:
+            if bbox and (key['Key'] not in outpath_keys.get(outpath, {}) or key['Key'] in bboxes):
+                bboxes.setdefault(key['Key'], []).append(bbox)
+            else:
+                bboxes.pop(key['Key'], None)
+            outpath_keys.setdefault(outpath, {})[key['Key']] = key
+
+    return {outpath: {"keys": list(keys.values()), "bboxes": outpath_bboxes[outpath]}
+            for outpath, keys in outpath_keys.items()}
+
+
+def download_selected(s3, bucket_name, selected, workers = 1, stream_decompress = False,
+                      sync = False, checksum = False, resume = False,
+                      confirm_footprint = False, subset_variables = None):
+    """ Download S3 objects selected by select_keys.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    selected -- selected objects by outpath from select_keys
+    workers -- number of parallel downloads, 1 downloads files one by one
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    sync -- if True, download only new or changed objects
+    checksum -- if True, compare local files with ETag in sync
+    resume -- if True, continue interrupted downloads and retry failures
+    confirm_footprint -- if True, remove downloaded files selected only by
+    bounding boxes if their footprint does not intersect
+    subset_variables -- dictionary of lists of variables read from netCDF
+    objects into slim local files by outpath (optional)
+    """
+    subset_variables = subset_variables or {}
+    for outpath, outpath_selected in selected.items():
+        download_keys(s3, bucket_name, outpath_selected["keys"], outpath,
+                      workers = workers, stream_decompress = stream_decompress,
+                      sync = sync, checksum = checksum, resume = resume,
+                      subset_variables = subset_variables.get(outpath))
+        if confirm_footprint and outpath_selected["bboxes"]:
+            confirm_footprints(outpath_selected["keys"], outpath, outpath_selected["bboxes"], stream_decompress)
+
+
+def download_patterns(s3, bucket_name, targets, workers = 1, stream_decompress = False,
+                      inventory = None, sync = False, checksum = False, resume = False,
+                      confirm_footprint = False, subset_variables = None):
+    """ Download S3 objects matching any of given patterns with one listing
+    of the bucket. Objects matched by several patterns with the same local
+    directory are downloaded once. Objects of targets with bounding box are
+    downloaded only if their granule can cover the bounding box.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    targets -- list of (pattern, outpath, bbox) tuples, matching files are
+    downloaded to outpath, bbox [lon_min, lat_min, lon_max, lat_max] or None
+    workers -- number of parallel downloads, 1 downloads files one by one
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+    sync -- if True, download only new or changed objects
+    checksum -- if True, compare local files with ETag in sync
+    resume -- if True, continue interrupted downloads and retry failures
+    confirm_footprint -- if True, remove downloaded files selected only by
+    bounding boxes if their footprint does not intersect
+    subset_variables -- dictionary of lists of variables read from netCDF
+    objects into slim local files by outpath (optional)
+    """
+    selected = select_keys(s3, bucket_name, targets, inventory)
+    download_selected(s3, bucket_name, selected, workers = workers, stream_decompress = stream_decompress,
+                      sync = sync, checksum = checksum, resume = resume,
+                      confirm_footprint = confirm_footprint, subset_variables = subset_variables)
+
+
+def get_files_containing_pattern(s3, bucket_name, pattern, outpath, workers = 1, stream_decompress = False,
+                                 inventory = None, sync = False, checksum = False, resume = False,
+                                 bbox = None, confirm_footprint = False, subset_variables = None):
     """ Download S3 objects containing given pattern.
                                       
     Keyword arguments:                                                                                
@@ -47,64 +528,110 @@ def get_files_containing_pattern(s3, bucket_name, pattern, outpath):
     bucket_name -- S3 bucket name where to search for files
     pattern -- pattern used for searching matching files
     outpath -- local directory where matching files are downloaded to
+    workers -- number of parallel downloads, 1 downloads files one by one
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+    sync -- if True, download only new or changed objects
+    checksum -- if True, compare local files with ETag in sync
+    resume -- if True, continue interrupted downloads and retry failures
+    bbox -- download only granules which can cover bounding box
+    [lon_min, lat_min, lon_max, lat_max] (optional)
+    confirm_footprint -- if True, remove downloaded files whose footprint
+    does not intersect bounding box
+    subset_variables -- list of variables read from netCDF objects into
+    slim local files, None downloads whole objects
 
     """
+    download_patterns(s3, bucket_name, [(pattern, outpath, bbox)],
+                      workers = workers, stream_decompress = stream_decompress,
+                      inventory = inventory, sync = sync, checksum = checksum, resume = resume,
+                      confirm_footprint = confirm_footprint,
+                      subset_variables = {outpath: subset_variables} if subset_variables else None)
 
-    # Use paginator to be able to list all objects in bucket containing
-    # more than 1000 objects.
-    paginator = s3.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket_name)
 
-    # Download files containing pattern
-    logger.debug(f'Searching for pattern {pattern} in bucket {bucket_name}')
-    for page in pages:
-        try:
-            for key in page['Contents']:
-                if re.search(pattern, key['Key']):
-                    logger.debug(f'Downloading file {key["Key"]}')
-                    local_file = f"{outpath}/{key['Key']}"
-                    s3.download_file(bucket_name, key['Key'], local_file)
-
-                    # If file is gzipped, unzip
-                    if local_file.endswith('.gz'):
-                        unzipped_file = os.path.splitext(local_file)[0]
-                        logger.debug(f'Unpacking gzip file {local_file}')
-                        try:
-                            with gzip.open(local_file, 'rb') as f_in:
-                                with open(unzipped_file, 'wb') as f_out:
-                                    shutil.copyfileobj(f_in, f_out)
-                        except Exception as e:
-                            logger.error(f'Error while unpacking gzip file {local_file}')
-                            logger.error(e)
-                
-        except:
-            logger.debug(f'"Contents" keyword not found on S3 page, passing on to next page.')
-            pass
+def download_variable(s3, variable_config, timeperiod, date, workers = 1, stream_decompress = False,
+                      inventory = None, sync = False, checksum = False, resume = False,
+                      confirm_footprint = False, subset = False):
+    """ Download S3 objects of given date for a variable. Granules are
+    filtered by bounding box of variable config if it has one.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_config -- download configuration of variable
+    timeperiod -- which configuration parameters to use, options day|month|year
+    date -- date to download
+    workers -- number of parallel downloads, 1 downloads files one by one
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+    sync -- if True, download only new or changed objects
+    checksum -- if True, compare local files with ETag in sync
+    resume -- if True, continue interrupted downloads and retry failures
+    confirm_footprint -- if True, remove downloaded files whose footprint
+    does not intersect bounding box
+    subset -- if True, download only subset_variables of variable config
+    """
+    bucket_name = variable_config["s3"][timeperiod]["bucket_name"]
+    time = ""
+    pattern = variable_config["s3"][timeperiod]["obj_name_start"].format(date = date, time = time)
+    bbox = variable_config["s3"][timeperiod].get("bbox")
+    subset_variables = variable_config["s3"][timeperiod].get("subset_variables") if subset else None
+
+    # Search files including date and download
+    outpath = variable_config["local"][timeperiod]["path"]
+    get_files_containing_pattern(s3, bucket_name, pattern, outpath,
+                                 workers = workers, stream_decompress = stream_decompress,
+                                 inventory = inventory, sync = sync, checksum = checksum, resume = resume,
+                                 bbox = bbox, confirm_footprint = confirm_footprint,
+                                 subset_variables = subset_variables)
 
 
 def main():
 
     # Create S3 client
     s3_config_file = "conf/tropomi_s3_ro.json"
-    s3 = create_s3_client(s3_config_file)
+    s3 = create_s3_client(s3_config_file, max_pool_connections = max(10, options.workers * TRANSFER_CONCURRENCY))
 
     # Read variable config
     variable_config_file = f"conf/download/{options.var}.json"
     logger.debug(f'Reading config file {variable_config_file}')
     try:
-        with open(variable_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(variable_config_file, "r") as jsonfile:
             variable_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the configuration file {variable_config_file}')
         logger.error(e)
     
-    bucket_name = variable_config["s3"][options.timeperiod]["bucket_name"]
-    time = ""
-    pattern = variable_config["s3"][options.timeperiod]["obj_name_start"].format(date = options.date, time = time)
-    
-    # Search files including date and download
-    outpath = variable_config["local"][options.timeperiod]["path"]
-    get_files_containing_pattern(s3, bucket_name, pattern, outpath)
+    # Schedule transfers together with other jobs on the host
+    if options.schedule or options.bandwidth:
+        scheduler.configure(options.priority or scheduler.priority_from_name(options.var),
+                            bandwidth = options.bandwidth * 1e6 if options.bandwidth else None)
+
+    # Serve downloads from local granule cache
+    if options.cache_dir:
+        granule_cache.configure(options.cache_dir,
+                                quota = options.cache_quota * 1e9 if options.cache_quota else None,
+                                policy = options.cache_policy,
+                                max_age = options.cache_max_age * 86400 if options.cache_max_age else None,
+                                link = options.cache_link)
+
+    # Verify transfers with checksums computed while transferring
+    if options.verify:
+        integrity.configure(options.digest_algorithm)
+
+    # Use local bucket inventory, refresh it from S3 first if wanted
+    inventory = None
+    if options.inventory:
+        inventory = bucket_inventory.open_inventory(options.inventory)
+        if options.refresh:
+            obj_name_start = variable_config["s3"][options.timeperiod]["obj_name_start"]
+            bucket_inventory.refresh_inventory(inventory, s3, variable_config["s3"][options.timeperiod]["bucket_name"],
+                                               prefix = s3_listing.get_pattern_prefix(obj_name_start.split("{")[0]))
+
+    download_variable(s3, variable_config, options.timeperiod, options.date,
+                      workers = options.workers, stream_decompress = options.stream_decompress,
+                      inventory = inventory, sync = options.sync, checksum = options.checksum,
+                      resume = options.resume, confirm_footprint = options.confirm_footprint,
+                      subset = options.subset)
 
 
 if __name__ == '__main__':                                                      
@@ -122,6 +649,84 @@ if __name__ == '__main__':
                         type = str,
                         default = 'day',
                         help = 'Time period to be downloaded. Options: day|month')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 1,
+                        help = 'Number of parallel downloads. Compressed files are unpacked on separate workers.')
+    parser.add_argument('--stream_decompress',
+                        action = 'store_true',
+                        help = 'Unpack compressed files while downloading without storing the compressed file.')
+    parser.add_argument('--inventory',
+                        type = str,
+                        default = None,
+                        help = 'Local SQLite bucket inventory file to search instead of listing S3 bucket.')
+    parser.add_argument('--refresh',
+                        action = 'store_true',
+                        help = 'Update bucket inventory from S3 before downloading.')
+    parser.add_argument('--sync',
+                        action = 'store_true',
+                        help = 'Download only new or changed files.')
+    parser.add_argument('--checksum',
+                        action = 'store_true',
+                        help = 'Compare file content with S3 ETag in sync instead of modification time.')
+    parser.add_argument('--resume',
+                        action = 'store_true',
+                        help = 'Continue interrupted downloads from .part files and retry failed requests.')
+    parser.add_argument('--verify',
+                        action = 'store_true',
+                        help = 'Verify downloads with ETag and source digest while streaming, quarantine and retry failing files.')
+    parser.add_argument('--digest_algorithm',
+                        type = str,
+                        default = 'sha256',
+                        help = 'Digest of uncompressed content stored in object metadata with verify. Options: md5, sha256, crc32c')
+    parser.add_argument('--confirm_footprint',
+                        action = 'store_true',
+                        help = 'Remove downloaded granules whose footprint does not intersect bounding box of config. Needs h5py.')
+    parser.add_argument('--subset',
+                        action = 'store_true',
+                        help = 'Read only subset_variables of config from netCDF granules with ranged GETs. Needs h5py.')
+    parser.add_argument('--schedule',
+                        action = 'store_true',
+                        help = 'Share transfer slots and bandwidth with other scheduled jobs on the host by priority.')
+    parser.add_argument('--priority',
+                        type = str,
+                        default = None,
+                        help = 'Priority class of transfers. Options: nrti|offl|rpro, default from stream in variable name.')
+    parser.add_argument('--bandwidth',
+                        type = float,
+                        default = None,
+                        help = 'Bandwidth limit of all scheduled transfers on the host in MB/s, implies --schedule.')
+    parser.add_argument('--cache_dir',
+                        type = str,
+                        default = None,
+                        help = 'Local granule cache directory shared by variables, downloaded files are linked from cache.')
+    parser.add_argument('--cache_quota',
+                        type = float,
+                        default = None,
+                        help = 'Maximum size of granule cache in GB.')
+    parser.add_argument('--cache_policy',
+                        type = str,
+                        default = 'lru',
+                        help = 'Which granules to evict first from cache. Options: lru|age')
+    parser.add_argument('--cache_max_age',
+                        type = float,
+                        default = None,
+                        help = 'Evict granules not used (lru) or cached (age) during this many days.')
+    parser.add_argument('--cache_link',
+                        type = str,
+                        default = 'hardlink',
+                        help = 'How cached granules are linked to local directories. Options: hardlink|symlink')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
     parser.add_argument('--loglevel',
                         default='info',
                         help='minimum severity of logged messages,\
@@ -143,4 +748,5 @@ if __name__ == '__main__':
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
     
-    main()
+    metrics.run(main, "download_tropomi", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
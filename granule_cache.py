@@ -0,0 +1,252 @@
+import logging
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import s3_sync
+import resumable
+import metrics
+import integrity
+
+logger = logging.getLogger("logger")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    digest TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    digest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (digest, path)
+);
+CREATE INDEX IF NOT EXISTS granules_last_access ON granules (last_access);
+"""
+
+# Options of eviction order and of materializing cached files
+EVICTION_POLICIES = ("lru", "age")
+LINK_TYPES = ("hardlink", "symlink")
+
+# Cache of this process, set with configure
+settings = {"enabled": False,
+            "cache_dir": None,
+            "quota": None,
+            "policy": "lru",
+            "max_age": None,
+            "link": "hardlink"}
+
+# Concurrent requests of the same granule are fetched once. Locks are kept
+# only while some thread holds or waits for them, as lock and user count
+_granule_locks = {}
+_granule_locks_lock = threading.Lock()
+
+
+def configure(cache_dir, quota = None, policy = "lru", max_age = None, link = "hardlink"):
+    """ Serve downloads of this process from local granule cache. Cached
+    files are shared by all processes using the same cache directory.
+
+    Keyword arguments:
+    cache_dir -- cache directory
+    quota -- maximum size of cached files in bytes, None for no limit
+    policy -- which granules to evict first, Options: lru | age
+    max_age -- evict granules not used for this many seconds (lru) or
+    cached this many seconds ago (age), None for no limit
+    link -- how cached files are materialized, Options: hardlink | symlink
+    """
+    if policy not in EVICTION_POLICIES:
+        raise ValueError(f'Give valid eviction policy, not {policy}.')
+    if link not in LINK_TYPES:
+        raise ValueError(f'Give valid link type, not {link}.')
+
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok = True)
+    with _cache_index(cache_dir) as conn:
+        conn.executescript(SCHEMA)
+    settings.update({"enabled": True, "cache_dir": cache_dir, "quota": quota, "policy": policy,
+                     "max_age": max_age, "link": link})
+    logger.debug(f'Using granule cache {cache_dir} with quota {quota} B and {policy} eviction')
+
+
+@contextmanager
+def _granule_lock(digest):
+    """ Lock granule for this thread, and remove its lock when no other
+    thread uses it.
+    """
+    with _granule_locks_lock:
+        entry = _granule_locks.setdefault(digest, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _granule_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _granule_locks[digest]
+
+
+@contextmanager
+def _cache_index(cache_dir):
+    """ Open connection to cache index, which is committed and closed at
+    exit. Connections are not shared by threads.
+    """
+    conn = sqlite3.connect(os.path.join(cache_dir, "cache.db"), timeout = 60)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def granule_digest(key):
+    """ Get content address of S3 object from its ETag and size.
+
+    Keyword arguments:
+    key -- S3 object description from listing
+
+    Return:
+    digest -- name of cached file
+    """
+    etag = key['ETag'].strip('"')
+    return f"{etag}_{key['Size']}"
+
+
+def cached_path(digest):
+    """ Get path of cached file.
+    """
+    return os.path.join(settings["cache_dir"], "objects", digest[:2], digest)
+
+
+def materialize(cached_file, local_file, link = "hardlink"):
+    """ Create link to cached file atomically. Hardlinks fall back to
+    symlinks across file systems.
+
+    Keyword arguments:
+    cached_file -- file in cache
+    local_file -- path of link
+    link -- Options: hardlink | symlink
+    """
+    tmp_link = f"{local_file}.link.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    if link == "hardlink":
+        try:
+            os.link(cached_file, tmp_link)
+        except OSError as e:
+            logger.debug(f'Hardlink to {cached_file} failed ({e}), using symlink')
+            os.symlink(os.path.abspath(cached_file), tmp_link)
+    else:
+        os.symlink(os.path.abspath(cached_file), tmp_link)
+    os.replace(tmp_link, local_file)
+
+
+def _remove_links(conn, digest, cached_file):
+    """ Remove materialized links of evicted granule, which still point to
+    the cached file.
+    """
+    for (path,) in conn.execute("SELECT path FROM links WHERE digest = ?", (digest,)).fetchall():
+        try:
+            if os.path.islink(path):
+                if os.readlink(path) == os.path.abspath(cached_file):
+                    os.remove(path)
+            elif os.path.exists(path) and os.path.samefile(path, cached_file):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f'Error while removing link {path} of evicted granule ({e})')
+    conn.execute("DELETE FROM links WHERE digest = ?", (digest,))
+
+
+def evict(conn, keep = None):
+    """ Remove expired granules and granules over quota with their links.
+
+    Keyword arguments:
+    conn -- connection to cache index
+    keep -- digest of granule which is not evicted (optional)
+
+    Return:
+    n_evicted -- number of evicted granules
+    """
+    order = "last_access" if settings["policy"] == "lru" else "created"
+    evicted = {}
+    if settings["max_age"]:
+        evicted.update(conn.execute(f"SELECT digest, size FROM granules WHERE {order} < ?",
+                                    (time.time() - settings["max_age"],)).fetchall())
+    if settings["quota"]:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM granules").fetchone()[0]
+        total -= sum(evicted.values())
+        for digest, size in conn.execute(f"SELECT digest, size FROM granules ORDER BY {order}").fetchall():
+            if total <= settings["quota"]:
+                break
+            if digest not in evicted:
+                evicted[digest] = size
+                total -= size
+    evicted.pop(keep, None)
+
+    for digest in evicted:
+        cached_file = cached_path(digest)
+        logger.debug(f'Evicting granule {digest} from cache')
+        _remove_links(conn, digest, cached_file)
+        if os.path.exists(cached_file):
+            os.remove(cached_file)
+        conn.execute("DELETE FROM granules WHERE digest = ?", (digest,))
+    conn.commit()
+
+    return len(evicted)
+
+
+def fetch(s3, bucket_name, key, local_file, transfer_config = None, resume = False, callback = None):
+    """ Get S3 object through cache. Object is downloaded into cache only
+    if not already cached, and linked to local file.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    key -- S3 object description from listing
+    local_file -- path where the object is materialized
+    transfer_config -- boto3 TransferConfig for multipart downloads
+    resume -- if True, continue interrupted download and retry failures
+    callback -- boto3 transfer callback (optional)
+
+    Return:
+    True/False -- True if served from cache without S3 traffic
+    """
+    digest = granule_digest(key)
+    cached_file = cached_path(digest)
+    with _granule_lock(digest):
+        hit = os.path.exists(cached_file) and os.path.getsize(cached_file) == key['Size']
+        if hit:
+            logger.debug(f'Serving {key["Key"]} from cache')
+            try:
+                materialize(cached_file, local_file, settings["link"])
+            except FileNotFoundError:
+                # Evicted by another process in between
+                hit = False
+
+        if not hit:
+            logger.debug(f'Downloading {key["Key"]} into cache')
+            os.makedirs(os.path.dirname(cached_file), exist_ok = True)
+            if resume:
+                metadata = integrity.retry(resumable.download_resumable, s3, bucket_name, key['Key'], cached_file)
+                integrity.expect(local_file, metadata)
+            elif integrity.settings["enabled"]:
+                metadata = integrity.retry(integrity.download_verified, s3, bucket_name, key, cached_file, callback)
+                integrity.expect(local_file, metadata)
+            else:
+                s3.download_file(bucket_name, key['Key'], cached_file, Config = transfer_config, Callback = callback)
+            s3_sync.set_mtime(cached_file, key['LastModified'])
+            materialize(cached_file, local_file, settings["link"])
+
+        metrics.add("cache_hits" if hit else "cache_misses")
+        now = time.time()
+        with _cache_index(settings["cache_dir"]) as conn:
+            conn.execute("INSERT INTO granules VALUES (?, ?, ?, ?, ?) ON CONFLICT(digest) DO UPDATE SET last_access = ?",
+                         (digest, key['Key'], key['Size'], now, now, now))
+            conn.execute("INSERT OR IGNORE INTO links VALUES (?, ?)", (digest, os.path.abspath(local_file)))
+            if not hit:
+                evict(conn, keep = digest)
+
+    return hit
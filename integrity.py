@@ -0,0 +1,365 @@
+import base64
+import hashlib
+import logging
+import math
+import os
+import datetime
+import threading
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+import compression
+import s3_sync
+import metrics
+
+logger = logging.getLogger("logger")
+
+# Digest algorithms of uncompressed content stored in S3 object metadata
+ALGORITHMS = ("md5", "sha256", "crc32c")
+DEFAULT_ALGORITHM = "sha256"
+
+# S3 object metadata key prefix of digest of uncompressed source file,
+# e.g. source-sha256
+METADATA_PREFIX = "source-"
+
+# Checksum of managed uploads, which S3 verifies for each request
+TRANSFER_CHECKSUM = "SHA256"
+
+# Largest object whose metadata can be replaced with a single copy
+MAX_COPY_SIZE = 5 * 1024 ** 3
+
+# Files failing verification are moved to this directory next to them,
+# and the transfer is tried this many times
+QUARANTINE_DIR = "quarantine"
+MAX_ATTEMPTS = 3
+
+READ_CHUNKSIZE = 1024 * 1024
+
+settings = {"enabled": False,
+            "algorithm": DEFAULT_ALGORITHM}
+
+# Expected digests of unpacked content of downloaded compressed files
+_expected = {}
+_expected_lock = threading.Lock()
+
+
+class IntegrityError(IOError):
+    """ Transferred data does not match its checksum.
+    """
+
+
+def configure(algorithm = DEFAULT_ALGORITHM):
+    """ Verify transfers of this process with checksums computed while
+    the data is transferred, compressed or unpacked.
+
+    Keyword arguments:
+    algorithm -- digest of uncompressed content stored in uploaded object
+    metadata, Options: md5 | sha256 | crc32c
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f'Give valid digest algorithm, not {algorithm}.')
+    if algorithm == "crc32c" and crc32c is None:
+        raise ValueError('Digest algorithm crc32c needs python package crc32c.')
+    settings.update({"enabled": True, "algorithm": algorithm})
+    logger.debug(f'Verifying transfers with {algorithm} digests')
+
+
+def metadata_key(algorithm):
+    """ Get S3 object metadata key of source digest.
+    """
+    return f"{METADATA_PREFIX}{algorithm}"
+
+
+class _CRC32C:
+    """ CRC32C with interface of hashlib hash objects.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+def new_digest(algorithm = None):
+    """ Get new hash object.
+
+    Keyword arguments:
+    algorithm -- Options: md5 | sha256 | crc32c, configured algorithm if
+    not given
+
+    Return:
+    digest -- object with update and hexdigest methods
+    """
+    algorithm = algorithm or settings["algorithm"]
+    if algorithm == "crc32c":
+        return _CRC32C()
+    return hashlib.new(algorithm)
+
+
+def content_md5(data):
+    """ Get value of Content-MD5 header of request body.
+    """
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def expected_source_digest(metadata):
+    """ Get digest of uncompressed source from S3 object metadata.
+
+    Keyword arguments:
+    metadata -- S3 object metadata dictionary
+
+    Return:
+    algorithm, digest -- hex digest and its algorithm, None if the object
+    has no source digest
+    """
+    for algorithm in (settings["algorithm"],) + ALGORITHMS:
+        if metadata and metadata_key(algorithm) in metadata:
+            if algorithm == "crc32c" and crc32c is None:
+                continue
+            return algorithm, metadata[metadata_key(algorithm)]
+    return None
+
+
+class ETagDigest:
+    """ Computes S3 ETag of streamed object content. Multipart ETags are
+    MD5 of part MD5s, so part MD5s are computed for each commonly used
+    part size matching the number of parts. Multipart objects of other
+    part sizes can not be verified with ETag.
+    """
+
+    def __init__(self, etag, size):
+        self.etag = etag.strip('"')
+        self.md5 = None
+        self.part_sizes = []
+        if '-' not in self.etag:
+            self.md5 = hashlib.md5()
+            return
+
+        n_parts = int(self.etag.split('-')[1])
+        mib = 1024 * 1024
+        part_sizes = s3_sync.MULTIPART_PART_SIZES + [math.ceil(size / n_parts / mib) * mib]
+        self.part_sizes = sorted({part_size for part_size in part_sizes if math.ceil(size / part_size) == n_parts})
+        self.parts = {part_size: [] for part_size in self.part_sizes}
+        self.current = {part_size: hashlib.md5() for part_size in self.part_sizes}
+        self.filled = {part_size: 0 for part_size in self.part_sizes}
+
+    def update(self, data):
+        if self.md5 is not None:
+            self.md5.update(data)
+        for part_size in self.part_sizes:
+            view = memoryview(data)
+            while view:
+                n = min(len(view), part_size - self.filled[part_size])
+                self.current[part_size].update(view[:n])
+                self.filled[part_size] += n
+                view = view[n:]
+                if self.filled[part_size] == part_size:
+                    self.parts[part_size].append(self.current[part_size].digest())
+                    self.current[part_size] = hashlib.md5()
+                    self.filled[part_size] = 0
+
+    def matches(self):
+        """ Check if streamed content matches ETag.
+
+        Return:
+        True/False -- False if content differs, None if ETag can not be
+        computed (e.g. unknown part size or encrypted object)
+        """
+        if self.md5 is not None:
+            if len(self.etag) != 32:
+                return None
+            return self.md5.hexdigest() == self.etag
+        digest = self.etag.split('-')[0]
+        for part_size in self.part_sizes:
+            parts = self.parts[part_size] + ([self.current[part_size].digest()] if self.filled[part_size] else [])
+            if hashlib.md5(b"".join(parts)).hexdigest() == digest:
+                return True
+
+        # Differing content can not be told apart from unknown part size
+        return None
+
+
+class DigestReader:
+    """ File object wrapper, which updates hash objects with bytes read
+    from it.
+    """
+
+    def __init__(self, f_in, digests):
+        self.f_in = f_in
+        self.digests = digests
+
+    def read(self, size = -1):
+        data = self.f_in.read(size)
+        for digest in self.digests:
+            digest.update(data)
+        return data
+
+    def close(self):
+        self.f_in.close()
+
+
+def check(name, matches, description):
+    """ Raise IntegrityError if checksum does not match.
+
+    Keyword arguments:
+    name -- file or object name
+    matches -- True/False result of comparison, None if not comparable
+    description -- what was compared, e.g. ETag
+    """
+    if matches is None:
+        metrics.add("unverified_checks")
+        logger.debug(f'{description} of {name} can not be verified')
+        return
+    if not matches:
+        metrics.add("integrity_failures")
+        raise IntegrityError(f'{description} of {name} does not match')
+    metrics.add("verified_checks")
+
+
+def quarantine(filename):
+    """ Move file failing verification into quarantine directory next to
+    it, so it is not used but can be inspected.
+
+    Keyword arguments:
+    filename -- file to move
+
+    Return:
+    quarantined_file -- new path of file, None if file does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+    quarantine_dir = os.path.join(os.path.dirname(filename), QUARANTINE_DIR)
+    os.makedirs(quarantine_dir, exist_ok = True)
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    quarantined_file = os.path.join(quarantine_dir, f"{os.path.basename(filename)}.{timestamp}")
+    os.replace(filename, quarantined_file)
+    metrics.add("quarantined_files")
+    logger.warning(f'Moved file {filename} failing verification to {quarantined_file}')
+    return quarantined_file
+
+
+def retry(function, *args, attempts = MAX_ATTEMPTS, **kwargs):
+    """ Call transfer function and call it again if the transferred data
+    fails verification.
+
+    Keyword arguments:
+    function -- function to call
+    args, kwargs -- arguments of function
+    attempts -- maximum number of calls
+
+    Return:
+    return value of function
+    """
+    for attempt in range(attempts):
+        try:
+            return function(*args, **kwargs)
+        except IntegrityError as e:
+            if attempt == attempts - 1:
+                raise
+            logger.warning(f'{e}, transferring again')
+
+
+def expect(local_file, metadata):
+    """ Remember source digest of downloaded compressed file, which is
+    verified when the file is unpacked.
+
+    Keyword arguments:
+    local_file -- downloaded compressed file
+    metadata -- S3 object metadata dictionary
+    """
+    if not settings["enabled"]:
+        return
+    expected = expected_source_digest(metadata)
+    if expected is not None:
+        with _expected_lock:
+            _expected[local_file] = expected
+
+
+def expected_for(local_file):
+    """ Get and forget source digest of downloaded compressed file.
+
+    Return:
+    algorithm, digest -- None if not known
+    """
+    with _expected_lock:
+        return _expected.pop(local_file, None)
+
+
+def download_verified(s3, bucket_name, key, local_file, callback = None):
+    """ Download S3 object with one GET into temporary file, computing its
+    ETag while streaming. Uncompressed objects with source digest in
+    metadata are also compared with the digest. The file is renamed when
+    verified, and quarantined otherwise.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    key -- S3 object description from listing
+    local_file -- final local file
+    callback -- boto3 transfer callback, e.g. for throttling (optional)
+
+    Return:
+    metadata -- S3 object metadata dictionary
+    """
+    tmp_file = f"{local_file}.tmp"
+    response = s3.get_object(Bucket=bucket_name, Key=key['Key'])
+    metadata = response.get('Metadata', {})
+    etag_digest = ETagDigest(response['ETag'], response['ContentLength'])
+    digests = [etag_digest]
+    expected = None
+    if not compression.codec_from_filename(key['Key'], metadata):
+        expected = expected_source_digest(metadata)
+        if expected is not None:
+            source_digest = new_digest(expected[0])
+            digests.append(source_digest)
+
+    try:
+        with open(tmp_file, 'wb') as f_out:
+            for chunk in response['Body'].iter_chunks(READ_CHUNKSIZE):
+                for digest in digests:
+                    digest.update(chunk)
+                f_out.write(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        response['Body'].close()
+
+    try:
+        check(key['Key'], etag_digest.matches(), "ETag")
+        if expected is not None:
+            check(key['Key'], source_digest.hexdigest() == expected[1], f"{expected[0]} digest")
+    except IntegrityError:
+        quarantine(tmp_file)
+        raise
+    os.replace(tmp_file, local_file)
+
+    return metadata
+
+
+def store_source_digest(s3, bucketname, objectname, metadata, size):
+    """ Add source digest to metadata of uploaded object by copying the
+    object onto itself, which is done by S3 without transferring data.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucketname -- S3 bucket name
+    objectname -- S3 object name
+    metadata -- complete S3 object metadata dictionary including digest
+    size -- size of S3 object
+    """
+    if size > MAX_COPY_SIZE:
+        logger.warning(f'Object {objectname} is too large for storing source digest in metadata')
+        return
+    s3.copy_object(Bucket=bucketname, Key=objectname, CopySource={'Bucket': bucketname, 'Key': objectname},
+                   Metadata=metadata, MetadataDirective='REPLACE')
@@ -0,0 +1,248 @@
+import io
+import os
+import json
+import time
+import datetime
+import logging
+import threading
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+logger = logging.getLogger("logger")
+
+# Prefix of metric names in Prometheus textfiles
+PROMETHEUS_PREFIX = "tropomi"
+
+# Number of hot functions logged with profiling
+PROFILE_LINES = 25
+
+# Metrics of this process: timers hold [count, total seconds, max seconds]
+# and counters a value, both by (name, labels)
+_timers = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def _labels(labels):
+    """ Hashable labels, labels with value None are left out.
+    """
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def observe(phase, seconds, **labels):
+    """ Record duration of one phase.
+
+    Keyword arguments:
+    phase -- phase name, e.g. list_page, get, compress
+    seconds -- duration in seconds
+    labels -- labels of phase, e.g. bucket
+    """
+    key = (phase, _labels(labels))
+    with _lock:
+        timer = _timers.setdefault(key, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+@contextmanager
+def timer(phase, **labels):
+    """ Context manager recording duration of phase, also when the phase
+    fails.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start_time, **labels)
+
+
+def add(name, value = 1, **labels):
+    """ Add value to counter.
+
+    Keyword arguments:
+    name -- counter name, e.g. bytes, objects, retries
+    value -- value to add
+    labels -- labels of counter, e.g. bucket
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def instrument(s3):
+    """ Time and count requests of boto3 S3 client by operation and bucket,
+    and count retries made by botocore. Durations are measured until the
+    response headers, streamed bodies are timed by the callers.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    """
+    def before_parameter_build(params, model, context, **kwargs):
+        context["metrics_bucket"] = params.get("Bucket")
+
+    def before_call(model, params, context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        labels = {"operation": model.name, "bucket": context.get("metrics_bucket")}
+        if "metrics_start" in context:
+            observe("request", time.perf_counter() - context["metrics_start"], **labels)
+        add("requests", **labels)
+        if http_response.status_code >= 400:
+            add("request_errors", **labels)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            add("retries", retries, **labels)
+
+    s3.meta.events.register('before-parameter-build.s3', before_parameter_build)
+    s3.meta.events.register('before-call.s3', before_call)
+    s3.meta.events.register('after-call.s3', after_call)
+
+
+def snapshot():
+    """ Get copy of metrics.
+
+    Return:
+    timers, counters -- dictionaries of [count, total, max] and values by
+    (name, labels)
+    """
+    with _lock:
+        return ({key: list(value) for key, value in _timers.items()}, dict(_counters))
+
+
+def reset():
+    """ Remove all recorded metrics.
+    """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def write_json_lines(metrics_file, script):
+    """ Append metrics of run as JSON lines, one line per metric.
+
+    Keyword arguments:
+    metrics_file -- JSON lines outfile
+    script -- name of script, added to each line
+    """
+    timers, counters = snapshot()
+    run_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with open(metrics_file, 'a') as outfile:
+        for (phase, labels), (count, total, maximum) in sorted(timers.items()):
+            outfile.write(json.dumps({"time": run_time, "script": script, "type": "timer", "name": phase,
+                                      "labels": dict(labels), "count": count, "seconds": round(total, 6),
+                                      "max_seconds": round(maximum, 6)}) + "\n")
+        for (name, labels), value in sorted(counters.items()):
+            outfile.write(json.dumps({"time": run_time, "script": script, "type": "counter", "name": name,
+                                      "labels": dict(labels), "value": value}) + "\n")
+
+
+def _prometheus_labels(labels, script):
+    """ Format labels of Prometheus sample.
+    """
+    labels = (("script", script),) + labels
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def write_prometheus(metrics_file, script):
+    """ Write metrics of run as Prometheus textfile, which is replaced
+    atomically for the node exporter textfile collector.
+
+    Keyword arguments:
+    metrics_file -- outfile ending with .prom
+    script -- name of script, added as label
+    """
+    timers, counters = snapshot()
+    lines = []
+    for suffix, help_text, index in (("seconds_total", "Total duration of phase", 1),
+                                     ("count", "Number of times phase was run", 0),
+                                     ("max_seconds", "Longest duration of phase", 2)):
+        name = f"{PROMETHEUS_PREFIX}_phase_{suffix}"
+        lines += [f"# HELP {name} {help_text}.", f"# TYPE {name} gauge"]
+        for (phase, labels), values in sorted(timers.items()):
+            lines.append(f"{name}{_prometheus_labels((('phase', phase),) + labels, script)} {values[index]}")
+    for counter_name in sorted({name for name, labels in counters}):
+        name = f"{PROMETHEUS_PREFIX}_{counter_name}_total"
+        lines += [f"# TYPE {name} counter"]
+        for (other_name, labels), value in sorted(counters.items()):
+            if other_name == counter_name:
+                lines.append(f"{name}{_prometheus_labels(labels, script)} {value}")
+    name = f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds"
+    lines += [f"# TYPE {name} gauge", f'{name}{{script="{script}"}} {time.time():.0f}']
+
+    tmp_file = f"{metrics_file}.tmp"
+    with open(tmp_file, 'w') as outfile:
+        outfile.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, metrics_file)
+
+
+def write_metrics(metrics_file, script, metrics_format = None):
+    """ Write metrics of run in file.
+
+    Keyword arguments:
+    metrics_file -- outfile
+    script -- name of script
+    metrics_format -- Options: json | prometheus, by default prometheus
+    for files ending with .prom and JSON lines otherwise
+    """
+    if metrics_format is None:
+        metrics_format = "prometheus" if metrics_file.endswith(".prom") else "json"
+    logger.debug(f'Writing metrics in {metrics_format} format to {metrics_file}')
+    if metrics_format == "prometheus":
+        write_prometheus(metrics_file, script)
+    elif metrics_format == "json":
+        write_json_lines(metrics_file, script)
+    else:
+        raise ValueError(f'Give valid metrics format, not {metrics_format}.')
+
+
+def _write_periodically(metrics_file, script, metrics_format, interval, stopped):
+    """ Write metrics every interval seconds until stopped is set.
+    """
+    while not stopped.wait(interval):
+        try:
+            write_metrics(metrics_file, script, metrics_format)
+        except Exception as e:
+            logger.error(f'Error while writing metrics file {metrics_file}')
+            logger.error(e)
+
+
+def run(function, script, metrics_file = None, metrics_format = None, profile = False, interval = None):
+    """ Run main function of script, time it and write metrics at the end,
+    also if the run fails.
+
+    Keyword arguments:
+    function -- function without arguments
+    script -- name of script
+    metrics_file -- outfile for metrics (optional)
+    metrics_format -- Options: json | prometheus, by default by filename
+    profile -- if True, run function with cProfile and log hot functions.
+    Only the main thread is profiled.
+    interval -- seconds between writes of metrics during the run, for long
+    running scripts (optional)
+    """
+    profiler = cProfile.Profile() if profile else None
+    stopped = threading.Event()
+    if metrics_file and interval:
+        threading.Thread(target = _write_periodically, args = (metrics_file, script, metrics_format, interval, stopped),
+                         daemon = True).start()
+    try:
+        with timer("run"):
+            if profiler is not None:
+                profiler.runcall(function)
+            else:
+                function()
+    finally:
+        stopped.set()
+        if metrics_file:
+            try:
+                write_metrics(metrics_file, script, metrics_format)
+            except Exception as e:
+                logger.error(f'Error while writing metrics file {metrics_file}')
+                logger.error(e)
+        if profiler is not None:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream = stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            logger.info(f'Hot functions of {script}:\n{stream.getvalue()}')
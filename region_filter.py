@@ -0,0 +1,159 @@
+import logging
+import math
+import datetime
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+import bucket_inventory
+
+logger = logging.getLogger("logger")
+
+# Sentinel-5P is on a sun-synchronous orbit with ascending node at 13:30
+# local solar time, repeating its ground track every 227 orbits in 16 days
+ASCENDING_NODE_LOCAL_TIME = 13.5
+INCLINATION = 98.74
+ORBIT_PERIOD = 16 * 86400 / 227
+
+# Orbit files start at spacecraft midnight, half an orbit before the
+# ascending node. Granules shorter than a full orbit (NRTI) get the
+# ascending node time from the orbit number and this reference orbit.
+REFERENCE_ORBIT = 26240
+REFERENCE_ORBIT_START = datetime.datetime(2022, 11, 2, 0, 15, tzinfo = datetime.timezone.utc)
+FULL_ORBIT_FRACTION = 0.9
+
+# TROPOMI swath is 2600 km wide
+HALF_SWATH_KM = 1300
+KM_PER_DEGREE = 111.32
+
+# Uncertainty of ascending node time, which widens the accepted region
+MARGIN_MINUTES = 10
+
+# Footprint polygon in S5P L2 metadata, "lat lon lat lon ..."
+FOOTPRINT_GROUP = "METADATA/EOP_METADATA/om:featureOfInterest/eop:multiExtentOf/gml:surfaceMembers/gml:exterior"
+FOOTPRINT_ATTRIBUTE = "gml:posList"
+
+
+def _ascending_node_time(start, end, orbit):
+    """ Estimate ascending node time of granule's orbit.
+    """
+    if (end - start).total_seconds() >= FULL_ORBIT_FRACTION * ORBIT_PERIOD:
+        return start + datetime.timedelta(seconds = ORBIT_PERIOD / 2)
+    if orbit is None:
+        return None
+    return REFERENCE_ORBIT_START + datetime.timedelta(seconds = (orbit - REFERENCE_ORBIT + 0.5) * ORBIT_PERIOD)
+
+
+def _overlaps_longitudes(lon_min, lon_max, west, east):
+    """ Check if longitude ranges overlap, ranges may cross antimeridian.
+    """
+    for shift in (-360, 0, 360):
+        if west + shift <= lon_max and east + shift >= lon_min:
+            return True
+    return False
+
+
+def granule_can_cross(key, bbox, n_latitudes = 5):
+    """ Check if daylight pass of granule can cover any part of bounding box.
+    Position of the satellite is predicted from sensing times and orbit
+    number in the filename with the sun-synchronous overpass timing.
+
+    Keyword arguments:
+    key -- S3 object name
+    bbox -- bounding box [lon_min, lat_min, lon_max, lat_max] in degrees
+    n_latitudes -- number of latitudes of bounding box checked
+
+    Return:
+    True/False -- False only if granule can not cover the bounding box
+    """
+    times = bucket_inventory.sensing_times(key)
+    if times is None:
+        return True
+    start, end = times
+    node_time = _ascending_node_time(start, end, bucket_inventory.parse_tropomi_filename(key)["orbit"])
+    if node_time is None:
+        return True
+
+    lon_min, lat_min, lon_max, lat_max = bbox
+    sin_inclination = math.sin(math.radians(INCLINATION))
+    cos_inclination = math.cos(math.radians(INCLINATION))
+    margin = datetime.timedelta(minutes = MARGIN_MINUTES)
+    margin_degrees = MARGIN_MINUTES / 4
+    for n in range(n_latitudes):
+        latitude = lat_min + (lat_max - lat_min) * n / max(1, n_latitudes - 1)
+
+        # Argument of latitude and local solar time of ascending pass
+        u = math.asin(max(-1, min(1, math.sin(math.radians(latitude)) / sin_inclination)))
+        local_time = ASCENDING_NODE_LOCAL_TIME + math.degrees(math.atan(cos_inclination * math.tan(u))) / 15
+        pass_time = node_time + datetime.timedelta(seconds = ORBIT_PERIOD * math.degrees(u) / 360)
+        if not start - margin <= pass_time <= end + margin:
+            continue
+
+        utc_hours = pass_time.hour + pass_time.minute / 60 + pass_time.second / 3600
+        longitude = (local_time - utc_hours) * 15
+        half_width = HALF_SWATH_KM / (KM_PER_DEGREE * max(0.05, math.cos(math.radians(latitude)))) + margin_degrees
+        if _overlaps_longitudes(lon_min, lon_max, longitude - half_width, longitude + half_width):
+            return True
+
+    return False
+
+
+def filter_keys(keys, bbox):
+    """ Select objects whose granules can cover bounding box.
+
+    Keyword arguments:
+    keys -- list of S3 object descriptions from listing
+    bbox -- bounding box [lon_min, lat_min, lon_max, lat_max] in degrees
+
+    Return:
+    keys -- list of selected S3 object descriptions
+    """
+    selected = [key for key in keys if granule_can_cross(key['Key'], bbox)]
+    logger.debug(f'Selected {len(selected)} of {len(keys)} granules crossing bounding box {bbox}')
+    return selected
+
+
+def _inside_polygon(lon, lat, polygon):
+    """ Ray casting test of point inside polygon of (lat, lon) vertices.
+    """
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (lat1 > lat) != (lat2 > lat) and lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+            inside = not inside
+    return inside
+
+
+def footprint_intersects(local_file, bbox):
+    """ Check granule footprint in S5P L2 metadata against bounding box.
+    Footprint vertices inside the bounding box, or corners or center of
+    the bounding box inside the footprint, count as intersection.
+
+    Keyword arguments:
+    local_file -- downloaded S5P L2 file
+    bbox -- bounding box [lon_min, lat_min, lon_max, lat_max] in degrees
+
+    Return:
+    True/False -- True if footprint intersects, or footprint is not found
+    """
+    if h5py is None:
+        raise ValueError('Footprint confirmation needs python package h5py.')
+
+    with h5py.File(local_file, 'r') as f_in:
+        if FOOTPRINT_GROUP not in f_in or FOOTPRINT_ATTRIBUTE not in f_in[FOOTPRINT_GROUP].attrs:
+            logger.debug(f'Footprint not found in {local_file}')
+            return True
+        pos_list = f_in[FOOTPRINT_GROUP].attrs[FOOTPRINT_ATTRIBUTE]
+
+    if isinstance(pos_list, bytes):
+        pos_list = pos_list.decode()
+    values = [float(value) for value in str(pos_list).split()]
+    polygon = list(zip(values[0::2], values[1::2]))
+
+    lon_min, lat_min, lon_max, lat_max = bbox
+    if any(lat_min <= lat <= lat_max and lon_min <= lon <= lon_max for lat, lon in polygon):
+        return True
+    points = [(lon_min, lat_min), (lon_min, lat_max), (lon_max, lat_min), (lon_max, lat_max),
+              ((lon_min + lon_max) / 2, (lat_min + lat_max) / 2)]
+    return any(_inside_polygon(lon, lat, polygon) for lon, lat in points)
@@ -0,0 +1,271 @@
+import io
+import bisect
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+import s3_sync
+import resumable
+import scheduler
+import metrics
+
+logger = logging.getLogger("logger")
+
+# Reads of HDF5 metadata fetch at least this many bytes at once
+READ_AHEAD = 256 * 1024
+
+# Chunk byte ranges closer than gap are fetched with one ranged GET, and
+# coalesced ranges are kept under this size for parallel GETs
+MAX_GAP = 64 * 1024
+MAX_RANGE = 16 * 1024 * 1024
+RANGE_WORKERS = 4
+
+# Attributes of netCDF4 dimensions, which are recreated in the subset file
+DIMENSION_ATTRIBUTES = ("DIMENSION_LIST", "REFERENCE_LIST", "CLASS", "NAME", "_Netcdf4Dimid", "_Netcdf4Coordinates")
+
+
+class S3RangeFile(io.RawIOBase):
+    """ Read-only file object of S3 object, which is read with ranged GETs.
+    Fetched byte ranges are cached, and small reads fetch READ_AHEAD bytes.
+    """
+
+    def __init__(self, s3, bucket_name, key, read_ahead = READ_AHEAD, resume = False):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.name = key['Key']
+        self.size = key['Size']
+        self.read_ahead = read_ahead
+        self.resume = resume
+        self.position = 0
+        self.segments = {}
+        self.starts = []
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_bytes = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def _get_range(self, start, end):
+        """ Get bytes from start to end (exclusive) with one ranged GET.
+        """
+        def get():
+            response = self.s3.get_object(Bucket = self.bucket_name, Key = self.name, Range = f"bytes={start}-{end - 1}")
+            with response['Body'] as body:
+                return body.read()
+
+        data = resumable.retry(get) if self.resume else get()
+        scheduler.throttle(len(data))
+        with self.lock:
+            self.n_requests += 1
+            self.n_bytes += len(data)
+            if start not in self.segments:
+                bisect.insort(self.starts, start)
+            if len(data) >= len(self.segments.get(start, b"")):
+                self.segments[start] = data
+        return data
+
+    def _find(self, start, end):
+        """ Get cached bytes from start to end, None if not cached.
+        """
+        with self.lock:
+            for segment_start in reversed(self.starts[:bisect.bisect_right(self.starts, start)]):
+                data = self.segments[segment_start]
+                if segment_start + len(data) >= end:
+                    return data[start - segment_start:end - segment_start]
+        return None
+
+    def readinto(self, buffer):
+        n = max(0, min(len(buffer), self.size - self.position))
+        if n == 0:
+            return 0
+        data = self._find(self.position, self.position + n)
+        if data is None:
+            end = min(self.size, self.position + max(n, self.read_ahead))
+            data = self._get_range(self.position, end)[:n]
+        buffer[:n] = data
+        self.position += n
+        return n
+
+    def prefetch(self, ranges, workers = RANGE_WORKERS):
+        """ Fetch byte ranges in parallel into cache.
+
+        Keyword arguments:
+        ranges -- list of (start, end) tuples, end exclusive
+
+        Return:
+        starts -- list of start offsets of fetched segments
+        """
+        ranges = [(start, end) for start, end in ranges if self._find(start, end) is None]
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            list(pool.map(lambda byte_range: self._get_range(*byte_range), ranges))
+        return [start for start, end in ranges]
+
+    def discard(self, starts):
+        """ Remove segments from cache.
+        """
+        with self.lock:
+            for start in starts:
+                if self.segments.pop(start, None) is not None:
+                    self.starts.remove(start)
+
+
+def coalesce_ranges(ranges, max_gap = MAX_GAP, max_range = MAX_RANGE):
+    """ Merge byte ranges which overlap or are closer than gap. Ranges are
+    not merged beyond max_range bytes.
+
+    Keyword arguments:
+    ranges -- list of (start, end) tuples, end exclusive
+    max_gap -- maximum number of unneeded bytes read between ranges
+    max_range -- maximum size of merged range
+
+    Return:
+    ranges -- sorted list of merged (start, end) tuples
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= max_gap and end - merged[-1][0] <= max_range:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def dataset_ranges(dataset):
+    """ Get byte ranges of stored data of HDF5 dataset.
+
+    Keyword arguments:
+    dataset -- h5py dataset
+
+    Return:
+    ranges -- list of (start, end) tuples, end exclusive
+    """
+    dataset_id = dataset.id
+    if dataset.chunks is None:
+        offset = dataset_id.get_offset()
+        if offset is None:
+            return []
+        return [(offset, offset + dataset_id.get_storage_size())]
+
+    ranges = []
+    for i in range(dataset_id.get_num_chunks()):
+        chunk_info = dataset_id.get_chunk_info(i)
+        if chunk_info.byte_offset is not None:
+            ranges.append((chunk_info.byte_offset, chunk_info.byte_offset + chunk_info.size))
+    return ranges
+
+
+def _copy_attributes(source, destination):
+    """ Copy attributes with their HDF5 types, dimension attributes are skipped.
+    """
+    for name in source.attrs:
+        if name in DIMENSION_ATTRIBUTES:
+            continue
+        destination.attrs.create(name, source.attrs[name], dtype = source.attrs.get_id(name).dtype)
+
+
+def _require_groups(f_out, f_in, name):
+    """ Create parent groups of object with their attributes.
+    """
+    group = f_out
+    for part in name.strip("/").split("/")[:-1]:
+        if part not in group:
+            _copy_attributes(f_in[f"{group.name.rstrip('/')}/{part}"], group.create_group(part))
+        group = group[part]
+
+
+def _copy_dataset(range_file, f_in, f_out, name):
+    """ Copy dataset with its dimension scales, reading its chunks with
+    coalesced ranged GETs.
+    """
+    if name in f_out:
+        return f_out[name]
+    source = f_in[name]
+
+    # Dimensions are copied first so they can be attached
+    scales = []
+    for dim in source.dims:
+        scales.append([_copy_dataset(range_file, f_in, f_out, scale.name) for scale in dim.values()
+                       if scale.name != source.name])
+
+    starts = range_file.prefetch(coalesce_ranges(dataset_ranges(source)))
+    _require_groups(f_out, f_in, name)
+    destination = f_out.create_dataset(name, data = source[()], chunks = source.chunks,
+                                       compression = source.compression, compression_opts = source.compression_opts,
+                                       shuffle = source.shuffle, fillvalue = source.fillvalue)
+    range_file.discard(starts)
+    _copy_attributes(source, destination)
+
+    if source.attrs.get("CLASS") == b"DIMENSION_SCALE":
+        scale_name = source.attrs.get("NAME", b"")
+        destination.make_scale(scale_name.decode() if isinstance(scale_name, bytes) else scale_name)
+    for dim, dim_scales in zip(destination.dims, scales):
+        for scale in dim_scales:
+            dim.attach_scale(scale)
+
+    return destination
+
+
+def download_subset(s3, bucket_name, key, outpath, variables, resume = False):
+    """ Download listed variables of HDF5/netCDF4 S3 object into slim local
+    file. Only file metadata and chunks of the variables are read.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    key -- S3 object description from listing
+    outpath -- local directory where the subset file is written
+    variables -- list of variable paths, e.g. PRODUCT/qa_value
+    resume -- if True, retry failed requests
+
+    Return:
+    local_file -- path of subset file
+    """
+    if h5py is None:
+        raise ValueError('Subset download needs python package h5py.')
+
+    local_file = f"{outpath}/{key['Key']}"
+    tmp_file = f"{local_file}.tmp"
+    range_file = S3RangeFile(s3, bucket_name, key, resume = resume)
+    logger.debug(f'Downloading {len(variables)} variables of file {key["Key"]}')
+    try:
+        with h5py.File(range_file, 'r') as f_in, h5py.File(tmp_file, 'w') as f_out:
+            _copy_attributes(f_in, f_out)
+            for name in variables:
+                if name not in f_in:
+                    logger.warning(f'Variable {name} not found in file {key["Key"]}')
+                    continue
+                _copy_dataset(range_file, f_in, f_out, f_in[name].name)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, local_file)
+    s3_sync.set_mtime(local_file, key['LastModified'])
+
+    metrics.add("downloaded_bytes", range_file.n_bytes, bucket = bucket_name)
+    metrics.add("downloaded_objects", bucket = bucket_name)
+    logger.debug(f'Read {range_file.n_bytes / 1e6:.1f} of {key["Size"] / 1e6:.1f} MB of file {key["Key"]} '
+                 f'with {range_file.n_requests} requests')
+
+    return local_file
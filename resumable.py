@@ -0,0 +1,222 @@
+import logging
+import os
+import json
+import time
+import random
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+import scheduler
+import metrics
+import integrity
+
+logger = logging.getLogger("logger")
+
+# Retry settings for jittered exponential backoff
+MAX_RETRIES = 5
+BASE_DELAY = 1
+MAX_DELAY = 60
+
+# Size of chunks written to .part file and of uploaded parts. Parts other
+# than the last one have to be at least 5 MB.
+DOWNLOAD_CHUNKSIZE = 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+
+# Client errors which are worth retrying
+RETRYABLE_ERROR_CODES = ('RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException',
+                         'RequestTimeTooSkewed', 'InternalError', 'ServiceUnavailable')
+
+
+def is_retryable(error):
+    """ Check if error from S3 request is temporary.
+
+    Keyword arguments:
+    error -- exception raised by S3 request
+
+    Return:
+    True/False -- True if request should be retried
+    """
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+    return isinstance(error, (BotoCoreError, ConnectionError, TimeoutError))
+
+
+def retry(function, *args, retries = MAX_RETRIES, **kwargs):
+    """ Call function and retry temporary errors with jittered exponential
+    backoff.
+
+    Keyword arguments:
+    function -- function to call
+    args, kwargs -- arguments of function
+    retries -- maximum number of retries
+
+    Return:
+    return value of function
+    """
+    for attempt in range(retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+            metrics.add("retries", function = function.__name__)
+            logger.warning(f'{function.__name__} failed ({e}), retrying in {delay:.1f} s')
+            time.sleep(delay)
+
+
+def _read_state(state_file):
+    """ Read transfer state file, None if it does not exist or is broken.
+    """
+    try:
+        with open(state_file, "r") as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_state(state_file, state):
+    """ Write transfer state file atomically.
+    """
+    with open(f"{state_file}.tmp", "w") as jsonfile:
+        json.dump(state, jsonfile)
+    os.replace(f"{state_file}.tmp", state_file)
+
+
+def download_resumable(s3, bucket_name, objectname, local_file):
+    """ Download S3 object into .part file with ranged GETs. Download of
+    an interrupted .part file continues from its end if the object has not
+    changed since, and the .part file is renamed when complete. With
+    verification, ETag is computed from the streamed chunks, and only the
+    already written part of an interrupted download is read from disk.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to download from
+    objectname -- S3 object name
+    local_file -- final local file
+
+    Return:
+    metadata -- S3 object metadata dictionary
+    """
+    part_file = f"{local_file}.part"
+    state_file = f"{part_file}.json"
+
+    head = retry(s3.head_object, Bucket=bucket_name, Key=objectname)
+    size = head['ContentLength']
+    etag = head['ETag']
+
+    # Start over if the object has changed since the .part file was written
+    state = _read_state(state_file)
+    if not state or state.get('ETag') != etag or not os.path.exists(part_file):
+        with open(part_file, 'wb'):
+            pass
+        _write_state(state_file, {'Bucket': bucket_name, 'Key': objectname, 'ETag': etag, 'Size': size})
+
+    etag_digest = None
+    if integrity.settings["enabled"]:
+        etag_digest = integrity.ETagDigest(etag, size)
+        with open(part_file, 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(DOWNLOAD_CHUNKSIZE), b""):
+                etag_digest.update(chunk)
+
+    def get_remaining():
+        offset = os.path.getsize(part_file)
+        if offset >= size:
+            return
+        logger.debug(f'Downloading {objectname} from byte {offset}')
+        response = s3.get_object(Bucket=bucket_name, Key=objectname, IfMatch=etag,
+                                 Range=f'bytes={offset}-')
+        with open(part_file, 'ab') as f_out:
+            for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNKSIZE):
+                scheduler.throttle(len(chunk))
+                f_out.write(chunk)
+                if etag_digest is not None:
+                    etag_digest.update(chunk)
+
+    retry(get_remaining)
+    if os.path.getsize(part_file) != size:
+        raise IOError(f'Incomplete download of {objectname}, {os.path.getsize(part_file)} of {size} bytes')
+
+    if etag_digest is not None:
+        try:
+            integrity.check(objectname, etag_digest.matches(), "ETag")
+        except integrity.IntegrityError:
+            integrity.quarantine(part_file)
+            os.remove(state_file)
+            raise
+
+    os.replace(part_file, local_file)
+    os.remove(state_file)
+
+    return head.get('Metadata', {})
+
+
+def upload_resumable(s3, filename, bucketname, objectname, metadata = None):
+    """ Upload file as multipart upload, which continues an interrupted
+    upload of the same file. Upload id and uploaded parts are kept in a
+    manifest file next to the uploaded file.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    filename -- File to upload
+    bucketname -- Bucket to upload to
+    objectname -- S3 object name
+    metadata -- S3 object metadata dictionary (optional)
+    """
+    manifest_file = f"{filename}.upload.json"
+    source = {'Bucket': bucketname, 'Key': objectname,
+              'Size': os.path.getsize(filename), 'Mtime': int(os.path.getmtime(filename))}
+
+    # Continue previous upload if the file has not changed and the upload
+    # still exists, S3 list of parts is used as the truth
+    manifest = _read_state(manifest_file)
+    parts = {}
+    if manifest and all(manifest.get(name) == value for name, value in source.items()):
+        try:
+            # Uploads of more than 1000 parts are listed in several pages
+            def list_uploaded_parts():
+                paginator = s3.get_paginator('list_parts')
+                return {part['PartNumber']: part['ETag']
+                        for page in paginator.paginate(Bucket=bucketname, Key=objectname, UploadId=manifest['UploadId'])
+                        for part in page.get('Parts', [])}
+
+            parts = retry(list_uploaded_parts)
+            logger.debug(f'Continuing upload of {filename} with {len(parts)} uploaded parts')
+        except ClientError as e:
+            logger.debug(f'Previous upload of {filename} not found, starting over ({e})')
+            manifest = None
+    else:
+        manifest = None
+
+    if manifest is None:
+        response = retry(s3.create_multipart_upload, Bucket=bucketname, Key=objectname,
+                         Metadata=metadata or {})
+        manifest = {**source, 'UploadId': response['UploadId'], 'PartSize': PART_SIZE}
+        _write_state(manifest_file, manifest)
+
+    upload_id = manifest['UploadId']
+    part_size = manifest['PartSize']
+    with open(filename, 'rb') as f_in:
+        part_number = 1
+        while True:
+            data = f_in.read(part_size)
+            if not data and part_number > 1:
+                break
+            if part_number not in parts:
+                scheduler.throttle(len(data))
+                checksum = {'ContentMD5': integrity.content_md5(data)} if integrity.settings["enabled"] else {}
+                response = retry(s3.upload_part, Bucket=bucketname, Key=objectname, UploadId=upload_id,
+                                 PartNumber=part_number, Body=data, **checksum)
+                parts[part_number] = response['ETag']
+                _write_state(manifest_file, {**manifest, 'Parts': parts})
+            if not data:
+                break
+            part_number += 1
+
+    retry(s3.complete_multipart_upload, Bucket=bucketname, Key=objectname, UploadId=upload_id,
+          MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag}
+                                     for number, etag in sorted(parts.items())]})
+    os.remove(manifest_file)
@@ -0,0 +1,225 @@
+import logging
+import os
+import re
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger("logger")
+
+# First date of TROPOMI data, shards are made from this date onwards
+FIRST_DATE = datetime.date(2017, 10, 1)
+
+# Date formats of shard boundaries
+SHARD_FORMATS = {"year": "%Y",
+                 "month": "%Y%m",
+                 "day": "%Y%m%d"}
+
+DEFAULT_SHARD_BY = "month"
+LISTING_WORKERS = 8
+
+# Characters which end the literal beginning of a search pattern
+REGEX_SPECIAL_CHARS = ".^$*+?{}[]\\|()"
+
+
+def get_pattern_prefix(pattern):
+    """ Get literal beginning of search pattern to be used as S3 listing prefix.
+
+    Keyword arguments:
+    pattern -- pattern used for searching matching files
+
+    Return:
+    prefix -- beginning of pattern up to the first regex special character
+    """
+    # Alternation can match object names with any beginning
+    if "|" in pattern:
+        return ""
+
+    prefix = ""
+    for char in pattern:
+        if char in REGEX_SPECIAL_CHARS:
+            # Quantifier makes the preceding character optional
+            if char in "?*{":
+                prefix = prefix[:-1]
+            break
+        prefix += char
+
+    return prefix
+
+
+def compile_patterns(patterns):
+    """ Compile search patterns into one matcher. Patterns are stored in a
+    prefix trie by their literal beginnings, so that each object name is
+    tested only against the patterns it can match. Identical patterns are
+    compiled once.
+
+    Keyword arguments:
+    patterns -- dictionary of patterns (strings or compiled regexes) by name
+
+    Return:
+    matcher -- prefix trie of nested dictionaries by character, compiled
+    regexes and their names are stored under key None
+    """
+    matcher = {}
+    regexes = {}
+    for name, pattern in patterns.items():
+        regex = re.compile(pattern)
+        node = matcher
+        for char in get_pattern_prefix(regex.pattern):
+            node = node.setdefault(char, {})
+        if regex.pattern not in regexes:
+            regexes[regex.pattern] = (regex, [])
+            node.setdefault(None, []).append(regexes[regex.pattern])
+        regexes[regex.pattern][1].append(name)
+
+    return matcher
+
+
+def patterns_prefix(patterns):
+    """ Get common literal beginning of patterns to be used as S3 listing
+    prefix for all of them.
+
+    Keyword arguments:
+    patterns -- list of patterns (strings or compiled regexes)
+
+    Return:
+    prefix -- common beginning of patterns
+    """
+    return os.path.commonprefix([get_pattern_prefix(re.compile(pattern).pattern) for pattern in patterns])
+
+
+def candidate_patterns(matcher, name):
+    """ Generator function for patterns whose literal beginning starts the
+    object name.
+
+    Keyword arguments:
+    matcher -- prefix trie from compile_patterns
+    name -- S3 object name
+
+    Yield:
+    (regex, names) -- compiled regex and names of patterns sharing it
+    """
+    node = matcher
+    for char in name:
+        yield from node.get(None, [])
+        node = node.get(char)
+        if node is None:
+            return
+    yield from node.get(None, [])
+
+
+def match_patterns(matcher, name):
+    """ Get names of all patterns found in object name.
+
+    Keyword arguments:
+    matcher -- prefix trie from compile_patterns
+    name -- S3 object name
+
+    Return:
+    names -- list of names of matching patterns
+    """
+    names = []
+    for regex, pattern_names in candidate_patterns(matcher, name):
+        if regex.search(name):
+            names.extend(pattern_names)
+    return names
+
+
+def shard_boundaries(prefix, shard_by = DEFAULT_SHARD_BY, end_date = None):
+    """ Get shard boundaries for prefix ending right before the date (or
+    part of the date) in TROPOMI filenames, e.g. S5P_OFFL_L2__NO2____ or
+    S5P_OFFL_L3_NO2_dailycomposite_2022.
+
+    Keyword arguments:
+    prefix -- listing prefix
+    shard_by -- Options: year | month | day
+    end_date -- last date in shards, today if not given
+
+    Return:
+    boundaries -- sorted list of prefixes of each year, month or day, empty
+    if prefix is not followed by date or the date is already that specific
+    """
+    match = re.search(r"_(\d{0,8})$", prefix)
+    if not match:
+        return []
+    base, digits = prefix[:match.start(1)], match.group(1)
+    date_format = SHARD_FORMATS[shard_by]
+    if len(digits) >= len(FIRST_DATE.strftime(date_format)):
+        return []
+
+    if end_date is None:
+        end_date = datetime.date.today()
+    dates = set()
+    single_date = FIRST_DATE
+    while single_date <= end_date:
+        date = single_date.strftime(date_format)
+        if date.startswith(digits):
+            dates.add(date)
+        single_date += datetime.timedelta(1)
+
+    return [f"{base}{date}" for date in sorted(dates)]
+
+
+def _list_range(s3, bucket_name, prefix, start_after = None, upper = None):
+    """ List keys starting with prefix in range start_after < key <= upper.
+    """
+    paginate_args = {"Bucket": bucket_name, "Prefix": prefix}
+    if start_after:
+        paginate_args["StartAfter"] = start_after
+
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**paginate_args):
+        if 'Contents' not in page:
+            logger.debug(f'"Contents" keyword not found on S3 page, passing on to next page.')
+            continue
+        metrics.add("listed_objects", len(page['Contents']), bucket = bucket_name)
+        for key in page['Contents']:
+            if upper is not None and key['Key'] > upper:
+                return keys
+            keys.append(key)
+
+    return keys
+
+
+def list_objects_sharded(s3, bucket_name, prefix = "", start_after = None, shard_by = DEFAULT_SHARD_BY,
+                         workers = LISTING_WORKERS):
+    """ Generator function for listing S3 objects in disjoint key ranges
+    concurrently. Ranges are split at year, month or day boundaries of
+    TROPOMI filenames and listed in parallel, results are yielded in key
+    order. Prefixes which are not followed by a date are listed as one
+    range.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    prefix -- list only objects starting with prefix
+    start_after -- list only objects after this key
+    shard_by -- Options: year | month | day
+    workers -- number of ranges listed in parallel
+
+    Yield:
+    object descriptions from S3 listing
+    """
+    boundaries = [boundary for boundary in shard_boundaries(prefix, shard_by)
+                  if not start_after or boundary > start_after]
+    if not boundaries:
+        yield from _list_range(s3, bucket_name, prefix, start_after)
+        return
+
+    # Range i contains keys boundaries[i-1] < key <= boundaries[i], first
+    # range starts from start_after and last range has no upper limit
+    lowers = [start_after] + boundaries
+    uppers = boundaries + [None]
+    logger.debug(f'Listing bucket {bucket_name} with prefix {prefix} in {len(lowers)} shards')
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(_list_range, s3, bucket_name, prefix, lower, upper)
+                   for lower, upper in zip(lowers, uppers)]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            # Listing of remaining shards is not needed if caller stops early
+            for future in futures:
+                future.cancel()
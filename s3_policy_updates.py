@@ -1,17 +1,33 @@
 import argparse
 import json
+import datetime
 import logging
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+import s3_listing
+import resumable
+import metrics
+from batch_tropomi import find_variable_configs
 
-def create_s3_resource(s3_config_file):
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+DELETE_WORKERS = 8
+
+logger = logging.getLogger("logger")
+
+
+def create_s3_resource(s3_config_file, max_pool_connections = 10):
     """ Create S3 resource to be used for policy updates
                                         
     Keyword arguments:
     s3_config_file -- .json config file containing S3 keys
+    max_pool_connections -- maximum number of connections kept in pool
                                                                 
     Return:      
     s3 -- S3 resource                                                      
@@ -20,71 +36,264 @@ def create_s3_resource(s3_config_file):
     # Read S3 config file
     logger.debug(f'Reading S3 config file {s3_config_file}')
     try:
-        with open(s3_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(s3_config_file, "r") as jsonfile:
             s3_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the S3 configuration file {s3_config_file}')
         logger.error(e)
 
     # Create S3 resource
-    s3 = boto3.resource("s3",
-                      aws_access_key_id = s3_config['aws_access_key_id'],
-                      aws_secret_access_key = s3_config['aws_secret_access_key'],
-                      endpoint_url = s3_config['endpoint_url']
-    )
+    with metrics.timer("client"):
+        s3 = boto3.resource("s3",
+                          aws_access_key_id = s3_config['aws_access_key_id'],
+                          aws_secret_access_key = s3_config['aws_secret_access_key'],
+                          endpoint_url = s3_config['endpoint_url'],
+                          config = Config(max_pool_connections = max_pool_connections)
+        )
+    metrics.instrument(s3.meta.client)
     
     return s3
 
 
-def change_bucket_lifecycle_conf(s3, bucketname):
+def retention_prefixes(variable_configs, bucket_wide = False):
+    """ Collect buckets and filename beginnings of variables with their
+    retention times. Retention is applied only to variables whose S3
+    configuration gives retention_days, others are kept forever. A
+    filename beginning without literal prefix would expire all objects
+    of the bucket, so it is skipped unless bucket wide rules are allowed.
+
+    Keyword arguments:
+    variable_configs -- dictionary of upload or download configurations by variable name
+    bucket_wide -- if True, allow rules covering whole bucket
+
+    Return:
+    retention -- dictionary of retention days by filename beginning by bucket name
+    """
+    retention = {}
+    for variable, variable_config in variable_configs.items():
+        for timeperiod, s3_config in variable_config["s3"].items():
+            if "retention_days" not in s3_config:
+                logger.debug(f'No retention_days given for {variable} {timeperiod}, skipping')
+                continue
+            if "obj_name_start" in s3_config:
+                templates = [s3_config["obj_name_start"]]
+            else:
+                local_config = variable_config["local"][timeperiod]
+                templates = [local_config[name] for name in ("datafile", "imagefile") if local_config.get(name)]
+            prefix = os.path.commonprefix([s3_listing.get_pattern_prefix(template.split("{")[0])
+                                           for template in templates])
+            if not prefix and not bucket_wide:
+                logger.warning(f'Retention of {variable} {timeperiod} would cover whole bucket '
+                               f'{s3_config["bucket_name"]}, skipping without --bucket_wide')
+                continue
+            retention.setdefault(s3_config["bucket_name"], {})[prefix] = s3_config["retention_days"]
+
+    # Objects of longer prefixes are already covered by shorter ones
+    for prefixes in retention.values():
+        for prefix in list(prefixes):
+            if any(prefix != other and prefix.startswith(other) and prefixes[other] == prefixes[prefix]
+                   for other in prefixes):
+                del prefixes[prefix]
+
+    return retention
+
+
+def change_bucket_lifecycle_conf(s3, bucketname, prefixes):
     """Change bucket lifecycle configuration (e.g. how often are
-    old files removed)
+    old files removed). Rules of other prefixes are kept.
 
     Keyword arguments:
     s3 -- S3 resource
     bucketname -- Which bucket's lifecycle config to edit
+    prefixes -- dictionary of retention days by filename beginning
+
+    Return:
+    True/False -- False if lifecycle configuration is not supported
     """
-    
-    lifecycle_configuration = {
-        "Rules": [
-            { "Expiration":
-              { "Days": 14 },
-              "Status": "Enabled"
-               }]}
-    
+    client = s3.meta.client
+    try:
+        rules = client.get_bucket_lifecycle_configuration(Bucket=bucketname)['Rules']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+            logger.warning(f'Lifecycle configuration of s3://{bucketname} not available ({e})')
+            return False
+        rules = []
+
+    rule_ids = {f"expire-{prefix or 'all'}" for prefix in prefixes}
+    rules = [rule for rule in rules if rule.get('ID') not in rule_ids]
+    rules += [{"ID": f"expire-{prefix or 'all'}",
+               "Filter": {"Prefix": prefix},
+               "Expiration": {"Days": days},
+               "Status": "Enabled"}
+              for prefix, days in prefixes.items()]
+
     logger.debug(f'Changing lifecycle configuration for s3://{bucketname}')
     try:
-        s3.put_bucket_lifecycle_configuration(
+        client.put_bucket_lifecycle_configuration(
             Bucket=bucketname,
-            LifecycleConfiguration=lifecycle_configuration)
+            LifecycleConfiguration={"Rules": rules})
     except ClientError as e:
-        logger.error(f'Error while changing lifecycle config for s3://{bucketname}')
-        logger.error(e)
+        logger.warning(f'Error while changing lifecycle config for s3://{bucketname} ({e})')
+        return False
+
+    return True
+
+
+def list_expired_objects(s3, bucketname, prefixes):
+    """ List objects older than retention time of their prefix.
+
+    Keyword arguments:
+    s3 -- S3 resource
+    bucketname -- S3 bucket name
+    prefixes -- dictionary of retention days by filename beginning
+
+    Return:
+    keys -- list of expired S3 object descriptions
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    keys = []
+    for prefix, days in prefixes.items():
+        expiration_time = now - datetime.timedelta(days = days)
+        keys += [key for key in s3_listing.list_objects_sharded(s3.meta.client, bucketname, prefix)
+                 if key['LastModified'] < expiration_time]
+
+    return keys
+
+
+def delete_objects(s3, bucketname, keys, workers = DELETE_WORKERS):
+    """ Delete objects in requests of DELETE_BATCH_SIZE keys, which are sent
+    in parallel.
+
+    Keyword arguments:
+    s3 -- S3 resource
+    bucketname -- S3 bucket name
+    keys -- list of S3 object descriptions to delete
+    workers -- number of parallel delete requests
+
+    Return:
+    n_deleted -- number of deleted objects
+    """
+    def delete_batch(batch):
+        response = resumable.retry(s3.meta.client.delete_objects, Bucket=bucketname,
+                                   Delete={"Objects": [{"Key": key['Key']} for key in batch], "Quiet": True})
+        for error in response.get('Errors', []):
+            logger.error(f'Error while deleting s3://{bucketname}/{error["Key"]}: {error["Message"]}')
+        n_deleted = len(batch) - len(response.get('Errors', []))
+        metrics.add("deleted_objects", n_deleted, bucket = bucketname)
+        return n_deleted
+
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        return sum(pool.map(delete_batch, batches))
+
+
+def apply_retention(s3, bucketname, prefixes, method = "auto", dry_run = False, workers = DELETE_WORKERS):
+    """ Apply retention to bucket with lifecycle rules, or by deleting
+    expired objects if lifecycle rules are not supported.
+
+    Keyword arguments:
+    s3 -- S3 resource
+    bucketname -- S3 bucket name
+    prefixes -- dictionary of retention days by filename beginning
+    method -- Options: auto | lifecycle | delete
+    dry_run -- if True, only report expired objects
+    workers -- number of parallel delete requests
+
+    Return:
+    report -- dictionary of applied method and number and size of expired objects
+    """
+    report = {"bucket": bucketname, "method": method, "objects": 0, "bytes": 0}
+    if not dry_run and method != "delete":
+        if change_bucket_lifecycle_conf(s3, bucketname, prefixes):
+            report["method"] = "lifecycle"
+            return report
+        if method == "lifecycle":
+            report["method"] = "failed"
+            return report
+        logger.info(f'Deleting expired objects of s3://{bucketname}, lifecycle rules are not available')
+
+    keys = list_expired_objects(s3, bucketname, prefixes)
+    report.update({"objects": len(keys), "bytes": sum(key['Size'] for key in keys)})
+    if not dry_run:
+        report.update({"method": "delete", "objects": delete_objects(s3, bucketname, keys, workers)})
+
+    return report
 
 
 def main():
-        
+
+    start_time = time.perf_counter()
+
     # Create S3 resource
     s3_config_file = "conf/tropomi_s3_rw.json"
-    s3 = create_s3_resource(s3_config_file)
+    s3 = create_s3_resource(s3_config_file, max_pool_connections = max(10, options.workers * 2))
 
-    bucketname = f"tropomi-{options.bucket}-l3"
-        
-    # Update bucket lifecycle policy
-    #change_bucket_lifecycle_conf(s3, bucketname)
-    
-    # Get bucket lifecycle policy
-    bucket_lifecycle_configuration = s3.BucketLifecycleConfiguration(bucketname)
-    print("bucket_lifecycle_configuration: ", bucket_lifecycle_configuration)
+    variable_configs = find_variable_configs(options.mode, options.vars.split(','))
+    retention = retention_prefixes(variable_configs, options.bucket_wide)
+    if not retention:
+        logger.info('No retention_days given in configurations of selected variables')
+        return
+
+    # Apply retention to all buckets concurrently
+    reports = []
+    with ThreadPoolExecutor(max_workers = options.workers) as pool:
+        futures = {pool.submit(apply_retention, s3, bucketname, prefixes, options.method, options.dry_run,
+                               options.workers): bucketname
+                   for bucketname, prefixes in retention.items()}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                logger.error(f'Error while applying retention to s3://{futures[future]}')
+                logger.error(e)
+                continue
+            verb = "would delete" if options.dry_run else "deleted"
+            logger.info(f's3://{report["bucket"]}: {report["method"]}, {verb} {report["objects"]} objects, '
+                        f'{report["bytes"] / 1e6:.1f} MB')
+            reports.append(report)
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'{"Would delete" if options.dry_run else "Deleted"} {sum(report["objects"] for report in reports)} '
+                f'objects, {sum(report["bytes"] for report in reports) / 1e6:.1f} MB from {len(reports)} buckets '
+                f'in {elapsed:.1f} s')
 
 
 if __name__ == '__main__':                                                      
     #Parse commandline arguments                                                
     parser = argparse.ArgumentParser()
-    parser.add_argument('--bucket',
-                        type = str,                                             
-                        default = 'no2-nrti',                               
-                        help = 'Tropomi variable to upload. Options: no2-nrti, co-nrti, o3-nrti, so2-nrti')
+    parser.add_argument('--vars',
+                        type = str,
+                        default = '*-nrti',
+                        help = 'Comma separated list of Tropomi variables or globs, whose buckets retention is applied to.')
+    parser.add_argument('--mode',
+                        type = str,
+                        default = 'upload',
+                        help = 'Which variable configurations to use. Options: upload|download')
+    parser.add_argument('--bucket_wide',
+                        action = 'store_true',
+                        help = 'Allow rules expiring all objects of a bucket, when a variable has no literal filename beginning.')
+    parser.add_argument('--method',
+                        type = str,
+                        default = 'auto',
+                        help = 'Options: lifecycle|delete|auto. Auto deletes expired objects if lifecycle rules are not supported.')
+    parser.add_argument('--dry_run',
+                        action = 'store_true',
+                        help = 'Only report how many objects and bytes would be deleted now.')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = DELETE_WORKERS,
+                        help = 'Number of buckets processed and delete requests sent in parallel.')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
     parser.add_argument('--loglevel',
                         default='info',
                         help='minimum severity of logged messages,\
@@ -106,4 +315,5 @@ if __name__ == '__main__':
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
     
-    main()
+    metrics.run(main, "s3_policy_updates", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
@@ -0,0 +1,157 @@
+import os
+import math
+import hashlib
+import datetime
+
+from botocore.exceptions import ClientError
+
+# Part sizes tried when matching multipart ETags: boto3 default, part
+# sizes used by these codes and the S3 minimum
+MULTIPART_PART_SIZES = [8 * 1024 * 1024,
+                        16 * 1024 * 1024,
+                        5 * 1024 * 1024]
+
+READ_CHUNKSIZE = 1024 * 1024
+
+# S3 object metadata keys describing the uploaded source file
+SOURCE_SIZE_KEY = "source-size"
+SOURCE_MTIME_KEY = "source-mtime"
+
+
+def _file_md5(filename):
+    """ MD5 hash object of whole file read in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(READ_CHUNKSIZE), b""):
+            md5.update(chunk)
+    return md5
+
+
+def _part_md5s(filename, part_size):
+    """ Generator function for MD5 hash objects of file parts
+    """
+    with open(filename, 'rb') as f_in:
+        for part in iter(lambda: f_in.read(part_size), b""):
+            yield hashlib.md5(part)
+
+
+def etag_matches(filename, etag):
+    """ Check if local file matches S3 ETag. Multipart ETags are MD5 of
+    part MD5s followed by number of parts, so part size is guessed from
+    the commonly used part sizes.
+
+    Keyword arguments:
+    filename -- local file
+    etag -- S3 ETag
+
+    Return:
+    True/False -- True if file content matches ETag
+    """
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return _file_md5(filename).hexdigest() == etag
+
+    digest, n_parts = etag.split('-')
+    n_parts = int(n_parts)
+    size = os.path.getsize(filename)
+    mib = 1024 * 1024
+    part_sizes = MULTIPART_PART_SIZES + [math.ceil(size / n_parts / mib) * mib]
+    for part_size in part_sizes:
+        if math.ceil(size / part_size) != n_parts:
+            continue
+        digests = b"".join(md5.digest() for md5 in _part_md5s(filename, part_size))
+        if hashlib.md5(digests).hexdigest() == digest:
+            return True
+
+    return False
+
+
+def _timestamp(last_modified):
+    """ Convert S3 LastModified (datetime or ISO string from saved
+    transfer plan) to POSIX timestamp.
+    """
+    if isinstance(last_modified, str):
+        last_modified = datetime.datetime.fromisoformat(last_modified)
+    return last_modified.timestamp()
+
+
+def set_mtime(local_file, last_modified):
+    """ Set modification time of downloaded file to S3 LastModified, so
+    that unchanged objects can be recognized later without checksums.
+
+    Keyword arguments:
+    local_file -- downloaded file
+    last_modified -- S3 LastModified of object
+    """
+    timestamp = _timestamp(last_modified)
+    os.utime(local_file, (timestamp, timestamp))
+
+
+def is_downloaded(local_file, key, checksum = False, compare_size = True):
+    """ Check if S3 object is already downloaded and unchanged.
+
+    Keyword arguments:
+    local_file -- local file of S3 object
+    key -- S3 object description from listing
+    checksum -- if True, compare file content with ETag instead of mtime
+    compare_size -- if False, size is not compared (e.g. unpacked files)
+
+    Return:
+    True/False -- True if local file is up to date
+    """
+    if not os.path.exists(local_file):
+        return False
+    if compare_size and os.path.getsize(local_file) != key['Size']:
+        return False
+    if checksum and compare_size:
+        return etag_matches(local_file, key['ETag'])
+
+    return int(os.path.getmtime(local_file)) == int(_timestamp(key['LastModified']))
+
+
+def source_metadata(filename):
+    """ Get S3 object metadata describing uploaded source file.
+
+    Keyword arguments:
+    filename -- file to upload
+
+    Return:
+    metadata -- dictionary of source file size and mtime
+    """
+    return {SOURCE_SIZE_KEY: str(os.path.getsize(filename)),
+            SOURCE_MTIME_KEY: str(int(os.path.getmtime(filename)))}
+
+
+def is_uploaded(s3, bucketname, objectname, filename, checksum = False):
+    """ Check if local file is already uploaded and unchanged.
+
+    Keyword arguments:
+    s3 -- S3 client
+    bucketname -- Bucket to upload to
+    objectname -- S3 object name
+    filename -- local file to upload
+    checksum -- if True, compare file content with ETag when the object
+    is not compressed
+
+    Return:
+    True/False -- True if S3 object is up to date
+    """
+    try:
+        response = s3.head_object(Bucket=bucketname, Key=objectname)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+    # Content of uncompressed objects can be compared with ETag
+    size = os.path.getsize(filename)
+    if checksum and response['ContentLength'] == size:
+        return etag_matches(filename, response['ETag'])
+
+    # Compressed objects are compared by the metadata of the source file
+    metadata = response.get('Metadata', {})
+    if SOURCE_SIZE_KEY in metadata:
+        return all(metadata.get(name) == value for name, value in source_metadata(filename).items())
+
+    return response['ContentLength'] == size and response['LastModified'].timestamp() >= os.path.getmtime(filename)
@@ -0,0 +1,260 @@
+import logging
+import os
+import re
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger("logger")
+
+# Priority classes from most to least urgent
+PRIORITY_CLASSES = ["nrti", "offl", "rpro"]
+DEFAULT_PRIORITY = "offl"
+
+# Maximum number of concurrent transfers of each class on the host
+CLASS_CONCURRENCY = {"nrti": 16,
+                     "offl": 8,
+                     "rpro": 4}
+
+# State of transfers of all processes on the host is shared in this file
+STATE_FILE = os.path.join(tempfile.gettempdir(), "tropomi_scheduler.json")
+
+# Seconds between checks for free transfer slots or bandwidth
+WAIT_INTERVAL = 0.1
+
+# Transferred bytes are taken from the bandwidth limit in chunks of
+# at least this size
+THROTTLE_CHUNKSIZE = 1024 * 1024
+
+# Each process takes bandwidth from the shared token bucket in grants of
+# this many seconds of the limit, which are then used without locking the
+# state file
+GRANT_SECONDS = 0.25
+
+# Scheduling of this process, set with configure
+settings = {"enabled": False,
+            "priority": DEFAULT_PRIORITY,
+            "bandwidth": None,
+            "state_file": STATE_FILE}
+
+# Bytes granted to this process from the shared token bucket, not yet used
+_grant = {"bytes": 0}
+_grant_lock = threading.Lock()
+
+
+def priority_from_name(name):
+    """ Get priority class from stream in variable name.
+
+    Keyword arguments:
+    name -- variable name, e.g. no2-nrti or ukraine-co-rpro
+
+    Return:
+    priority -- Options: nrti | offl | rpro, default if stream is not found
+    """
+    match = re.search(r"(?:^|-)(nrti|offl|rpro)(?:-|$)", name.lower())
+    return match.group(1) if match else DEFAULT_PRIORITY
+
+
+def lowest_priority(names):
+    """ Get least urgent priority class of variable names.
+    """
+    priorities = [priority_from_name(name) for name in names] or [DEFAULT_PRIORITY]
+    return max(priorities, key = PRIORITY_CLASSES.index)
+
+
+def configure(priority = DEFAULT_PRIORITY, bandwidth = None, state_file = STATE_FILE):
+    """ Schedule transfers of this process together with other scheduled
+    processes on the host. Transfers are not scheduled unless configured.
+
+    Keyword arguments:
+    priority -- Options: nrti | offl | rpro
+    bandwidth -- bandwidth limit of all scheduled transfers on the host in
+    bytes per second, None for no limit
+    state_file -- file for state shared by processes
+    """
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f'Give valid priority class, not {priority}.')
+    settings.update({"enabled": True, "priority": priority, "bandwidth": bandwidth, "state_file": state_file})
+    _grant["bytes"] = 0
+    logger.debug(f'Scheduling transfers with priority {priority} and bandwidth limit {bandwidth} B/s')
+
+
+def _is_alive(pid):
+    """ Check if process exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _shared_state():
+    """ Lock, read and write back state file shared by processes. Entries
+    of processes which no longer exist are removed.
+    """
+    with open(settings["state_file"], 'a+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        state_file.seek(0)
+        try:
+            state = json.loads(state_file.read() or "{}")
+        except ValueError:
+            state = {}
+        for name in ("active", "throttled"):
+            state[name] = {priority: [pid for pid in state.get(name, {}).get(priority, []) if _is_alive(pid)]
+                           for priority in PRIORITY_CLASSES}
+
+        yield state
+
+        state_file.seek(0)
+        state_file.truncate()
+        json.dump(state, state_file)
+
+
+def _more_urgent_waiting(state, name, priority):
+    """ Check if transfers of more urgent classes are waiting.
+    """
+    return any(state[name][other] for other in PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority)])
+
+
+def _wait_for(name, take):
+    """ Wait until take(state) succeeds and no transfers of more urgent
+    classes are waiting in the same queue. Only resources shared by all
+    classes are taken this way, so that waiting of more urgent classes
+    means that they would get what less urgent classes leave.
+
+    Keyword arguments:
+    name -- waiting queue of state, Options: throttled
+    take -- function taking resources from shared state, returns True if
+    resources were taken and the number of seconds to wait otherwise
+    """
+    pid = os.getpid()
+    priority = settings["priority"]
+    queued = False
+    while True:
+        with _shared_state() as state:
+            delay = WAIT_INTERVAL
+            if not _more_urgent_waiting(state, name, priority):
+                result = take(state)
+                if result is True:
+                    if queued:
+                        state[name][priority].remove(pid)
+                    return
+                delay = max(WAIT_INTERVAL, result)
+            if not queued:
+                state[name][priority].append(pid)
+                queued = True
+        time.sleep(delay)
+
+
+@contextmanager
+def transfer_slot():
+    """ Context manager for running one transfer. Waits until the priority
+    class of this process has a free slot. Slots of each class are
+    separate, so transfers of other classes are not waited for.
+    """
+    if not settings["enabled"]:
+        yield
+        return
+
+    pid = os.getpid()
+    priority = settings["priority"]
+
+    with metrics.timer("scheduler_wait", priority = priority):
+        while True:
+            with _shared_state() as state:
+                if len(state["active"][priority]) < CLASS_CONCURRENCY[priority]:
+                    state["active"][priority].append(pid)
+                    break
+            time.sleep(WAIT_INTERVAL)
+    try:
+        yield
+    finally:
+        with _shared_state() as state:
+            if pid in state["active"][priority]:
+                state["active"][priority].remove(pid)
+
+
+def throttle(n_bytes):
+    """ Take transferred bytes from token bucket of host bandwidth limit,
+    wait if bucket is empty. More urgent classes get bandwidth first.
+    Bytes are taken from the shared bucket in grants of GRANT_SECONDS of
+    bandwidth, and smaller transfers use the grant of this process.
+
+    Keyword arguments:
+    n_bytes -- number of bytes to transfer
+    """
+    if not settings["enabled"] or not settings["bandwidth"]:
+        return
+
+    rate = settings["bandwidth"]
+
+    with _grant_lock:
+        if _grant["bytes"] >= n_bytes:
+            _grant["bytes"] -= n_bytes
+            return
+        grant = max(n_bytes - _grant["bytes"], rate * GRANT_SECONDS)
+
+        def take_tokens(state):
+            # Bucket holds one second of bandwidth and may go negative by
+            # the size of the last grant
+            now = time.time()
+            tokens = min(rate, state.get("tokens", rate) + (now - state.get("time", now)) * rate)
+            state["time"] = now
+            state["tokens"] = tokens
+            if tokens <= 0:
+                return -tokens / rate
+            state["tokens"] = tokens - grant
+            return True
+
+        # Other threads of this process wait for the grant as well
+        _wait_for("throttled", take_tokens)
+        _grant["bytes"] += grant - n_bytes
+
+
+def bandwidth_callback():
+    """ Get boto3 transfer callback, which throttles transferred bytes.
+
+    Return:
+    callback -- function to be given as Callback of boto3 transfers, None
+    if bandwidth is not limited
+    """
+    if not settings["enabled"] or not settings["bandwidth"]:
+        return None
+
+    lock = threading.Lock()
+    pending = [0]
+
+    def callback(n_bytes):
+        with lock:
+            pending[0] += n_bytes
+            if pending[0] < THROTTLE_CHUNKSIZE:
+                return
+            n_bytes, pending[0] = pending[0], 0
+        throttle(n_bytes)
+
+    return callback
+
+
+class ThrottledReader:
+    """ File object wrapper, which throttles bytes read from it.
+    """
+
+    def __init__(self, f_in):
+        self.f_in = f_in
+
+    def read(self, size = -1):
+        data = self.f_in.read(size)
+        throttle(len(data))
+        return data
+
+    def close(self):
+        self.f_in.close()
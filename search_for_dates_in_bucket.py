@@ -5,12 +5,24 @@ import datetime
 from dateutil.relativedelta import relativedelta
 import logging
 import time
-import gzip
-import shutil
 import os
+import string
 
 import boto3
 
+import bucket_inventory
+import s3_listing
+import metrics
+
+# Length of the date token in object names for each product
+DATE_DIGITS = {"l2": 8,
+               "l3_day": 8,
+               "l3_month": 6,
+               "l3_year": 4}
+
+logger = logging.getLogger("logger")
+
+
 def create_s3_client(s3_config_file):
     """ Create S3 client to be used for downloading files.
                                                                                                   
@@ -24,29 +36,32 @@ def create_s3_client(s3_config_file):
     # Read S3 config file
     logger.debug(f'Reading S3 config file {s3_config_file}')
     try:
-        with open(s3_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(s3_config_file, "r") as jsonfile:
             s3_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the S3 configuration file {s3_config_file}')
         logger.error(e)
 
     # Create S3 client
-    s3 = boto3.client("s3",
-                      aws_access_key_id = s3_config['aws_access_key_id'],
-                      aws_secret_access_key = s3_config['aws_secret_access_key'],
-                      endpoint_url = s3_config['endpoint_url']
-    )
-    
+    with metrics.timer("client"):
+        s3 = boto3.client("s3",
+                          aws_access_key_id = s3_config['aws_access_key_id'],
+                          aws_secret_access_key = s3_config['aws_secret_access_key'],
+                          endpoint_url = s3_config['endpoint_url']
+        )
+    metrics.instrument(s3)
+
     return s3
 
 
-def search_for_pattern(s3, bucket_name, pattern):
+def search_for_pattern(s3, bucket_name, pattern, inventory = None):
     """ Search S3 objects by filename pattern containing date.
                                       
     Keyword arguments:                                                                                
     s3 -- boto3 S3 client
     bucket_name -- S3 bucket name where to search for files
     pattern -- pattern used for searching matching files
+    inventory -- bucket inventory to search instead of S3 listing (optional)
 
     Return:                                                                                           
     True/False -- True if match is found
@@ -54,32 +69,98 @@ def search_for_pattern(s3, bucket_name, pattern):
     """
     found_match = False
     
-    # Use paginator to be able to list all objects in bucket containing
-    # more than 1000 objects.
-    paginator = s3.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket_name)
+    # Listing is limited to objects starting with the literal beginning
+    # of the pattern.
+    prefix = s3_listing.get_pattern_prefix(pattern)
 
     # Search for files containing pattern
-    logger.debug(f'Searching for pattern {pattern} in bucket {bucket_name}')
-    for page in pages:
-        try:
-            for key in page['Contents']:
-                if re.search(pattern, key['Key']):
-                    return True
-        except:
-            logger.debug(f'"Contents" keyword not found on S3 page, passing on to next page.')
-            pass
+    logger.debug(f'Searching for pattern {pattern} with prefix {prefix} in bucket {bucket_name}')
+    for key in bucket_inventory.list_bucket(s3, bucket_name, prefix, inventory):
+        if re.search(pattern, key['Key']):
+            return True
 
     return False
 
 
+def template_to_regex(obj_name_start, date_digits):
+    """ Convert obj_name_start template to regex capturing the date token.
+
+    Keyword arguments:
+    obj_name_start -- filename template containing placeholder for {date}
+    date_digits -- number of digits in date token
+
+    Return:
+    compiled regex with named group "date"
+    """
+    regex = ""
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(obj_name_start):
+        regex += literal
+        if field_name == "date":
+            regex += f"(?P<date>\\d{{{date_digits}}})"
+        elif field_name is not None:
+            regex += ".*?"
+
+    return re.compile(regex)
+
+
+def search_for_templates(s3, bucket_name, templates, product, prefix = "", inventory = None):
+    """ List S3 bucket once and collect all dates found in object names
+    for several filename templates.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    templates -- dictionary of filename templates containing placeholder
+    for {date} by name
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    prefix -- list only objects starting with this prefix
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    found_dates -- dictionary of sets of date strings found in bucket by
+    template name
+    """
+    matcher = s3_listing.compile_patterns({name: template_to_regex(obj_name_start, DATE_DIGITS[product])
+                                           for name, obj_name_start in templates.items()})
+    found_dates = {name: set() for name in templates}
+
+    # Collect date tokens from all matching object names
+    logger.debug(f'Searching for dates of {len(templates)} templates with prefix {prefix} in bucket {bucket_name}')
+    for key in bucket_inventory.list_bucket(s3, bucket_name, prefix, inventory):
+        for date_regex, names in s3_listing.candidate_patterns(matcher, key['Key']):
+            for match in date_regex.finditer(key['Key']):
+                for name in names:
+                    found_dates[name].add(match.group('date'))
+
+    logger.debug(f'Found {sum(len(dates) for dates in found_dates.values())} dates in bucket {bucket_name}')
+    return found_dates
+
+
+def search_for_dates(s3, bucket_name, obj_name_start, product, prefix = "", inventory = None):
+    """ List S3 bucket once and collect all dates found in object names.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name where to search for files
+    obj_name_start -- filename template containing placeholder for {date}
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    prefix -- list only objects starting with this prefix
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    found_dates -- set of date strings found in bucket
+    """
+    return search_for_templates(s3, bucket_name, {obj_name_start: obj_name_start}, product,
+                                prefix = prefix, inventory = inventory)[obj_name_start]
+
+
 def daterange(start_date, end_date, product = "l2", reverse = False):
     """ Generator function for getting a list of dates
 
     Keyword arguments:                                                                                
     start_date -- First date in list
     end_date -- Last date in list
-    product -- Options: l2 | l3_day | l3_month
+    product -- Options: l2 | l3_day | l3_month | l3_year
     reverse -- if True, list dates from last to first
 
     Yield:
@@ -96,15 +177,92 @@ def daterange(start_date, end_date, product = "l2", reverse = False):
         delta = relativedelta(end_date, start_date)
         n_months = delta.months + (delta.years * 12)
         for n in range(n_months+1):
-            print(n)
             if not reverse:
                 yield (start_date + relativedelta(months = n)).strftime("%Y%m")
             else:
                 yield (end_date - relativedelta(months = n)).strftime("%Y%m")
+    elif product == "l3_year":
+        for n in range(end_date.year - start_date.year + 1):
+            if not reverse:
+                yield (start_date + relativedelta(years = n)).strftime("%Y")
+            else:
+                yield (end_date - relativedelta(years = n)).strftime("%Y")
     else:
         raise ValueError('Give valid product name.')
 
 
+def search_variable(s3, variable_config, product, dates, single_listing = False, inventory = None):
+    """ Generator function for searching which dates are found in S3 bucket
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_config -- search configuration of variable
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    dates -- list of dates to search
+    single_listing -- if True, list bucket only once for all dates
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Yield:
+    dates found in bucket in the order of given dates
+    """
+    bucket_name = variable_config[product]["bucket_name"]
+    obj_name_start = variable_config[product]["obj_name_start"]
+
+    # List bucket only once and collect all dates found in it. Listing is
+    # limited to the common beginning of the first and last date patterns.
+    if single_listing:
+        prefix = s3_listing.patterns_prefix([obj_name_start.format(date = single_date)
+                                             for single_date in dates[:1] + dates[-1:]])
+        found_dates = search_for_dates(s3, bucket_name, obj_name_start, product, prefix = prefix,
+                                       inventory = inventory)
+
+    # Loop through dates and check if they are found in bucket
+    for single_date in dates:
+        if single_listing:
+            date_found = single_date in found_dates
+        else:
+            pattern = obj_name_start.format(date = single_date)
+            date_found = search_for_pattern(s3, bucket_name, pattern, inventory = inventory)
+
+        if date_found:
+            yield single_date
+
+
+def search_variables(s3, variable_configs, product, dates, inventory = None):
+    """ Search which dates of several variables are found in S3 buckets.
+    Each bucket is listed only once for all variables using it.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of search configurations by variable name
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    dates -- list of dates to search
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    found_dates -- dictionary of lists of dates found in bucket in the
+    order of given dates by variable name
+    """
+    bucket_templates = {}
+    for var, variable_config in variable_configs.items():
+        bucket_templates.setdefault(variable_config[product]["bucket_name"], {})[var] = \
+            variable_config[product]["obj_name_start"]
+
+    found_dates = {}
+    for bucket_name, templates in bucket_templates.items():
+        # Listing is limited to the common beginning of the first and last
+        # date patterns of all variables
+        prefix = s3_listing.patterns_prefix([obj_name_start.format(date = single_date)
+                                             for obj_name_start in templates.values()
+                                             for single_date in dates[:1] + dates[-1:]])
+        bucket_dates = search_for_templates(s3, bucket_name, templates, product, prefix = prefix,
+                                            inventory = inventory)
+        for var in templates:
+            found_dates[var] = [single_date for single_date in dates if single_date in bucket_dates[var]]
+
+    return found_dates
+
+
 def main():
 
     # Create S3 client
@@ -115,7 +273,7 @@ def main():
     variable_config_file = f"conf/search/{options.var}.json"
     logger.debug(f'Reading config file {variable_config_file}')
     try:
-        with open(variable_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(variable_config_file, "r") as jsonfile:
             variable_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the configuration file {variable_config_file}')
@@ -125,20 +283,29 @@ def main():
     if options.product == "l3_month":
         start_date = datetime.datetime.strptime(options.start_date,'%Y%m').date()
         end_date = datetime.datetime.strptime(options.end_date,'%Y%m').date()
+    elif options.product == "l3_year":
+        start_date = datetime.datetime.strptime(options.start_date,'%Y').date()
+        end_date = datetime.datetime.strptime(options.end_date,'%Y').date()
     else:
         start_date = datetime.datetime.strptime(options.start_date,'%Y%m%d').date()
         end_date = datetime.datetime.strptime(options.end_date,'%Y%m%d').date()
 
-    # Loop through dates and check if they are found in bucket
+    # Use local bucket inventory, refresh it from S3 first if wanted
+    inventory = None
+    if options.inventory:
+        inventory = bucket_inventory.open_inventory(options.inventory)
+        if options.refresh:
+            obj_name_start = variable_config[options.product]["obj_name_start"]
+            bucket_inventory.refresh_inventory(inventory, s3, variable_config[options.product]["bucket_name"],
+                                               prefix = s3_listing.get_pattern_prefix(obj_name_start.split("{")[0]))
+
+    # Search dates from last to first and write found dates in file
+    dates = list(daterange(start_date, end_date, product = options.product, reverse = True))
     with open(options.datelist_file, 'w') as outfile_datelist:
-        for single_date in daterange(start_date, end_date, product = options.product, reverse = True):
-            bucket_name = variable_config[options.product]["bucket_name"]
-            pattern = variable_config[options.product]["obj_name_start"].format(date = single_date)
-    
-            # Check if pattern is found in bucket and write found dates in file
-            if search_for_pattern(s3, bucket_name, pattern):
-                print(f"{single_date}")
-                outfile_datelist.write(f"{single_date}\n")
+        for single_date in search_variable(s3, variable_config, options.product, dates,
+                                           single_listing = options.single_listing, inventory = inventory):
+            print(f"{single_date}")
+            outfile_datelist.write(f"{single_date}\n")
 
 if __name__ == '__main__':                                                      
     #Parse commandline arguments                                                
@@ -150,7 +317,7 @@ if __name__ == '__main__':
     parser.add_argument('--product',
                         type = str,
                         default = 'l3_month',
-                        help = 'Product to search. Options: l2|l3_day|l3_month')
+                        help = 'Product to search. Options: l2|l3_day|l3_month|l3_year')
     parser.add_argument('--start_date',
                         type = str,                          
                         default = '202201',                               
@@ -163,6 +330,27 @@ if __name__ == '__main__':
                         type = str,                                             
                         default = 's3_data_newest_dates.txt',                               
                         help = 'Outfile for printed list of days.')    
+    parser.add_argument('--single_listing',
+                        action = 'store_true',
+                        help = 'List bucket only once and search all dates from the listing.')
+    parser.add_argument('--inventory',
+                        type = str,
+                        default = None,
+                        help = 'Local SQLite bucket inventory file to search instead of listing S3 bucket.')
+    parser.add_argument('--refresh',
+                        action = 'store_true',
+                        help = 'Update bucket inventory from S3 before searching.')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
     parser.add_argument('--loglevel',
                         default='debug',
                         help='minimum severity of logged messages,\
@@ -184,4 +372,5 @@ if __name__ == '__main__':
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
     
-    main()
+    metrics.run(main, "search_for_dates_in_bucket", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
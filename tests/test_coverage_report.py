@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+moto = pytest.importorskip("moto")
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bucket_inventory
+import coverage_report
+
+BUCKET = "tropomi-coverage-test"
+TEMPLATE = "S5P_OFFL_L2__NO2____{date}"
+VARIABLE_CONFIGS = {"no2-offl": {"l2": {"bucket_name": BUCKET, "obj_name_start": TEMPLATE}}}
+
+
+def granule_key(single_date, orbit):
+    """ L2 object name of orbit starting on date.
+    """
+    return (f"S5P_OFFL_L2__NO2____{single_date}T{orbit % 24:02d}0000_{single_date}T{orbit % 24:02d}5900_"
+            f"{orbit:05d}_03_020400_20221103T170957.nc")
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name = "us-east-1")
+        client.create_bucket(Bucket = BUCKET)
+        # Full day, partial day with few orbits and missing day
+        for orbit in range(26200, 26200 + coverage_report.MIN_ORBITS):
+            client.put_object(Bucket = BUCKET, Key = granule_key("20221101", orbit), Body = b"data")
+        for orbit in range(26300, 26303):
+            client.put_object(Bucket = BUCKET, Key = granule_key("20221102", orbit), Body = b"data")
+        yield client
+
+
+@pytest.fixture
+def inventory(s3, tmp_path):
+    conn = bucket_inventory.open_inventory(str(tmp_path / "inventory.sqlite"))
+    bucket_inventory.refresh_inventory(conn, s3, BUCKET)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("use_inventory", [False, True])
+def test_coverage_matrix_reports_present_partial_and_missing_dates(s3, inventory, use_inventory):
+    coverage = coverage_report.coverage_matrix(s3, VARIABLE_CONFIGS, ["l2"], "20221101", "20221103", workers = 2,
+                                               inventory = inventory if use_inventory else None)
+
+    assert coverage["l2"]["dates"] == ["20221101", "20221102", "20221103"]
+    variable = coverage["l2"]["variables"]["no2-offl"]
+    assert variable["bucket"] == BUCKET
+    assert variable["status"] == ["present", "partial", "missing"]
+    assert variable["orbits"] == [coverage_report.MIN_ORBITS, 3, 0]
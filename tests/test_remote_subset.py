@@ -0,0 +1,148 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+moto = pytest.importorskip("moto")
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remote_subset
+
+BUCKET = "tropomi-subset-test"
+KEY = "S5P_OFFL_L2__NO2____20221101T000000_20221101T001000_26210_03_020400_20221102T000000.nc"
+VARIABLES = ["PRODUCT/qa_value", "PRODUCT/nitrogendioxide_tropospheric_column"]
+
+
+def write_granule(filename):
+    """ Write small netCDF4 style L2 granule with dimension scales, chunked
+    and compressed variables and a large variable which is not read.
+    """
+    rng = np.random.default_rng(1)
+    with h5py.File(filename, 'w') as f:
+        f.attrs["title"] = "TROPOMI/S5P NO2 1-Orbit L2 Swath"
+        product = f.create_group("PRODUCT")
+        product.attrs["comment"] = "Main data fields"
+        scanline = product.create_dataset("scanline", data = np.arange(400, dtype = "i4"))
+        scanline.make_scale("scanline")
+        pixel = product.create_dataset("ground_pixel", data = np.arange(50, dtype = "i4"))
+        pixel.make_scale("ground_pixel")
+
+        qa_value = product.create_dataset("qa_value", data = rng.integers(0, 100, (400, 50), dtype = "u1"),
+                                          chunks = (50, 50), compression = "gzip", shuffle = True)
+        qa_value.attrs["scale_factor"] = np.float32(0.01)
+        no2 = product.create_dataset("nitrogendioxide_tropospheric_column",
+                                     data = rng.random((400, 50), dtype = "f4"), chunks = (100, 50),
+                                     fillvalue = np.float32(9.96921e36))
+        no2.attrs["units"] = "mol m-2"
+        for dataset in (qa_value, no2):
+            dataset.dims[0].attach_scale(scanline)
+            dataset.dims[1].attach_scale(pixel)
+
+        support = f.create_group("PRODUCT/SUPPORT_DATA")
+        support.create_dataset("surface_albedo", data = rng.random((400, 50, 32), dtype = "f4"), chunks = (50, 50, 32))
+
+
+def data_attributes(dataset):
+    """ Attributes of dataset other than dimension attributes.
+    """
+    return {name: value for name, value in dataset.attrs.items() if name not in remote_subset.DIMENSION_ATTRIBUTES}
+
+
+@pytest.fixture
+def s3(tmp_path):
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name = "us-east-1")
+        client.create_bucket(Bucket = BUCKET)
+        granule = tmp_path / "granule.nc"
+        write_granule(granule)
+        client.upload_file(str(granule), BUCKET, KEY)
+        yield client
+
+
+@pytest.fixture
+def key(s3):
+    head = s3.head_object(Bucket = BUCKET, Key = KEY)
+    return {"Key": KEY, "Size": head["ContentLength"], "ETag": head["ETag"], "LastModified": head["LastModified"]}
+
+
+@pytest.mark.parametrize("ranges, expected", [
+    ([], []),
+    ([(0, 10), (10, 20)], [(0, 20)]),
+    ([(10, 20), (0, 10)], [(0, 20)]),
+    ([(0, 10), (5, 15)], [(0, 15)]),
+    ([(0, 10), (20, 30)], [(0, 30)]),
+    ([(0, 10), (21, 30)], [(0, 10), (21, 30)]),
+    ([(0, 10), (2, 5)], [(0, 10)]),
+])
+def test_coalesce_ranges_merges_adjacent_and_close_ranges(ranges, expected):
+    assert remote_subset.coalesce_ranges(ranges, max_gap = 10) == expected
+
+
+def test_coalesce_ranges_keeps_merged_ranges_under_max_range():
+    ranges = [(i * 10, i * 10 + 10) for i in range(10)]
+    merged = remote_subset.coalesce_ranges(ranges, max_gap = 0, max_range = 30)
+    assert merged == [(0, 30), (30, 60), (60, 90), (90, 100)]
+
+
+def test_download_subset_matches_full_read(s3, key, tmp_path):
+    outpath = tmp_path / "subset"
+    outpath.mkdir()
+    local_file = remote_subset.download_subset(s3, BUCKET, key, str(outpath), VARIABLES)
+
+    assert local_file == f"{outpath}/{KEY}"
+    assert not os.path.exists(f"{local_file}.tmp")
+    with h5py.File(tmp_path / "granule.nc", 'r') as f_full, h5py.File(local_file, 'r') as f_subset:
+        assert f_subset.attrs["title"] == f_full.attrs["title"]
+        assert f_subset["PRODUCT"].attrs["comment"] == f_full["PRODUCT"].attrs["comment"]
+        assert "SUPPORT_DATA" not in f_subset["PRODUCT"]
+        for name in VARIABLES:
+            full, subset = f_full[name], f_subset[name]
+            np.testing.assert_array_equal(subset[()], full[()])
+            assert subset.dtype == full.dtype
+            assert subset.chunks == full.chunks
+            assert subset.compression == full.compression
+            assert data_attributes(subset) == data_attributes(full)
+            assert [dim[0].name for dim in subset.dims] == ["/PRODUCT/scanline", "/PRODUCT/ground_pixel"]
+        np.testing.assert_array_equal(f_subset["PRODUCT/scanline"][()], f_full["PRODUCT/scanline"][()])
+
+
+def test_download_subset_reads_chunks_with_coalesced_ranges(s3, key, tmp_path, monkeypatch):
+    n_gets = []
+    s3.meta.events.register('before-call.s3.GetObject', lambda **kwargs: n_gets.append(1))
+
+    # GETs between prefetching chunks of a variable and discarding them
+    # are the data reads, which have to be served by the prefetched ranges
+    data_reads = []
+    prefetch, discard = remote_subset.S3RangeFile.prefetch, remote_subset.S3RangeFile.discard
+
+    def counted_prefetch(range_file, ranges, workers = remote_subset.RANGE_WORKERS):
+        data_reads.append({"ranges": len(ranges), "start": len(n_gets)})
+        return prefetch(range_file, ranges, workers)
+
+    def counted_discard(range_file, starts):
+        data_reads[-1]["gets"] = len(n_gets) - data_reads[-1]["start"]
+        return discard(range_file, starts)
+
+    monkeypatch.setattr(remote_subset.S3RangeFile, "prefetch", counted_prefetch)
+    monkeypatch.setattr(remote_subset.S3RangeFile, "discard", counted_discard)
+    range_files = []
+    init = remote_subset.S3RangeFile.__init__
+
+    def recorded_init(range_file, *args, **kwargs):
+        init(range_file, *args, **kwargs)
+        range_files.append(range_file)
+
+    monkeypatch.setattr(remote_subset.S3RangeFile, "__init__", recorded_init)
+
+    remote_subset.download_subset(s3, BUCKET, key, str(tmp_path), VARIABLES)
+
+    assert len(data_reads) == 4
+    for data_read in data_reads:
+        assert data_read["gets"] <= data_read["ranges"]
+    range_file, = range_files
+    assert range_file.n_requests == len(n_gets)
+    assert range_file.n_bytes < key["Size"] / 2
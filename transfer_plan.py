@@ -0,0 +1,381 @@
+import os
+import math
+import json
+import datetime
+import logging
+from contextlib import contextmanager
+from functools import partial
+
+import compression
+import s3_sync
+import resumable
+import download_tropomi
+import upload_tropomi
+import search_for_dates_in_bucket
+
+# Throughput used for estimating duration of transfers, bytes per second
+THROUGHPUT = 50e6
+
+# Latency of one request when estimating duration
+REQUEST_LATENCY = 0.05
+
+# boto3 upload_file defaults
+UPLOAD_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+UPLOAD_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+logger = logging.getLogger("logger")
+
+
+@contextmanager
+def count_requests(s3):
+    """ Context manager counting S3 requests made with client by operation.
+
+    Yield:
+    counts -- dictionary of number of requests by operation name, updated
+    """
+    counts = {}
+
+    def count(model, **kwargs):
+        counts[model.name] = counts.get(model.name, 0) + 1
+
+    s3.meta.events.register('before-call.s3', count)
+    try:
+        yield counts
+    finally:
+        s3.meta.events.unregister('before-call.s3', count)
+
+
+def download_requests(size, resume = False):
+    """ Estimate number of requests of downloading object.
+
+    Keyword arguments:
+    size -- object size in bytes
+    resume -- if True, object is downloaded with resumable download
+
+    Return:
+    requests -- dictionary of number of requests by type
+    """
+    if resume or size < download_tropomi.MULTIPART_THRESHOLD:
+        return {"HEAD": 1, "GET": 1}
+    return {"HEAD": 1, "GET": math.ceil(size / download_tropomi.MULTIPART_CHUNKSIZE)}
+
+
+def upload_requests(size, multipart = False, resume = False):
+    """ Estimate number of requests of uploading file.
+
+    Keyword arguments:
+    size -- file size in bytes
+    multipart -- if True, file is uploaded as streaming multipart upload
+    resume -- if True, file is uploaded with resumable upload
+
+    Return:
+    requests -- dictionary of number of requests by type
+    """
+    if multipart:
+        part_size = upload_tropomi.PART_SIZE
+    elif resume:
+        part_size = resumable.PART_SIZE
+    elif size < UPLOAD_MULTIPART_THRESHOLD:
+        return {"PUT": 1}
+    else:
+        part_size = UPLOAD_MULTIPART_CHUNKSIZE
+    return {"PUT": max(1, math.ceil(size / part_size)) + 2}
+
+
+def upload_size(filename, compressed_file = None):
+    """ Get number of bytes sent when uploading file. Data files are sent
+    compressed, and their size is known if they are already compressed on
+    disk, otherwise the uncompressed size is an upper bound.
+
+    Keyword arguments:
+    filename -- file to upload
+    compressed_file -- compressed file of data file, None if file is sent as is
+
+    Return:
+    size, estimated -- size in bytes, True if size is an upper bound
+    """
+    size = os.path.getsize(filename)
+    if compressed_file is None:
+        return size, False
+    if os.path.exists(compressed_file) and os.path.getmtime(compressed_file) >= os.path.getmtime(filename):
+        return os.path.getsize(compressed_file), False
+    return size, True
+
+
+def _key_record(key):
+    """ JSON serializable S3 object description.
+    """
+    last_modified = key['LastModified']
+    if isinstance(last_modified, datetime.datetime):
+        last_modified = last_modified.isoformat()
+    return {"Key": key['Key'], "Size": key['Size'], "ETag": key['ETag'], "LastModified": last_modified}
+
+
+def _add_requests(total, requests):
+    """ Add numbers of requests to total by type.
+    """
+    for name, n in requests.items():
+        total[name] = total.get(name, 0) + n
+
+
+def summarize(plan, throughput = THROUGHPUT, workers = 1):
+    """ Sum objects, bytes and requests of plan and estimate duration.
+
+    Keyword arguments:
+    plan -- transfer plan
+    throughput -- total throughput of transfers in bytes per second
+    workers -- number of parallel transfers
+
+    Return:
+    summary -- dictionary of totals, also stored in plan
+    """
+    summary = {"objects": 0, "bytes": 0, "present_objects": 0, "present_bytes": 0,
+               "transfer_objects": 0, "transfer_bytes": 0, "estimated_objects": 0,
+               "planning_requests": plan["planning_requests"], "requests": {}}
+    for item in plan["items"]:
+        summary["objects"] += 1
+        summary["bytes"] += item["size"]
+        if item["present"]:
+            summary["present_objects"] += 1
+            summary["present_bytes"] += item["size"]
+        if item["transfer"]:
+            summary["transfer_objects"] += 1
+            summary["transfer_bytes"] += item.get("transfer_size", item["size"])
+            summary["estimated_objects"] += int(item.get("estimated", False))
+            _add_requests(summary["requests"], item["requests"])
+
+    n_requests = sum(summary["requests"].values())
+    summary["estimated_duration_s"] = summary["transfer_bytes"] / throughput + \
+        n_requests * REQUEST_LATENCY / max(1, workers)
+    plan["summary"] = summary
+    return summary
+
+
+def plan_downloads(s3, variable_configs, timeperiod, dates, inventory = None, sync = False, checksum = False,
+                   stream_decompress = False, resume = False, subset = False, check_present = True):
+    """ List objects of variables and dates to download and check which
+    are already present locally. Each bucket is listed once.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of download configurations by variable name
+    timeperiod -- which configuration parameters to use, options day|month|year
+    dates -- list of dates to download
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+    sync -- if True, objects present locally are not downloaded
+    checksum -- if True, compare local files with ETag
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    resume -- if True, objects are downloaded with resumable downloads
+    subset -- if True, only subset_variables of configs are downloaded
+    check_present -- if True, check which objects are present locally,
+    always checked in sync
+
+    Return:
+    plan -- transfer plan
+    """
+    bucket_configs = {}
+    for var, variable_config in variable_configs.items():
+        bucket_configs.setdefault(variable_config["s3"][timeperiod]["bucket_name"], {})[var] = variable_config
+
+    plan = {"mode": "download", "created": datetime.datetime.utcnow().isoformat(), "timeperiod": timeperiod, "sync": sync,
+            "stream_decompress": stream_decompress, "buckets": {}, "items": []}
+    with count_requests(s3) as planning_requests:
+        for bucket_name, configs in bucket_configs.items():
+            targets = [(config["s3"][timeperiod]["obj_name_start"].format(date = single_date, time = ""),
+                        config["local"][timeperiod]["path"],
+                        config["s3"][timeperiod].get("bbox"))
+                       for config in configs.values() for single_date in dates]
+
+            # Local directories shared with variables without subset get
+            # whole granules
+            subset_variables = {}
+            if subset:
+                for config in configs.values():
+                    outpath = config["local"][timeperiod]["path"]
+                    variables = config["s3"][timeperiod].get("subset_variables")
+                    if not variables or subset_variables.get(outpath, []) is None:
+                        subset_variables[outpath] = None
+                    else:
+                        subset_variables[outpath] = sorted(set(subset_variables.get(outpath, [])) | set(variables))
+
+            selected = download_tropomi.select_keys(s3, bucket_name, targets, inventory)
+            for outpath, outpath_selected in selected.items():
+                outpath_selected["keys"] = [_key_record(key) for key in outpath_selected["keys"]]
+                for key in outpath_selected["keys"]:
+                    present = (sync or check_present) and \
+                        download_tropomi.is_unchanged(key, outpath, stream_decompress, checksum,
+                                                      bool(subset_variables.get(outpath)))
+                    plan["items"].append({"bucket": bucket_name, "outpath": outpath, "name": key['Key'],
+                                          "size": key['Size'], "present": present,
+                                          "transfer": not (sync and present),
+                                          "requests": download_requests(key['Size'], resume)})
+            plan["buckets"][bucket_name] = {"selected": selected, "subset_variables": subset_variables}
+    plan["planning_requests"] = planning_requests
+
+    return plan
+
+
+def plan_uploads(s3, variable_configs, timeperiod, dates, sync = False, checksum = False,
+                 stream_compress = False, resume = False, check_present = True):
+    """ Find local files of variables and dates to upload and check which
+    are already present in S3.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of upload configurations by variable name
+    timeperiod -- which configuration parameters to use, options day|month|year
+    dates -- list of dates to upload
+    sync -- if True, files present in S3 are not uploaded
+    checksum -- if True, compare files with S3 ETag
+    stream_compress -- if True, data files are compressed while uploading
+    resume -- if True, files are uploaded with resumable uploads
+    check_present -- if True, check which files are present in S3 with
+    HEAD requests, always checked in sync
+
+    Return:
+    plan -- transfer plan
+    """
+    plan = {"mode": "upload", "created": datetime.datetime.utcnow().isoformat(), "timeperiod": timeperiod, "sync": sync,
+            "stream_compress": stream_compress, "items": []}
+    with count_requests(s3) as planning_requests:
+        for var, variable_config in variable_configs.items():
+            bucket_name = variable_config["s3"][timeperiod]["bucket_name"]
+            local_config = variable_config["local"][timeperiod]
+            for single_date in dates:
+                files = []
+                if local_config.get("datafile"):
+                    datafile = f'{local_config["path"]}/{local_config["datafile"].format(date = single_date)}'
+                    extension = compression.CODEC_EXTENSIONS[local_config.get("compression", "gzip")]
+                    files.append((datafile, f'{os.path.basename(datafile)}{extension}', f'{datafile}{extension}',
+                                  stream_compress and not resume))
+                imagefile = f'{local_config["path"]}/{local_config["imagefile"].format(date = single_date)}'
+                files.append((imagefile, os.path.basename(imagefile), None, False))
+
+                for filename, objectname, compressed_file, multipart in files:
+                    if not os.path.exists(filename):
+                        logger.warning(f'File {filename} not found, not uploaded')
+                        continue
+                    size = os.path.getsize(filename)
+                    transfer_size, estimated = upload_size(filename, compressed_file)
+                    present = (sync or check_present) and \
+                        s3_sync.is_uploaded(s3, bucket_name, objectname, filename, checksum)
+                    plan["items"].append({"var": var, "date": single_date, "bucket": bucket_name,
+                                          "name": filename, "objectname": objectname, "size": size,
+                                          "transfer_size": transfer_size, "estimated": estimated,
+                                          "present": present, "transfer": not (sync and present),
+                                          "requests": upload_requests(transfer_size, multipart, resume)})
+    plan["planning_requests"] = planning_requests
+
+    return plan
+
+
+def plan_search(s3, variable_configs, product, dates, inventory = None):
+    """ Search dates of variables in S3 buckets. Searching is done while
+    planning, and executing the plan writes the found dates.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of search configurations by variable name
+    product -- Options: l2 | l3_day | l3_month | l3_year
+    dates -- list of dates to search
+    inventory -- bucket inventory to search instead of S3 listing (optional)
+
+    Return:
+    plan -- transfer plan
+    """
+    with count_requests(s3) as planning_requests:
+        found_dates = search_for_dates_in_bucket.search_variables(s3, variable_configs, product, dates, inventory)
+    return {"mode": "search", "created": datetime.datetime.utcnow().isoformat(), "product": product,
+            "found_dates": found_dates, "items": [], "planning_requests": planning_requests}
+
+
+def log_plan(plan):
+    """ Log summary of transfer plan.
+    """
+    summary = plan["summary"]
+    planning_requests = ", ".join(f'{n} {name}' for name, n in sorted(summary["planning_requests"].items())) or "none"
+    logger.info(f'Planning {plan["mode"]} made requests: {planning_requests}')
+    if plan["mode"] == "search":
+        for var, var_dates in sorted(plan["found_dates"].items()):
+            logger.info(f'{var}: found {len(var_dates)} dates')
+        return
+
+    requests = ", ".join(f'{n} {name}' for name, n in sorted(summary["requests"].items())) or "none"
+    logger.info(f'Plan: {summary["objects"]} files, {summary["bytes"] / 1e6:.1f} MB, '
+                f'{summary["present_objects"]} files, {summary["present_bytes"] / 1e6:.1f} MB already present')
+    logger.info(f'Plan: transfer {summary["transfer_objects"]} files, {summary["transfer_bytes"] / 1e6:.1f} MB '
+                f'with requests: {requests}, estimated duration {summary["estimated_duration_s"]:.0f} s')
+    if summary.get("estimated_objects"):
+        logger.info(f'Plan: {summary["estimated_objects"]} data files are not compressed yet, '
+                    f'their uncompressed size is counted as upper bound')
+
+
+def write_plan(plan, plan_file):
+    """ Write transfer plan in JSON file.
+    """
+    with open(plan_file, 'w') as jsonfile:
+        json.dump(plan, jsonfile, indent = 1)
+
+
+def read_plan(plan_file):
+    """ Read transfer plan from JSON file.
+    """
+    with open(plan_file, 'r') as jsonfile:
+        return json.load(jsonfile)
+
+
+def plan_tasks(s3, plan, variable_configs = None, datelist_dir = ".", workers = 1,
+               resume = False, confirm_footprint = False):
+    """ Get tasks executing transfer plan without listing again. Downloads
+    get one task per bucket, uploads one task per variable and date, and
+    searches one task per variable.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    plan -- transfer plan
+    variable_configs -- dictionary of upload configurations by variable name
+    datelist_dir -- directory for lists of found dates
+    workers -- number of parallel transfers of each task
+    resume -- if True, continue interrupted transfers and retry failures
+    confirm_footprint -- if True, remove downloaded files selected only by
+    bounding boxes if their footprint does not intersect
+
+    Return:
+    tasks -- dictionary of task functions without arguments by task name
+    """
+    tasks = {}
+    if plan["mode"] == "download":
+        transfer = {(item["bucket"], item["outpath"], item["name"]) for item in plan["items"] if item["transfer"]}
+        for bucket_name, bucket_plan in plan["buckets"].items():
+            selected = {outpath: {"keys": [key for key in outpath_selected["keys"]
+                                           if (bucket_name, outpath, key['Key']) in transfer],
+                                  "bboxes": outpath_selected["bboxes"]}
+                        for outpath, outpath_selected in bucket_plan["selected"].items()}
+            tasks[f'download {bucket_name}'] = partial(
+                download_tropomi.download_selected, s3, bucket_name, selected,
+                workers = workers, stream_decompress = plan["stream_decompress"], resume = resume,
+                confirm_footprint = confirm_footprint, subset_variables = bucket_plan["subset_variables"])
+
+    elif plan["mode"] == "upload":
+        var_date_files = {}
+        for item in plan["items"]:
+            if item["transfer"]:
+                var_date_files.setdefault((item["var"], item["date"]), []).append(item["name"])
+        for (var, single_date), files in var_date_files.items():
+            tasks[f'upload {var} {single_date}'] = partial(
+                upload_tropomi.upload_variable, s3, variable_configs[var], plan["timeperiod"], single_date,
+                stream_compress = plan["stream_compress"], resume = resume, files = files)
+
+    else:
+        for var, var_dates in plan["found_dates"].items():
+            tasks[f'search {var}'] = partial(_write_datelist, f'{datelist_dir}/{var}_{plan["product"]}.txt', var_dates)
+
+    return tasks
+
+
+def _write_datelist(datelist_file, dates):
+    """ Write dates in file, one per line.
+    """
+    with open(datelist_file, 'w') as outfile_datelist:
+        for single_date in dates:
+            outfile_datelist.write(f"{single_date}\n")
@@ -5,12 +5,27 @@ import datetime
 import logging
 import time
 import os
-import gzip
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
 
+import compression
+import s3_sync
+import resumable
+import scheduler
+import metrics
+import integrity
+
+# Streaming compressed upload: size of uploaded parts. Parts other than
+# the last one have to be at least 5 MB.
+PART_SIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+
+logger = logging.getLogger("logger")
+
 
 def create_s3_client(s3_config_file):
     """ Create S3 client to be used for downloading files.
@@ -25,23 +40,25 @@ def create_s3_client(s3_config_file):
     # Read S3 config file
     logger.debug(f'Reading S3 config file {s3_config_file}')
     try:
-        with open(s3_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(s3_config_file, "r") as jsonfile:
             s3_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the S3 configuration file {s3_config_file}')
         logger.error(e)
 
     # Create S3 client
-    s3 = boto3.client("s3",
-                      aws_access_key_id = s3_config['aws_access_key_id'],
-                      aws_secret_access_key = s3_config['aws_secret_access_key'],
-                      endpoint_url = s3_config['endpoint_url']
-    )
-    
+    with metrics.timer("client"):
+        s3 = boto3.client("s3",
+                          aws_access_key_id = s3_config['aws_access_key_id'],
+                          aws_secret_access_key = s3_config['aws_secret_access_key'],
+                          endpoint_url = s3_config['endpoint_url']
+        )
+    metrics.instrument(s3)
+
     return s3
 
 
-def upload_file(s3, filename, bucketname, objectname=None):
+def upload_file(s3, filename, bucketname, objectname=None, metadata=None, resume=False):
     """Upload file to an S3 bucket.
 
     Keyword arguments:
@@ -49,19 +66,262 @@ def upload_file(s3, filename, bucketname, objectname=None):
     filename -- File to upload
     bucketname -- Bucket to upload to
     objectname -- S3 object name. If not specified then filename is used
+    metadata -- S3 object metadata dictionary (optional)
+    resume -- if True, continue interrupted upload and retry failures
+
+    Return:
+    n_bytes -- number of uploaded bytes, None if upload failed
     """
 
     # If S3 object_name was not specified, use file_name
     if objectname is None:
         objectname = os.path.basename(filename)
 
-    # Upload the file
-    logger.debug(f'Uploading file {filename} to s3://{bucketname}')
+    # With verification S3 checks the checksum of each request
+    extra_args = {'Metadata': metadata} if metadata else {}
+    if integrity.settings["enabled"]:
+        extra_args['ChecksumAlgorithm'] = integrity.TRANSFER_CHECKSUM
+
+    with scheduler.transfer_slot(), metrics.timer("upload", bucket = bucketname):
+        if resume:
+            logger.debug(f'Uploading file {filename} to s3://{bucketname} as resumable upload')
+            try:
+                resumable.upload_resumable(s3, filename, bucketname, objectname, metadata)
+            except ClientError as e:
+                logger.error(f'Error while uploading file {filename} to s3://{bucketname}')
+                logger.error(e)
+                return None
+        else:
+            # Upload the file
+            logger.debug(f'Uploading file {filename} to s3://{bucketname}')
+            try:
+                s3.upload_file(filename, bucketname, objectname,
+                               ExtraArgs = extra_args or None,
+                               Callback = scheduler.bandwidth_callback())
+            except (ClientError, S3UploadFailedError) as e:
+                logger.error(f'Error while uploading file {filename} to s3://{bucketname}')
+                logger.error(e)
+                return None
+
+    n_bytes = os.path.getsize(filename)
+    metrics.add("uploaded_bytes", n_bytes, bucket = bucketname)
+    metrics.add("uploaded_objects", bucket = bucketname)
+
+    return n_bytes
+
+
+def compressed_parts(filename, codec = "gzip", compresslevel = None, part_size = PART_SIZE, digest = None):
+    """ Generator function for compressing file in multipart upload parts
+
+    Keyword arguments:
+    filename -- File to compress
+    codec -- Options: gzip | pgzip | zstd
+    compresslevel -- compression level, codec default if not given
+    part_size -- minimum size of yielded parts, except the last one
+    digest -- hash object updated with the uncompressed data (optional)
+
+    Yield:
+    compressed data parts
+    """
+    buffer = bytearray()
+    n_parts = 0
+    with open(filename, 'rb') as f_in:
+        for data in compression.compress_chunks(f_in, codec, compresslevel, digest = digest):
+            buffer += data
+            if len(buffer) >= part_size:
+                yield bytes(buffer)
+                n_parts += 1
+                buffer.clear()
+
+    # Empty last part is rejected, but an empty file needs one part
+    if buffer or n_parts == 0:
+        yield bytes(buffer)
+
+
+def upload_file_compress_stream(s3, filename, bucketname, objectname=None, codec = "gzip", compresslevel = None,
+                                metadata=None):
+    """Compress file in chunks and upload the chunks as multipart upload to
+    an S3 bucket without writing compressed file to disk. Uploading of parts
+    overlaps with compressing the following parts.
+
+    Keyword arguments:
+    s3 -- S3 client
+    filename -- File to compress and upload
+    bucketname -- Bucket to upload to
+    objectname -- S3 object name. If not specified then filename with codec extension is used
+    codec -- Options: gzip | pgzip | zstd
+    compresslevel -- compression level, codec default if not given
+    metadata -- S3 object metadata dictionary (optional)
+
+    Return:
+    n_bytes -- number of uploaded compressed bytes, None if upload failed
+    """
+
+    # If S3 object_name was not specified, use file_name
+    if objectname is None:
+        objectname = f'{os.path.basename(filename)}{compression.CODEC_EXTENSIONS[codec]}'
+
+    logger.debug(f'Compressing with {codec} and uploading file {filename} to s3://{bucketname}')
     try:
-        s3.upload_file(filename, bucketname, objectname)
+        upload_id = s3.create_multipart_upload(Bucket=bucketname, Key=objectname,
+                                               Metadata={**(metadata or {}), compression.METADATA_KEY: codec})['UploadId']
     except ClientError as e:
         logger.error(f'Error while uploading file {filename} to s3://{bucketname}')
         logger.error(e)
+        return None
+
+    # Limit number of compressed parts waiting for upload
+    slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY * 2)
+
+    def upload_part(part_number, data):
+        try:
+            scheduler.throttle(len(data))
+            checksum = {'ContentMD5': integrity.content_md5(data)} if integrity.settings["enabled"] else {}
+            response = s3.upload_part(Bucket=bucketname, Key=objectname, UploadId=upload_id,
+                                      PartNumber=part_number, Body=data, **checksum)
+        finally:
+            slots.release()
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    n_bytes = 0
+    digest = integrity.new_digest() if integrity.settings["enabled"] else None
+    try:
+        with scheduler.transfer_slot(), metrics.timer("upload", bucket = bucketname, codec = codec), \
+                ThreadPoolExecutor(max_workers = UPLOAD_CONCURRENCY) as pool:
+            futures = []
+            for part_number, data in enumerate(compressed_parts(filename, codec, compresslevel, digest = digest),
+                                               start = 1):
+                slots.acquire()
+                n_bytes += len(data)
+                futures.append(pool.submit(upload_part, part_number, data))
+            parts = [future.result() for future in futures]
+        s3.complete_multipart_upload(Bucket=bucketname, Key=objectname, UploadId=upload_id,
+                                     MultipartUpload={'Parts': parts})
+    except Exception as e:
+        logger.error(f'Error while uploading file {filename} to s3://{bucketname}')
+        logger.error(e)
+        s3.abort_multipart_upload(Bucket=bucketname, Key=objectname, UploadId=upload_id)
+        return None
+
+    # Source digest is known only after the upload, so it is added to the
+    # metadata afterwards
+    if digest is not None:
+        try:
+            integrity.store_source_digest(s3, bucketname, objectname,
+                                          {**(metadata or {}), compression.METADATA_KEY: codec,
+                                           integrity.metadata_key(integrity.settings["algorithm"]): digest.hexdigest()},
+                                          n_bytes)
+        except ClientError as e:
+            logger.error(f'Error while storing digest of file {filename} in s3://{bucketname}')
+            logger.error(e)
+
+    metrics.add("uploaded_bytes", n_bytes, bucket = bucketname)
+    metrics.add("uploaded_objects", bucket = bucketname)
+
+    return n_bytes
+
+
+def upload_variable(s3, variable_config, timeperiod, date, stream_compress = False, sync = False, checksum = False,
+                    resume = False, files = None):
+    """Upload data file and image file of given date to an S3 bucket.
+
+    Keyword arguments:
+    s3 -- S3 client
+    variable_config -- upload configuration of variable
+    timeperiod -- which configuration parameters to use, options day|month|year
+    date -- date to upload
+    stream_compress -- if True, data file is compressed while uploading
+    sync -- if True, upload only new or changed files
+    checksum -- if True, compare files with S3 ETag in sync
+    resume -- if True, continue interrupted uploads and retry failures.
+    Streaming compression can not be resumed, so data file is compressed
+    on disk first.
+    files -- local files to upload, other files are skipped as unchanged,
+    None uploads both files (optional)
+    """
+    bucket_name = variable_config["s3"][timeperiod]["bucket_name"]
+    local_config = variable_config["local"][timeperiod]
+    uploaded_bytes = 0
+    uploaded_files = []
+    skipped_files = []
+    missing_files = []
+    failed_files = []
+
+    if local_config["datafile"]:
+        datafile = f'{local_config["path"]}/{local_config["datafile"].format(date = date)}'
+        codec = local_config.get("compression", "gzip")
+        compresslevel = local_config.get("compresslevel")
+        objectname = f'{os.path.basename(datafile)}{compression.CODEC_EXTENSIONS[codec]}'
+        if files is not None and datafile not in files:
+            logger.debug(f'Skipping unchanged file {datafile}')
+            skipped_files.append(datafile)
+        elif not os.path.exists(datafile):
+            logger.warning(f'File {datafile} not found, not uploaded')
+            missing_files.append(datafile)
+        elif sync and s3_sync.is_uploaded(s3, bucket_name, objectname, datafile, checksum):
+            logger.debug(f'Skipping unchanged file {datafile}')
+            skipped_files.append(datafile)
+        elif stream_compress and not resume:
+            # Compress data file while uploading to S3
+            n_bytes = upload_file_compress_stream(s3, datafile, bucket_name, objectname, codec = codec,
+                                                  compresslevel = compresslevel,
+                                                  metadata = s3_sync.source_metadata(datafile))
+            if n_bytes is None:
+                failed_files.append(datafile)
+            else:
+                uploaded_bytes += n_bytes
+                uploaded_files.append(datafile)
+        else:
+            # Compress data file before uploading
+            datafile_compressed = f'{datafile}{compression.CODEC_EXTENSIONS[codec]}'
+            metadata = s3_sync.source_metadata(datafile)
+            digest = integrity.new_digest() if integrity.settings["enabled"] else None
+            try:
+                with metrics.timer("compress", codec = codec):
+                    compression.compress_file(datafile, datafile_compressed, codec, compresslevel, digest = digest)
+            except Exception as e:
+                logger.error(f'Error while compressing file {datafile}')
+                logger.error(e)
+                failed_files.append(datafile)
+            else:
+                if digest is not None:
+                    metadata[integrity.metadata_key(integrity.settings["algorithm"])] = digest.hexdigest()
+                # Upload data file to S3
+                n_bytes = upload_file(s3, datafile_compressed, bucket_name, objectname,
+                                      metadata = {**metadata, compression.METADATA_KEY: codec},
+                                      resume = resume)
+                if n_bytes is None:
+                    failed_files.append(datafile)
+                else:
+                    uploaded_bytes += n_bytes
+                    uploaded_files.append(datafile)
+    
+    # Upload image file to S3
+    imagefile = f'{local_config["path"]}/{local_config["imagefile"].format(date = date)}'
+    if files is not None and imagefile not in files:
+        logger.debug(f'Skipping unchanged file {imagefile}')
+        skipped_files.append(imagefile)
+    elif not os.path.exists(imagefile):
+        logger.warning(f'File {imagefile} not found, not uploaded')
+        missing_files.append(imagefile)
+    elif sync and s3_sync.is_uploaded(s3, bucket_name, os.path.basename(imagefile), imagefile, checksum):
+        logger.debug(f'Skipping unchanged file {imagefile}')
+        skipped_files.append(imagefile)
+    else:
+        n_bytes = upload_file(s3, imagefile, bucket_name, metadata = s3_sync.source_metadata(imagefile),
+                              resume = resume)
+        if n_bytes is None:
+            failed_files.append(imagefile)
+        else:
+            uploaded_bytes += n_bytes
+            uploaded_files.append(imagefile)
+
+    # Data files are reported with their compressed size as sent
+    if sync or files is not None:
+        skipped_bytes = sum(os.path.getsize(filename) for filename in skipped_files if os.path.exists(filename))
+        logger.info(f'Uploaded {len(uploaded_files)} files, {uploaded_bytes / 1e6:.1f} MB sent, '
+                    f'skipped {len(skipped_files)} unchanged files, {skipped_bytes / 1e6:.1f} MB, '
+                    f'{len(missing_files)} files not found, {len(failed_files)} failed')
 
 
 def main():
@@ -74,32 +334,23 @@ def main():
     variable_config_file = f"conf/upload/{options.var}.json"
     logger.debug(f'Reading config file {variable_config_file}')
     try:
-        with open(variable_config_file, "r") as jsonfile:
+        with metrics.timer("config"), open(variable_config_file, "r") as jsonfile:
             variable_config = json.load(jsonfile)
     except Exception as e:
         logger.error(f'Error while reading the configuration file {variable_config_file}')
         logger.error(e)
-    
-    bucket_name = variable_config["s3"][options.timeperiod]["bucket_name"]
 
-    if variable_config["local"][options.timeperiod]["datafile"]:
-        # Gzip data file before uploading
-        datafile = f'{variable_config["local"][options.timeperiod]["path"]}/{variable_config["local"][options.timeperiod]["datafile"].format(date = options.date)}'
-        datafile_gzip = f'{datafile}.gz'
-        logger.debug(f'Gzipping file {datafile}')
-        try:
-            with open(datafile, 'rb') as f_in:
-                with gzip.open(datafile_gzip, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-        except Exception as e:
-            logger.error(f'Error while gzipping file {datafile}')
-            logger.error(e)
-        # Upload data file to S3
-        upload_file(s3, datafile_gzip, bucket_name)
+    # Schedule transfers together with other jobs on the host
+    if options.schedule or options.bandwidth:
+        scheduler.configure(options.priority or scheduler.priority_from_name(options.var),
+                            bandwidth = options.bandwidth * 1e6 if options.bandwidth else None)
+
+    # Verify transfers with checksums computed while transferring
+    if options.verify:
+        integrity.configure(options.digest_algorithm)
     
-    # Upload image file to S3
-    imagefile = f'{variable_config["local"][options.timeperiod]["path"]}/{variable_config["local"][options.timeperiod]["imagefile"].format(date = options.date)}'
-    upload_file(s3, imagefile, bucket_name)
+    upload_variable(s3, variable_config, options.timeperiod, options.date, options.stream_compress,
+                    sync = options.sync, checksum = options.checksum, resume = options.resume)
 
 
 if __name__ == '__main__':                                                      
@@ -117,6 +368,47 @@ if __name__ == '__main__':
                         type = str,
                         default = 'day',
                         help = 'Time period to upload. Options: day|month')
+    parser.add_argument('--stream_compress',
+                        action = 'store_true',
+                        help = 'Compress data file while uploading without writing compressed file to disk.')
+    parser.add_argument('--sync',
+                        action = 'store_true',
+                        help = 'Upload only new or changed files.')
+    parser.add_argument('--checksum',
+                        action = 'store_true',
+                        help = 'Compare file content with S3 ETag in sync instead of size and modification time.')
+    parser.add_argument('--resume',
+                        action = 'store_true',
+                        help = 'Continue interrupted multipart uploads and retry failed requests. Streaming compression can not be resumed, so data files are compressed on disk first.')
+    parser.add_argument('--verify',
+                        action = 'store_true',
+                        help = 'Send checksums with uploads and store digest of uncompressed data file in object metadata.')
+    parser.add_argument('--digest_algorithm',
+                        type = str,
+                        default = 'sha256',
+                        help = 'Digest of uncompressed content stored in object metadata with verify. Options: md5, sha256, crc32c')
+    parser.add_argument('--schedule',
+                        action = 'store_true',
+                        help = 'Share transfer slots and bandwidth with other scheduled jobs on the host by priority.')
+    parser.add_argument('--priority',
+                        type = str,
+                        default = None,
+                        help = 'Priority class of transfers. Options: nrti|offl|rpro, default from stream in variable name.')
+    parser.add_argument('--bandwidth',
+                        type = float,
+                        default = None,
+                        help = 'Bandwidth limit of all scheduled transfers on the host in MB/s, implies --schedule.')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
     parser.add_argument('--loglevel',
                         default='info',
                         help='minimum severity of logged messages,\
@@ -138,4 +430,5 @@ if __name__ == '__main__':
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
     
-    main()
+    metrics.run(main, "upload_tropomi", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile)
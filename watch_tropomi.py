@@ -0,0 +1,471 @@
+import argparse
+import json
+import datetime
+import logging
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+import compression
+import bucket_inventory
+import s3_listing
+import download_tropomi
+import upload_tropomi
+import search_for_dates_in_bucket
+import scheduler
+import granule_cache
+import region_filter
+import integrity
+import metrics
+from batch_tropomi import S3_CONFIG_FILES, find_variable_configs
+
+# Seconds between polls of buckets and local directories
+POLL_INTERVAL = 60
+
+# First poll lists granules sensed during the last hours
+LOOKBACK_HOURS = 24
+
+# Granules may arrive out of sensing time order, so each poll lists again
+# the granules sensed during the last minutes before the newest granule
+OVERLAP_MINUTES = 60
+
+# Local files modified during the last seconds may still be written
+SETTLE_SECONDS = 10
+
+logger = logging.getLogger("logger")
+
+
+def write_latency(latency_file, record):
+    """ Log end-to-end latency of a granule and append it as JSON line to
+    latency file.
+
+    Keyword arguments:
+    latency_file -- JSON lines outfile, None to only log
+    record -- dictionary describing transferred granule
+    """
+    logger.info(f'{record["mode"]} {record["name"]} latency {record["latency_s"]:.0f} s')
+    if latency_file:
+        with open(latency_file, 'a') as outfile:
+            outfile.write(json.dumps(record) + "\n")
+
+
+def download_granule(s3, bucket_name, key, outpaths, stream_decompress = False, resume = False):
+    """ Download S3 object into local directories and unpack it.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    key -- S3 object description from listing
+    outpaths -- list of local directories
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    resume -- if True, continue interrupted downloads and retry failures
+    """
+    for outpath in outpaths:
+        if download_tropomi.is_unchanged(key, outpath, stream_decompress):
+            continue
+        local_file = download_tropomi.download_object(s3, bucket_name, key, outpath,
+                                                      stream_decompress = stream_decompress, resume = resume)
+        if compression.codec_from_filename(local_file):
+            download_tropomi.decompress_file(local_file)
+
+
+def poll_bucket(s3, bucket_name, prefix, state):
+    """ List new objects of bucket after the last listed key. Objects
+    sensed within OVERLAP_MINUTES before the newest object are listed again
+    and objects already seen are skipped.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    bucket_name -- S3 bucket name
+    prefix -- filename beginning right before the sensing time
+    state -- dictionary with start_after key and set of seen keys, updated
+
+    Return:
+    keys -- list of new S3 object descriptions
+    """
+    keys = [key for key in s3_listing.list_objects_sharded(s3, bucket_name, prefix, start_after = state["start_after"])
+            if key['Key'] not in state["seen"]]
+    if not keys:
+        return keys
+
+    newest_key = max(key['Key'] for key in keys)
+    times = bucket_inventory.sensing_times(newest_key)
+    if times:
+        state["start_after"] = f"{prefix}{(times[0] - datetime.timedelta(minutes = OVERLAP_MINUTES)).strftime(bucket_inventory.SENSING_TIME_FORMAT)}"
+    else:
+        state["start_after"] = newest_key
+    state["seen"] = {name for name in state["seen"] | {key['Key'] for key in keys} if name > state["start_after"]}
+
+    return keys
+
+
+def finish_download(future, bucket_name, key, target, latency_file = None):
+    """ Record latency of finished granule download. Failed granules are
+    forgotten, so they are downloaded again in the next poll if they are
+    still inside the overlap.
+
+    Keyword arguments:
+    future -- finished future of download_granule
+    bucket_name -- S3 bucket name
+    key -- S3 object description from listing
+    target -- polling state of bucket and prefix, updated
+    latency_file -- JSON lines outfile for latency of each granule (optional)
+    """
+    try:
+        future.result()
+    except Exception as e:
+        logger.error(f'Error while downloading file {key["Key"]}')
+        logger.error(e)
+        target["seen"].discard(key['Key'])
+        return
+    finished = datetime.datetime.now(datetime.timezone.utc)
+    last_modified = key['LastModified']
+    times = bucket_inventory.sensing_times(key['Key'])
+    write_latency(latency_file, {
+        "mode": "download",
+        "bucket": bucket_name,
+        "name": key['Key'],
+        "sensing_end": times[1].isoformat() if times else None,
+        "last_modified": last_modified.isoformat(),
+        "finished": finished.isoformat(),
+        "latency_s": (finished - (times[1] if times else last_modified)).total_seconds(),
+        "delivery_s": (finished - last_modified).total_seconds()})
+
+
+def watch_downloads(s3, variable_configs, interval = POLL_INTERVAL, workers = 4, stream_decompress = False,
+                    resume = False, latency_file = None, max_polls = None):
+    """ Poll buckets of variables and download new granules as soon as they
+    appear. Variables sharing a bucket and filename beginning are polled
+    together. Granules are skipped if all variables of the bucket have
+    bounding boxes and the granule can not cover any of them.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of download configurations by variable name
+    interval -- seconds between polls
+    workers -- number of parallel downloads
+    stream_decompress -- if True, compressed objects are unpacked while downloading
+    resume -- if True, continue interrupted downloads and retry failures
+    latency_file -- JSON lines outfile for latency of each granule (optional)
+    max_polls -- stop after number of polls, None polls forever
+    """
+    start_after = (datetime.datetime.utcnow() - datetime.timedelta(hours = LOOKBACK_HOURS)).strftime(bucket_inventory.SENSING_TIME_FORMAT)
+    watched = {}
+    for variable_config in variable_configs.values():
+        bucket_name = variable_config["s3"]["day"]["bucket_name"]
+        prefix = s3_listing.get_pattern_prefix(variable_config["s3"]["day"]["obj_name_start"].split("{")[0])
+        target = watched.setdefault((bucket_name, prefix), {"outpaths": [], "start_after": f"{prefix}{start_after}",
+                                                            "seen": set(), "bboxes": []})
+        if variable_config["local"]["day"]["path"] not in target["outpaths"]:
+            target["outpaths"].append(variable_config["local"]["day"]["path"])
+        if target["bboxes"] is not None:
+            bbox = variable_config["s3"]["day"].get("bbox")
+            target["bboxes"] = target["bboxes"] + [bbox] if bbox else None
+
+    # Downloads run in the background while polling continues, so a slow
+    # granule does not delay finding new ones
+    n_polls = 0
+    futures = {}
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        while max_polls is None or n_polls < max_polls:
+            poll_time = time.time()
+            for (bucket_name, prefix), target in watched.items():
+                try:
+                    keys = poll_bucket(s3, bucket_name, prefix, target)
+                except Exception as e:
+                    logger.error(f'Error while polling bucket {bucket_name}')
+                    logger.error(e)
+                    continue
+                logger.debug(f'Found {len(keys)} new objects with prefix {prefix} in bucket {bucket_name}')
+                if target["bboxes"]:
+                    keys = [key for key in keys
+                            if any(region_filter.granule_can_cross(key['Key'], bbox) for bbox in target["bboxes"])]
+                for key in keys:
+                    futures[pool.submit(download_granule, s3, bucket_name, key, target["outpaths"],
+                                        stream_decompress, resume)] = (bucket_name, prefix, key)
+            n_polls += 1
+
+            # Finished downloads are recorded until the next poll, after
+            # the last poll all downloads are waited for
+            next_poll = poll_time + interval if max_polls is None or n_polls < max_polls else None
+            while futures:
+                timeout = None if next_poll is None else max(0, next_poll - time.time())
+                done, _ = wait(futures, timeout = timeout, return_when = FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    bucket_name, prefix, key = futures.pop(future)
+                    finish_download(future, bucket_name, key, watched[(bucket_name, prefix)], latency_file)
+            if next_poll is not None:
+                time.sleep(max(0, next_poll - time.time()))
+
+
+def changed_dates(variable_config, mtimes):
+    """ Find dates of settled local files which are new or modified since
+    last check.
+
+    Keyword arguments:
+    variable_config -- upload configuration of variable
+    mtimes -- dictionary of handled modification times by path, updated
+
+    Return:
+    dates -- dictionary of newest modification time by date
+    """
+    local_config = variable_config["local"]["day"]
+    regexes = [search_for_dates_in_bucket.template_to_regex(local_config[name], search_for_dates_in_bucket.DATE_DIGITS["l3_day"])
+               for name in ("datafile", "imagefile") if local_config.get(name)]
+    now = time.time()
+    dates = {}
+    for entry in os.scandir(local_config["path"]):
+        matches = [match for match in (regex.fullmatch(entry.name) for regex in regexes) if match]
+        if not matches:
+            continue
+        match = matches[0]
+        mtime = entry.stat().st_mtime
+        if mtimes.get(entry.path) == mtime or now - mtime < SETTLE_SECONDS:
+            continue
+        mtimes[entry.path] = mtime
+        dates[match.group('date')] = max(mtime, dates.get(match.group('date'), 0))
+
+    return dates
+
+
+def is_complete(variable_config, date):
+    """ Check if data file and image file of date both exist.
+    """
+    local_config = variable_config["local"]["day"]
+    return all(os.path.exists(f'{local_config["path"]}/{local_config[name].format(date = date)}')
+               for name in ("datafile", "imagefile") if local_config.get(name))
+
+
+def wait_for_changes(inotify, timeout):
+    """ Wait until files are written in watched directories or timeout.
+
+    Keyword arguments:
+    inotify -- INotify instance watching local directories, None to sleep
+    timeout -- maximum number of seconds to wait
+    """
+    if inotify is None:
+        time.sleep(timeout)
+        return
+    events = inotify.read(timeout = int(timeout * 1000), read_delay = SETTLE_SECONDS * 1000)
+    logger.debug(f'Received {len(events)} file events')
+
+
+def watch_uploads(s3, variable_configs, interval = POLL_INTERVAL, stream_compress = False, resume = False,
+                  latency_file = None, max_polls = None):
+    """ Watch local directories of variables and upload new or changed data
+    file and image file pairs as soon as both are written. Directories are
+    watched with inotify if inotify_simple is installed, otherwise polled.
+
+    Keyword arguments:
+    s3 -- boto3 S3 client
+    variable_configs -- dictionary of upload configurations by variable name
+    interval -- seconds between polls
+    stream_compress -- if True, data file is compressed while uploading
+    resume -- if True, continue interrupted uploads and retry failures
+    latency_file -- JSON lines outfile for latency of each upload (optional)
+    max_polls -- stop after number of polls, None polls forever
+    """
+    inotify = None
+    if INotify is not None:
+        inotify = INotify()
+        for path in {variable_config["local"]["day"]["path"] for variable_config in variable_configs.values()}:
+            inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO)
+    else:
+        logger.debug(f'inotify_simple not installed, polling directories every {interval} s')
+
+    # Files modified before the lookback period are not uploaded again
+    lookback_time = time.time() - LOOKBACK_HOURS * 3600
+    mtimes = {}
+    for variable_config in variable_configs.values():
+        path = variable_config["local"]["day"]["path"]
+        mtimes.update({entry.path: entry.stat().st_mtime for entry in os.scandir(path)
+                       if entry.stat().st_mtime < lookback_time})
+
+    n_polls = 0
+    pending = {}
+    while max_polls is None or n_polls < max_polls:
+        for var, variable_config in variable_configs.items():
+            try:
+                for date, mtime in changed_dates(variable_config, mtimes).items():
+                    pending[(var, date)] = max(mtime, pending.get((var, date), 0))
+            except OSError as e:
+                logger.error(f'Error while scanning directory of variable {var}')
+                logger.error(e)
+
+        for (var, date), mtime in list(pending.items()):
+            if not is_complete(variable_configs[var], date):
+                continue
+            del pending[(var, date)]
+            try:
+                upload_tropomi.upload_variable(s3, variable_configs[var], "day", date,
+                                               stream_compress = stream_compress, sync = True, resume = resume)
+            except Exception as e:
+                logger.error(f'Error while uploading {var} {date}')
+                logger.error(e)
+                continue
+            finished = time.time()
+            write_latency(latency_file, {
+                "mode": "upload",
+                "bucket": variable_configs[var]["s3"]["day"]["bucket_name"],
+                "name": f"{var} {date}",
+                "modified": datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).isoformat(),
+                "finished": datetime.datetime.fromtimestamp(finished, datetime.timezone.utc).isoformat(),
+                "latency_s": finished - mtime})
+
+        n_polls += 1
+        if max_polls is None or n_polls < max_polls:
+            wait_for_changes(inotify, interval)
+
+
+def main():
+
+    # Create one S3 client kept for the whole run
+    s3 = download_tropomi.create_s3_client(S3_CONFIG_FILES[options.mode],
+                                           max_pool_connections = max(10, options.workers * download_tropomi.TRANSFER_CONCURRENCY))
+
+    variable_configs = find_variable_configs(options.mode, options.vars.split(','))
+
+    # Serve downloads from local granule cache
+    if options.cache_dir:
+        granule_cache.configure(options.cache_dir,
+                                quota = options.cache_quota * 1e9 if options.cache_quota else None,
+                                policy = options.cache_policy,
+                                max_age = options.cache_max_age * 86400 if options.cache_max_age else None,
+                                link = options.cache_link)
+
+    # Schedule transfers together with other jobs on the host
+    if options.schedule or options.bandwidth:
+        scheduler.configure(options.priority or scheduler.lowest_priority(variable_configs),
+                            bandwidth = options.bandwidth * 1e6 if options.bandwidth else None)
+
+    # Verify transfers with checksums computed while transferring
+    if options.verify:
+        integrity.configure(options.digest_algorithm)
+    logger.info(f'Watching {len(variable_configs)} variables: {", ".join(sorted(variable_configs))}')
+
+    max_polls = options.max_polls or None
+    if options.mode == "download":
+        watch_downloads(s3, variable_configs, interval = options.interval, workers = options.workers,
+                        stream_decompress = options.stream_decompress, resume = options.resume,
+                        latency_file = options.latency_file, max_polls = max_polls)
+    else:
+        watch_uploads(s3, variable_configs, interval = options.interval, stream_compress = options.stream_compress,
+                      resume = options.resume, latency_file = options.latency_file, max_polls = max_polls)
+
+
+if __name__ == '__main__':
+    #Parse commandline arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode',
+                        type = str,
+                        choices = ['download', 'upload'],
+                        help = 'Watch buckets for new granules to download or local directories for new files to upload.')
+    parser.add_argument('--vars',
+                        type = str,
+                        default = '*-nrti',
+                        help = 'Comma separated list of Tropomi variables or globs (e.g. no2-nrti,ukraine-*-nrti).')
+    parser.add_argument('--interval',
+                        type = int,
+                        default = POLL_INTERVAL,
+                        help = 'Seconds between polls.')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 4,
+                        help = 'Number of parallel downloads.')
+    parser.add_argument('--stream_decompress',
+                        action = 'store_true',
+                        help = 'Unpack compressed files while downloading without storing the compressed file.')
+    parser.add_argument('--stream_compress',
+                        action = 'store_true',
+                        help = 'Compress data files while uploading without writing compressed file to disk.')
+    parser.add_argument('--resume',
+                        action = 'store_true',
+                        help = 'Continue interrupted transfers and retry failed requests. Uploads with stream_compress compress data files on disk first.')
+    parser.add_argument('--verify',
+                        action = 'store_true',
+                        help = 'Verify transfers with checksums computed while streaming, quarantine and retry failing downloads.')
+    parser.add_argument('--digest_algorithm',
+                        type = str,
+                        default = 'sha256',
+                        help = 'Digest of uncompressed content stored in object metadata with verify. Options: md5, sha256, crc32c')
+    parser.add_argument('--schedule',
+                        action = 'store_true',
+                        help = 'Share transfer slots and bandwidth with other scheduled jobs on the host by priority.')
+    parser.add_argument('--priority',
+                        type = str,
+                        default = None,
+                        help = 'Priority class of transfers. Options: nrti|offl|rpro, default from stream in least urgent variable.')
+    parser.add_argument('--bandwidth',
+                        type = float,
+                        default = None,
+                        help = 'Bandwidth limit of all scheduled transfers on the host in MB/s, implies --schedule.')
+    parser.add_argument('--cache_dir',
+                        type = str,
+                        default = None,
+                        help = 'Local granule cache directory shared by variables, downloaded files are linked from cache.')
+    parser.add_argument('--cache_quota',
+                        type = float,
+                        default = None,
+                        help = 'Maximum size of granule cache in GB.')
+    parser.add_argument('--cache_policy',
+                        type = str,
+                        default = 'lru',
+                        help = 'Which granules to evict first from cache. Options: lru|age')
+    parser.add_argument('--cache_max_age',
+                        type = float,
+                        default = None,
+                        help = 'Evict granules not used (lru) or cached (age) during this many days.')
+    parser.add_argument('--cache_link',
+                        type = str,
+                        default = 'hardlink',
+                        help = 'How cached granules are linked to local directories. Options: hardlink|symlink')
+    parser.add_argument('--latency_file',
+                        type = str,
+                        default = None,
+                        help = 'JSON lines outfile for end-to-end latency of each granule.')
+    parser.add_argument('--max_polls',
+                        type = int,
+                        default = 0,
+                        help = 'Stop after number of polls, 0 watches until stopped.')
+    parser.add_argument('--metrics_file',
+                        type = str,
+                        default = None,
+                        help = 'Outfile for metrics of run, .prom for Prometheus textfile, otherwise JSON lines.')
+    parser.add_argument('--metrics_format',
+                        type = str,
+                        default = None,
+                        help = 'Format of metrics file. Options: json|prometheus, default by filename.')
+    parser.add_argument('--profile',
+                        action = 'store_true',
+                        help = 'Run with cProfile and log hot functions of main thread.')
+    parser.add_argument('--loglevel',
+                        default='info',
+                        help='minimum severity of logged messages,\
+                        options: debug, info, warning, error, critical, default=info')
+
+    options = parser.parse_args()
+
+    # Setup logger
+    loglevel_dict={'debug':logging.DEBUG,
+                   'info':logging.INFO,
+                   'warning':logging.WARNING,
+                   'error':logging.ERROR,
+                   'critical':logging.CRITICAL}
+    logger = logging.getLogger("logger")
+    logger.setLevel(loglevel_dict[options.loglevel])
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s | (%(filename)s:%(lineno)d)','%Y-%m-%d %H:%M:%S')
+    logging.Formatter.converter = time.gmtime # use utc
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    metrics.run(main, "watch_tropomi", metrics_file = options.metrics_file,
+                metrics_format = options.metrics_format, profile = options.profile,
+                interval = options.interval)